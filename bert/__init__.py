@@ -1,2 +1,2 @@
 from .tokenization import BasicTokenizer, BertTokenizer
-from .modeling import BertModel
\ No newline at end of file
+from .modeling import BertConfig, BertModel
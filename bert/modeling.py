@@ -261,10 +261,11 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -278,6 +279,24 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 
+class BertPacking(object):
+    """Maps between padded `(batch_size, seq_len, ...)` tensors and packed
+    `(num_tokens, ...)` tensors that only hold the positions where
+    *attention_mask* is non-zero."""
+
+    def __init__(self, attention_mask):
+        self.batch_size, self.seq_len = attention_mask.size()
+        self.index = attention_mask.reshape(-1).ne(0).nonzero().squeeze(1)
+
+    def pack(self, x):
+        return x.reshape((self.batch_size * self.seq_len,) + x.size()[2:]).index_select(0, self.index)
+
+    def unpack(self, x):
+        padded = x.new_zeros((self.batch_size * self.seq_len,) + x.size()[1:])
+        padded = padded.index_copy(0, self.index, x)
+        return padded.view((self.batch_size, self.seq_len) + x.size()[1:])
+
+
 class BertSelfAttention(nn.Module):
     def __init__(self, config):
         super(BertSelfAttention, self).__init__()
@@ -300,10 +319,15 @@ class BertSelfAttention(nn.Module):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, attention_mask):
+    def forward(self, hidden_states, attention_mask, packing=None):
         mixed_query_layer = self.query(hidden_states)
         mixed_key_layer = self.key(hidden_states)
         mixed_value_layer = self.value(hidden_states)
+        if packing is not None:
+            # only the attention itself needs the padded layout
+            mixed_query_layer = packing.unpack(mixed_query_layer)
+            mixed_key_layer = packing.unpack(mixed_key_layer)
+            mixed_value_layer = packing.unpack(mixed_value_layer)
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_for_scores(mixed_key_layer)
@@ -326,6 +350,8 @@ class BertSelfAttention(nn.Module):
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
+        if packing is not None:
+            context_layer = packing.pack(context_layer)
         return context_layer
 
 
@@ -349,8 +375,8 @@ class BertAttention(nn.Module):
         self.self = BertSelfAttention(config)
         self.output = BertSelfOutput(config)
 
-    def forward(self, input_tensor, attention_mask):
-        self_output = self.self(input_tensor, attention_mask)
+    def forward(self, input_tensor, attention_mask, packing=None):
+        self_output = self.self(input_tensor, attention_mask, packing=packing)
         attention_output = self.output(self_output, input_tensor)
         return attention_output
 
@@ -391,8 +417,8 @@ class BertLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
 
-    def forward(self, hidden_states, attention_mask):
-        attention_output = self.attention(hidden_states, attention_mask)
+    def forward(self, hidden_states, attention_mask, packing=None):
+        attention_output = self.attention(hidden_states, attention_mask, packing=packing)
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
         return layer_output
@@ -405,10 +431,10 @@ class BertEncoder(nn.Module):
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
 
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, packing=None, num_layers=None):
         all_encoder_layers = []
-        for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+        for layer_module in self.layer[:num_layers]:
+            hidden_states = layer_module(hidden_states, attention_mask, packing=packing)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
         if not output_all_encoded_layers:
@@ -678,6 +704,12 @@ class BertModel(BertPreTrainedModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `packed`: boolean, if `True` the layers run on the tokens selected by `attention_mask` only, so that no
+            compute is spent on padding. Positions are the same as in the padded input and the encoded layers
+            are zero at masked positions. Default: `False`.
+        `output_layer`: an optional layer index (negative values count from the top of the pretrained model).
+            If set, only the layers up to and including it are computed, the pooler is skipped, and the outputs
+            are `(hidden states of that layer, None)`. Default: `None`.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
@@ -712,7 +744,41 @@ class BertModel(BertPreTrainedModel):
         self.apply(self.init_bert_weights)
         self.hidden_size = config.hidden_size
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+    def resolve_output_layer(self, output_layer):
+        """Map a possibly negative `output_layer` to the index of the layer in the pretrained model."""
+        num_hidden_layers = self.config.num_hidden_layers
+        if not -num_hidden_layers <= output_layer < num_hidden_layers:
+            raise ValueError('output_layer {} is out of range for a BERT model with {} layers'.format(
+                output_layer, num_hidden_layers))
+        output_layer %= num_hidden_layers
+        if output_layer >= len(self.encoder.layer):
+            raise ValueError('output_layer {} was removed by truncate(), only {} layers are left'.format(
+                output_layer, len(self.encoder.layer)))
+        return output_layer
+
+    def truncate(self, output_layer):
+        """Drop the layers above `output_layer` and the pooler.
+
+        `config.num_hidden_layers` still describes the pretrained model, so negative `output_layer`
+        values keep referring to the same layer afterwards.
+        """
+        num_layers = self.resolve_output_layer(output_layer) + 1
+        self.encoder.layer = self.encoder.layer[:num_layers]
+        self.pooler = None
+
+    def upgrade_state_dict_named(self, state_dict, name):
+        """Discard the weights of the parts removed by `truncate`, so full checkpoints still load."""
+        prefix = name + '.' if name else ''
+        removed = []
+        if self.pooler is None:
+            removed.append(prefix + 'pooler.')
+        removed.extend('{}encoder.layer.{}.'.format(prefix, i)
+                       for i in range(len(self.encoder.layer), self.config.num_hidden_layers))
+        for k in [k for k in state_dict if k.startswith(tuple(removed))]:
+            del state_dict[k]
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                packed=False, output_layer=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -733,12 +799,32 @@ class BertModel(BertPreTrainedModel):
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
-        encoded_layers = self.encoder(embedding_output,
-                                      extended_attention_mask,
-                                      output_all_encoded_layers=output_all_encoded_layers)
+        num_layers = None
+        if output_layer is not None:
+            num_layers = self.resolve_output_layer(output_layer) + 1
+            output_all_encoded_layers = False
+
+        if packed:
+            packing = BertPacking(attention_mask)
+            position_ids = torch.arange(input_ids.size(1), dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+            embedding_output = self.embeddings(packing.pack(input_ids), packing.pack(token_type_ids),
+                                               position_ids=packing.pack(position_ids))
+            encoded_layers = self.encoder(embedding_output,
+                                          extended_attention_mask,
+                                          output_all_encoded_layers=output_all_encoded_layers,
+                                          packing=packing, num_layers=num_layers)
+            encoded_layers = [packing.unpack(layer) for layer in encoded_layers]
+        else:
+            embedding_output = self.embeddings(input_ids, token_type_ids)
+            encoded_layers = self.encoder(embedding_output,
+                                          extended_attention_mask,
+                                          output_all_encoded_layers=output_all_encoded_layers,
+                                          num_layers=num_layers)
         sequence_output = encoded_layers[-1]
-        pooled_output = self.pooler(sequence_output)
+        if output_layer is not None:
+            return sequence_output, None
+        pooled_output = self.pooler(sequence_output) if self.pooler is not None else None
         if not output_all_encoded_layers:
             encoded_layers = encoded_layers[-1]
         return encoded_layers, pooled_output
@@ -17,6 +17,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import collections
+import functools
 import logging
 import os
 import unicodedata
@@ -77,7 +78,7 @@ class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
     def __init__(self, vocab_file, do_lower_case=True, max_len=None, do_basic_tokenize=True,
-                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]")):
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"), cache_size=100000):
         """Constructs a BertTokenizer.
 
         Args:
@@ -91,6 +92,7 @@ class BertTokenizer(object):
                          sequence length.
           never_split: List of tokens which will never be split during tokenization.
                          Only has an effect when do_wordpiece_only=False
+          cache_size: Number of whitespace-separated words whose word pieces are memoized.
         """
         if not os.path.isfile(vocab_file):
             raise ValueError(
@@ -113,17 +115,46 @@ class BertTokenizer(object):
         self.cls_index = self.vocab[self.cls_word]
         self.sep_word = "[SEP]"
         self.sep_index = self.vocab[self.sep_word]
+        self.cache_size = cache_size
+        self._build_word_cache()
 
-    def tokenize(self, text):
-        split_tokens = []
+    def _build_word_cache(self):
+        # Both tokenizers work on one whitespace-separated word at a time, so
+        # the word pieces of a word only depend on the word itself.
         if self.do_basic_tokenize:
-            for token in self.basic_tokenizer.tokenize(text):
-                for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                    split_tokens.append(sub_token)
+            self._split_words = self.basic_tokenizer.split_words
+            tokenize_word = self._tokenize_word
         else:
-            split_tokens = self.wordpiece_tokenizer.tokenize(text)
+            self._split_words = whitespace_tokenize
+            tokenize_word = self.wordpiece_tokenizer.tokenize_word
+        self._cached_tokenize_word = functools.lru_cache(maxsize=self.cache_size)(tokenize_word)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_split_words']
+        del state['_cached_tokenize_word']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_word_cache()
+
+    def _tokenize_word(self, word):
+        sub_tokens = []
+        for token in self.basic_tokenizer.tokenize_word(word):
+            sub_tokens.extend(self.wordpiece_tokenizer.tokenize_word(token))
+        return tuple(sub_tokens)
+
+    def tokenize(self, text):
+        split_tokens = []
+        for word in self._split_words(text):
+            split_tokens.extend(self._cached_tokenize_word(word))
         return split_tokens
 
+    def tokenize_batch(self, texts):
+        """Tokenizes a list of texts."""
+        return [self.tokenize(text) for text in texts]
+
     def __len__(self):
         """Returns the number of symbols in the dictionary"""
         return len(self.vocab)
@@ -137,11 +168,28 @@ class BertTokenizer(object):
     def sep(self):
         return self.sep_index
 
+    def encode_line(self, line):
+        """Converts a raw line into the ids of ``[CLS] line [SEP]`` used as BERT
+        input, truncated to ``max_len`` (keeping the final ``[SEP]``)."""
+        return self.encode_lines([line])[0]
+
+    def encode_lines(self, lines):
+        """Batched version of :func:`encode_line`."""
+        token_lists = self.tokenize_batch([
+            '{} {} {}'.format(self.cls_word, line.strip(), self.sep_word) for line in lines
+        ])
+        ids = []
+        for tokens in token_lists:
+            if len(tokens) > self.max_len:
+                tokens = tokens[:self.max_len - 1]
+                tokens.append(self.sep_word)
+            ids.append(self.convert_tokens_to_ids(tokens))
+        return ids
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
-        ids = []
-        for token in tokens:
-            ids.append(self.vocab[token])
+        vocab = self.vocab
+        ids = [vocab[token] for token in tokens]
         if len(ids) > self.max_len:
             logger.warning(
                 "Token indices sequence length is longer than the specified maximum "
@@ -234,26 +282,37 @@ class BasicTokenizer(object):
         """
         self.do_lower_case = do_lower_case
         self.never_split = never_split
+        self._char_table = _CleanCharTable(self._is_chinese_char)
+
+    def split_words(self, text):
+        """Splits text into whitespace-separated words after invalid character
+        removal, whitespace cleanup and CJK character splitting.
+
+        This is equivalent to ``whitespace_tokenize(self._tokenize_chinese_chars(
+        self._clean_text(text)))``, but does all three in a single
+        ``str.translate`` pass.
+        """
+        # CJK character splitting was added on November 1st, 2018 for the
+        # multilingual and Chinese models. This is also applied to the English
+        # models now, but it doesn't matter since the English models were not
+        # trained on any Chinese data and generally don't have any Chinese data
+        # in them (there are Chinese characters in the vocabulary because
+        # Wikipedia does have some Chinese words in the English Wikipedia.).
+        return text.translate(self._char_table).split()
+
+    def tokenize_word(self, token):
+        """Runs lower casing, accent stripping and punctuation splitting on a
+        single word returned by :func:`split_words`."""
+        if self.do_lower_case and token not in self.never_split:
+            token = token.lower()
+            token = self._run_strip_accents(token)
+        return whitespace_tokenize(" ".join(self._run_split_on_punc(token)))
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
-        text = self._clean_text(text)
-        # This was added on November 1st, 2018 for the multilingual and Chinese
-        # models. This is also applied to the English models now, but it doesn't
-        # matter since the English models were not trained on any Chinese data
-        # and generally don't have any Chinese data in them (there are Chinese
-        # characters in the vocabulary because Wikipedia does have some Chinese
-        # words in the English Wikipedia.).
-        text = self._tokenize_chinese_chars(text)
-        orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
-        for token in orig_tokens:
-            if self.do_lower_case and token not in self.never_split:
-                token = token.lower()
-                token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
-
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
+        output_tokens = []
+        for token in self.split_words(text):
+            output_tokens.extend(self.tokenize_word(token))
         return output_tokens
 
     def _run_strip_accents(self, text):
@@ -338,6 +397,32 @@ class BasicTokenizer(object):
         return "".join(output)
 
 
+class _CleanCharTable(dict):
+    """``str.translate`` table that applies ``BasicTokenizer._clean_text`` and
+    ``BasicTokenizer._tokenize_chinese_chars`` to a character. Entries are
+    filled in the first time a character is seen."""
+
+    def __init__(self, is_chinese_char):
+        super(_CleanCharTable, self).__init__()
+        self.is_chinese_char = is_chinese_char
+
+    def __missing__(self, cp):
+        char = chr(cp)
+        if cp == 0 or cp == 0xfffd or _is_control(char):
+            value = None
+        elif _is_whitespace(char):
+            value = " "
+        elif self.is_chinese_char(cp):
+            value = " " + char + " "
+        else:
+            value = char
+        self[cp] = value
+        return value
+
+
+_TRIE_END = ""
+
+
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
@@ -345,6 +430,49 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        # Prefix tries over the vocab: one for pieces starting a word, one for
+        # the "##" continuation pieces (keyed without the "##").
+        self._trie = {}
+        self._suffix_trie = {}
+        for piece in vocab:
+            self._add_to_trie(self._trie, piece, piece)
+            if piece.startswith("##") and len(piece) > 2:
+                self._add_to_trie(self._suffix_trie, piece[2:], piece)
+
+    @staticmethod
+    def _add_to_trie(trie, key, piece):
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[_TRIE_END] = piece
+
+    def tokenize_word(self, token):
+        """Tokenizes a single word into a tuple of word pieces.
+
+        Finds the longest vocab prefix of the remaining characters with a
+        single walk down the prefix trie, which gives the same pieces as
+        probing every substring from the longest down.
+        """
+        if len(token) > self.max_input_chars_per_word:
+            return (self.unk_token,)
+
+        sub_tokens = []
+        start = 0
+        while start < len(token):
+            node = self._trie if start == 0 else self._suffix_trie
+            cur_substr = None
+            for i in range(start, len(token)):
+                node = node.get(token[i])
+                if node is None:
+                    break
+                piece = node.get(_TRIE_END)
+                if piece is not None:
+                    cur_substr, end = piece, i + 1
+            if cur_substr is None:
+                return (self.unk_token,)
+            sub_tokens.append(cur_substr)
+            start = end
+        return tuple(sub_tokens)
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -366,35 +494,7 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
-
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
-                    break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
+            output_tokens.extend(self.tokenize_word(token))
         return output_tokens
 
 
@@ -0,0 +1,187 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import torch
+
+
+class BertOutputCache(object):
+    """Persistent cache of per-sentence BERT hidden states for generation.
+
+    Entries are keyed by the BERT weights (see
+    :func:`~fairseq.models.FairseqEncoderDecoderModel.bert_fingerprint`), the
+    output layer and the ``bert_input`` row, and hold the fp16 states of the
+    row's non-padding tokens. They are appended to a data file that is read
+    through a memory map, and listed in an index that is written by
+    :func:`flush` and :func:`close`. Entries not written to the index, e.g.
+    after a crash, are simply lost.
+
+    Once the entries exceed *max_bytes*, the least recently used ones are
+    evicted. Their space is reclaimed by rewriting the data file when it
+    grows to twice *max_bytes*.
+
+    The cache must not be used by several processes at once.
+
+    Args:
+        path (str): directory holding the cache, created if needed
+        max_bytes (int): size cap of the cached states
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, max_bytes):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (offset, length, hidden_dim), least recently used first
+        self.entries = OrderedDict()
+        self.generation = 0
+        index_file = self._index_file()
+        if os.path.exists(index_file):
+            with open(index_file, 'rb') as f:
+                state = pickle.load(f)
+            if state['version'] == self.VERSION:
+                self.entries = state['entries']
+                self.generation = state['generation']
+        self.live_bytes = sum(self._nbytes(entry) for entry in self.entries.values())
+        # data files left behind by an interrupted compaction
+        for name in os.listdir(path):
+            if name.startswith('data.') and name != os.path.basename(self._data_file_path(self.generation)):
+                os.remove(os.path.join(path, name))
+
+        self._data_file = open(self._data_file_path(self.generation), 'ab' if self.entries else 'wb')
+        self._data_file.seek(0, os.SEEK_END)
+        self._data_size = self._data_file.tell()
+        self._buffer = None
+
+    def _index_file(self):
+        return os.path.join(self.path, 'index.pkl')
+
+    def _data_file_path(self, generation):
+        return os.path.join(self.path, 'data.{}.bin'.format(generation))
+
+    @staticmethod
+    def _nbytes(entry):
+        _, length, hidden_dim = entry
+        return length * hidden_dim * np.dtype(np.float16).itemsize
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def keys(model, bert_input, output_layer=None):
+        """Cache keys of the rows of *bert_input* for *model*."""
+        if output_layer is None:
+            output_layer = model.bert_output_layer
+        prefix = '{} {} {}'.format(model.bert_fingerprint(), output_layer, model.packed_bert).encode()
+        pad = model.berttokenizer.pad()
+        keys = []
+        for row in bert_input.cpu().numpy():
+            if model.packed_bert:
+                # packed BERT does not see the padding, so its layout doesn't matter
+                row = row[row != pad]
+            h = hashlib.sha1(prefix)
+            h.update(row.astype(np.int64).tobytes())
+            keys.append(h.digest())
+        return keys
+
+    def get(self, key):
+        """The cached `(length, hidden_dim)` fp16 states of *key*, or None."""
+        entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        offset, length, hidden_dim = entry
+        if self._buffer is None or offset + self._nbytes(entry) > len(self._buffer):
+            self._data_file.flush()
+            self._buffer = np.memmap(self._data_file_path(self.generation), dtype=np.uint8, mode='r')
+        array = np.frombuffer(self._buffer, dtype=np.float16, count=length * hidden_dim, offset=offset)
+        return torch.from_numpy(array.reshape(length, hidden_dim).copy())
+
+    def put(self, key, states):
+        """Add the `(length, hidden_dim)` *states* of *key*."""
+        if key in self.entries:
+            return
+        array = states.detach().cpu().to(torch.float16).numpy()
+        entry = (self._data_size, array.shape[0], array.shape[1])
+        self._data_file.write(array.tobytes(order='C'))
+        self._data_size += array.nbytes
+        self.entries[key] = entry
+        self.live_bytes += array.nbytes
+        while self.live_bytes > self.max_bytes and len(self.entries) > 0:
+            _, evicted = self.entries.popitem(last=False)
+            self.live_bytes -= self._nbytes(evicted)
+        if self._data_size > 2 * self.max_bytes:
+            self._compact()
+
+    def bert_features(self, model, bert_input, output_layer=None):
+        """The `(batch, bert_len, hidden_dim)` fp16 states of *bert_input*, as
+        computed by :func:`~fairseq.models.FairseqEncoderDecoderModel.bert_features`.
+        Cached rows are read back and BERT only runs on the other ones.
+        Padding positions are zero."""
+        mask = bert_input.ne(model.berttokenizer.pad())
+        keys = self.keys(model, bert_input, output_layer)
+        states = [self.get(key) for key in keys]
+        misses = [i for i, s in enumerate(states) if s is None]
+        self.hits += len(keys) - len(misses)
+        self.misses += len(misses)
+        if len(misses) > 0:
+            miss_input = bert_input[misses]
+            computed = model.bert_features(miss_input, output_layer)
+            computed = computed[mask[misses]].to(torch.float16).cpu()
+            for i, s in zip(misses, computed.split(mask[misses].sum(dim=1).tolist())):
+                states[i] = s
+                self.put(keys[i], s)
+
+        features = torch.zeros(mask.size() + states[0].size()[1:], dtype=torch.float16)
+        features[mask.cpu()] = torch.cat(states, dim=0)
+        return features.to(bert_input.device)
+
+    def _compact(self):
+        """Rewrite the live entries to a new data file."""
+        generation = self.generation + 1
+        entries = OrderedDict()
+        offset = 0
+        with open(self._data_file_path(generation), 'wb') as f:
+            for key in list(self.entries.keys()):
+                _, length, hidden_dim = self.entries[key]
+                f.write(self.get(key).numpy().tobytes(order='C'))
+                entries[key] = (offset, length, hidden_dim)
+                offset += length * hidden_dim * np.dtype(np.float16).itemsize
+        old_generation = self.generation
+        self._data_file.close()
+        self._buffer = None
+        self.entries, self.generation = entries, generation
+        self._data_file = open(self._data_file_path(generation), 'ab')
+        self._data_size = offset
+        self.flush()
+        os.remove(self._data_file_path(old_generation))
+
+    def flush(self):
+        """Write the data and the index to disk."""
+        self._data_file.flush()
+        tmp_file = self._index_file() + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({
+                'version': self.VERSION,
+                'generation': self.generation,
+                'entries': self.entries,
+            }, f)
+        os.replace(tmp_file, self._index_file())
+
+    def close(self):
+        self.flush()
+        self._data_file.close()
+        self._buffer = None
@@ -6,11 +6,16 @@
 # can be found in the PATENTS file in the same directory.
 
 from collections import Counter
+from itertools import chain
 import os
 
+import numpy as np
+
 from fairseq.tokenizer import tokenize_line
 from bert import BertTokenizer
 import torch
+
+
 def safe_readline(f):
     pos = f.tell()
     while True:
@@ -26,6 +31,8 @@ class Binarizer:
     @staticmethod
     def binarize(filename, dict, consumer, tokenize=tokenize_line, append_eos=True, reverse_order=False,
                  offset=0, end=-1):
+        if isinstance(dict, BertTokenizer):
+            return Binarizer.binarize_bert(filename, dict, consumer, offset=offset, end=end)
         nseq, ntok = 0, 0
         replaced = Counter()
 
@@ -40,34 +47,59 @@ class Binarizer:
             while line:
                 if end > 0 and f.tell() > end:
                     break
-                if isinstance(dict, BertTokenizer):
-                    line = line.strip()
-                    line = '{} {} {}'.format('[CLS]', line, '[SEP]')
-                    tokenizedline = dict.tokenize(line)
-                    if len(tokenizedline) > dict.max_len:
-                        tokenizedline = tokenizedline[:dict.max_len-1]
-                        tokenizedline.append('[SEP]')
-                    words = dict.convert_tokens_to_ids(tokenizedline)
-                    nwords = len(words)
-                    ids = torch.IntTensor(nwords)
-                    for i, word in enumerate(words):
-                        ids[i] = word
-                        replaced_consumer(tokenizedline[i], word)
-                else:
-                    ids = dict.encode_line(
-                            line=line,
-                            line_tokenizer=tokenize,
-                            add_if_not_exist=False,
-                            consumer=replaced_consumer,
-                            append_eos=append_eos,
-                            reverse_order=reverse_order,
-                    )
+                ids = dict.encode_line(
+                    line=line,
+                    line_tokenizer=tokenize,
+                    add_if_not_exist=False,
+                    consumer=replaced_consumer,
+                    append_eos=append_eos,
+                    reverse_order=reverse_order,
+                )
                 nseq += 1
                 ntok += len(ids)
                 consumer(ids)
                 line = f.readline()
         return {'nseq': nseq, 'nunk': sum(replaced.values()), 'ntok': ntok, 'replaced': replaced}
 
+    @staticmethod
+    def binarize_bert(filename, tokenizer, consumer, offset=0, end=-1, batch_size=1000):
+        """Binarizes BERT input lines from *filename* with a
+        :class:`~bert.BertTokenizer`.
+
+        Lines are tokenized *batch_size* at a time and the ids of a batch are
+        converted with a single NumPy array, which is then split into one
+        tensor per sentence for *consumer*.
+        """
+        nseq, ntok, nunk = 0, 0, 0
+
+        def flush(lines):
+            nonlocal nseq, ntok, nunk
+            ids = tokenizer.encode_lines(lines)
+            lengths = np.fromiter((len(x) for x in ids), dtype=np.int64, count=len(ids))
+            flat = np.fromiter(chain.from_iterable(ids), dtype=np.int64, count=int(lengths.sum()))
+            nseq += len(ids)
+            ntok += flat.size
+            nunk += int((flat == tokenizer.unk_index).sum())
+            for sent in np.split(flat, np.cumsum(lengths)[:-1]):
+                consumer(torch.from_numpy(sent))
+
+        batch = []
+        with open(filename, 'r', encoding='utf-8') as f:
+            f.seek(offset)
+            # next(f) breaks f.tell(), hence readline() must be used
+            line = safe_readline(f)
+            while line:
+                if end > 0 and f.tell() > end:
+                    break
+                batch.append(line)
+                if len(batch) == batch_size:
+                    flush(batch)
+                    batch = []
+                line = f.readline()
+        if len(batch) > 0:
+            flush(batch)
+        return {'nseq': nseq, 'nunk': nunk, 'ntok': ntok, 'replaced': Counter()}
+
     @staticmethod
     def find_offsets(filename, num_chunks):
         with open(filename, 'r', encoding='utf-8') as f:
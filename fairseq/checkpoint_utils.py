@@ -8,6 +8,8 @@
 from collections import OrderedDict
 from typing import Union
 import collections
+import hashlib
+import json
 import logging
 import os
 import re
@@ -59,8 +61,10 @@ def save_checkpoint(args, trainer, epoch_itr, val_loss, warmup_from_nmt=False):
         extra_state.update({'best': save_checkpoint.best})
 
     checkpoints = [os.path.join(args.save_dir, fn) for fn, cond in checkpoint_conds.items() if cond]
+    frozen_references = {}
     if len(checkpoints) > 0:
-        trainer.save_checkpoint(checkpoints[0], extra_state)
+        frozen_file = trainer.save_checkpoint(checkpoints[0], extra_state)
+        frozen_references = {os.path.basename(cp): frozen_file for cp in checkpoints}
         for cp in checkpoints[1:]:
             shutil.copyfile(checkpoints[0], cp)
 
@@ -86,6 +90,8 @@ def save_checkpoint(args, trainer, epoch_itr, val_loss, warmup_from_nmt=False):
             if os.path.lexists(old_chk):
                 os.remove(old_chk)
 
+    prune_frozen_states(args.save_dir, frozen_references)
+
 
 def load_checkpoint(args, trainer):
     """Load a checkpoint and restore the training iterator."""
@@ -141,10 +147,101 @@ def load_checkpoint_to_cpu(path):
     state = torch.load(
         path, map_location=lambda s, l: default_restore_location(s, 'cpu'),
     )
+    state = load_frozen_state(state, path)
     state = _upgrade_state_dict(state)
     return state
 
 
+def load_frozen_state(state, path):
+    """Merge the frozen parameters referenced by the checkpoint *state*
+    loaded from *path* (see :func:`save_frozen_state`) back into
+    ``state['model']``."""
+    frozen_file = state.pop('frozen_model_state', None)
+    if frozen_file is None:
+        return state
+    frozen_path = os.path.join(os.path.dirname(path), frozen_file)
+    if not os.path.exists(frozen_path):
+        raise IOError('Frozen parameters referenced by {} not found: {}'.format(path, frozen_path))
+    frozen_state = torch.load(
+        frozen_path, map_location=lambda s, l: default_restore_location(s, 'cpu'),
+    )
+    state['model'].update(frozen_state)
+    return state
+
+
+def save_frozen_state(state_dict, frozen_keys, save_dir):
+    """Move the entries *frozen_keys* of a model *state_dict* to a separate
+    file in *save_dir*, named after a hash of their content, so that it is
+    written only once and shared by all checkpoints.
+
+    Returns:
+        tuple: the state dict without the frozen entries and the name of the
+        frozen state file (relative to *save_dir*)
+    """
+    frozen_state = OrderedDict()
+    sha = hashlib.sha1()
+    for key in sorted(frozen_keys):
+        value = state_dict[key].detach().cpu().contiguous()
+        frozen_state[key] = value
+        sha.update('{} {} {}'.format(key, value.dtype, tuple(value.size())).encode('utf-8'))
+        sha.update(value.view(-1).view(torch.uint8).numpy() if value.numel() > 0 else b'')
+    frozen_file = 'frozen_{}.pt'.format(sha.hexdigest()[:16])
+
+    frozen_path = os.path.join(save_dir, frozen_file)
+    if not os.path.exists(frozen_path):
+        torch_persistent_save(frozen_state, frozen_path + '.tmp')
+        os.replace(frozen_path + '.tmp', frozen_path)
+
+    state_dict = OrderedDict(
+        (key, value) for key, value in state_dict.items() if key not in frozen_state
+    )
+    return state_dict, frozen_file
+
+
+def prune_frozen_states(save_dir, frozen_references):
+    """Delete the frozen state files (see :func:`save_frozen_state`) that
+    no checkpoint in *save_dir* references anymore, e.g. once the
+    checkpoints saved before some BERT layers were unfrozen are removed.
+
+    The reference of each checkpoint is recorded in *save_dir* as
+    checkpoints are saved rather than read back from the checkpoints.
+
+    Args:
+        save_dir (str): the checkpoint directory
+        frozen_references (Dict[str, str]): the frozen state file (or None)
+            referenced by each checkpoint just saved, by file name
+    """
+    path = os.path.join(save_dir, 'frozen_states.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            references = json.load(f)
+    elif any(frozen_file is not None for frozen_file in frozen_references.values()):
+        references = {}
+    else:
+        return  # no frozen state was ever saved
+    references.update(frozen_references)
+    checkpoints = set(
+        os.path.basename(cp) for cp in checkpoint_paths(save_dir, pattern=r'checkpoint.*\.pt')
+    )
+    references = {cp: frozen_file for cp, frozen_file in references.items() if cp in checkpoints}
+    with open(path + '.tmp', 'w') as f:
+        json.dump(references, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+    referenced = set(references.values())
+    unreferenced = [
+        frozen_path for frozen_path in checkpoint_paths(save_dir, pattern=r'frozen_[0-9a-f]+\.pt')
+        if os.path.basename(frozen_path) not in referenced
+    ]
+    if len(unreferenced) > 0 and len(checkpoints) > len(references):
+        # rather keep unused files than break a checkpoint
+        print('| WARNING: not deleting frozen state files, {} does not record {}'.format(
+            path, ', '.join(sorted(checkpoints - set(references)))))
+        return
+    for frozen_path in unreferenced:
+        os.remove(frozen_path)
+
+
 def load_model_ensemble(filenames, arg_overrides=None, task=None, bert_ratio=None, encoder_ratio=None, geargs=None):
     """Loads an ensemble of models.
 
@@ -164,6 +261,11 @@ def load_model_ensemble(filenames, arg_overrides=None, task=None, bert_ratio=Non
         if geargs is not None:
             bert_output_layer = getattr(args, 'bert_output_layer', -1)
             setattr(geargs, 'bert_output_layer', bert_output_layer)
+            if getattr(geargs, 'truncate_bert', False):
+                args.truncate_bert = True
+            if getattr(geargs, 'concurrent_bert', False):
+                args.concurrent_bert = True
+                args.bert_threads = geargs.bert_threads
         if arg_overrides is not None:
             for arg_name, arg_val in arg_overrides.items():
                 setattr(args, arg_name, arg_val)
@@ -227,7 +329,7 @@ def convert_state_dict_type(state_dict, ttype=torch.FloatTensor):
 
 def save_state(
     filename, args, model_state_dict, criterion, optimizer, lr_scheduler,
-    num_updates, optim_history=None, extra_state=None,
+    num_updates, optim_history=None, extra_state=None, frozen_model_state=None,
 ):
     if optim_history is None:
         optim_history = []
@@ -247,6 +349,9 @@ def save_state(
         'last_optimizer_state': convert_state_dict_type(optimizer.state_dict()),
         'extra_state': extra_state,
     }
+    if frozen_model_state is not None:
+        # name of a file next to the checkpoint with the remaining model params
+        state_dict['frozen_model_state'] = frozen_model_state
     torch_persistent_save(state_dict, filename)
 
 
@@ -75,6 +75,10 @@ class AdaptiveLoss(FairseqCriterion):
         }
         return loss, sample_size, logging_output
 
+    @staticmethod
+    def logging_keys():
+        return {'loss': float, 'ntokens': int, 'nsentences': int, 'sample_size': int}
+
     @staticmethod
     def aggregate_logging_outputs(logging_outputs):
         """Aggregate logging outputs from data parallel training."""
@@ -50,6 +50,10 @@ class CrossEntropyCriterion(FairseqCriterion):
         )
         return loss, loss
 
+    @staticmethod
+    def logging_keys():
+        return {'loss': float, 'ntokens': int, 'nsentences': int, 'sample_size': int}
+
     @staticmethod
     def aggregate_logging_outputs(logging_outputs):
         """Aggregate logging outputs from data parallel training."""
@@ -39,6 +39,15 @@ class FairseqCriterion(_Loss):
         """Aggregate logging outputs from data parallel training."""
         raise NotImplementedError
 
+    @staticmethod
+    def logging_keys():
+        """The type (``int`` or ``float``) of each key of the logging
+        outputs, if they are numbers that :func:`aggregate_logging_outputs`
+        and :func:`grad_denom` only sum. The logging outputs of the workers
+        are then summed with a single all_reduce during distributed
+        training, instead of being gathered. None if unknown."""
+        return None
+
     @staticmethod
     def grad_denom(sample_sizes):
         """Compute the gradient denominator for a set of sample sizes."""
@@ -61,6 +61,10 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         loss = (1. - self.eps) * nll_loss + eps_i * smooth_loss
         return loss, nll_loss
 
+    @staticmethod
+    def logging_keys():
+        return {'loss': float, 'nll_loss': float, 'ntokens': int, 'nsentences': int, 'sample_size': int}
+
     @staticmethod
     def aggregate_logging_outputs(logging_outputs):
         """Aggregate logging outputs from data parallel training."""
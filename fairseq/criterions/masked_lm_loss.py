@@ -126,6 +126,13 @@ class MaskedLmLoss(FairseqCriterion):
         }
         return loss, sample_size, logging_output
 
+    @staticmethod
+    def logging_keys():
+        return {
+            'loss': float, 'lm_loss': float, 'sentence_loss': float,
+            'ntokens': int, 'nsentences': int, 'sample_size': int,
+        }
+
     @staticmethod
     def aggregate_logging_outputs(logging_outputs):
         """Aggregate logging outputs from data parallel training."""
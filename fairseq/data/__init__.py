@@ -13,7 +13,13 @@ from .fairseq_dataset import FairseqDataset
 from .backtranslation_dataset import BacktranslationDataset
 from .block_pair_dataset import BlockPairDataset
 from .concat_dataset import ConcatDataset
-from .indexed_dataset import IndexedCachedDataset, IndexedDataset, IndexedRawTextDataset, MMapIndexedDataset
+from .indexed_dataset import (
+    IndexedCachedDataset,
+    IndexedDataset,
+    IndexedRawTextDataset,
+    MMapBertFeatureDataset,
+    MMapIndexedDataset,
+)
 from .language_pair_dataset import LanguagePairDataset
 from .lm_context_window_dataset import LMContextWindowDataset
 from .masked_lm_dataset import MaskedLMDataset
@@ -48,6 +54,7 @@ __all__ = [
     'LMContextWindowDataset',
     'MaskedLMDataset',
     'MaskedLMDictionary',
+    'MMapBertFeatureDataset',
     'MMapIndexedDataset',
     'MonolingualDataset',
     'NoisingDataset',
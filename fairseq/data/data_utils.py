@@ -6,6 +6,7 @@
 # can be found in the PATENTS file in the same directory.
 
 import contextlib
+import hashlib
 import os
 import numpy as np
 try:
@@ -128,10 +129,11 @@ def filter_by_size(indices, size_fn, max_positions, raise_exception=False):
 
 def batch_by_size(
     indices, num_tokens_fn, max_tokens=None, max_sentences=None,
-    required_batch_size_multiple=1,
+    required_batch_size_multiple=1, num_tokens_vec=None,
+    bert_num_tokens_vec=None, max_bert_tokens=None, cache_dir=None,
 ):
     """
-    Yield mini-batches of indices bucketed by size. Batches may contain
+    Return mini-batches of indices bucketed by size. Batches may contain
     sequences of different lengths.
 
     Args:
@@ -144,46 +146,173 @@ def batch_by_size(
             batch (default: None).
         required_batch_size_multiple (int, optional): require batch size to
             be a multiple of N (default: 1).
+        num_tokens_vec (np.ndarray, optional): number of tokens (or token cost,
+            see :func:`quadratic_cost`) of each index in *indices*; computed
+            with *num_tokens_fn* if not given (default: None).
+        bert_num_tokens_vec (np.ndarray, optional): number of BERT tokens of
+            each index in *indices*, budgeted separately by *max_bert_tokens*
+            (default: None).
+        max_bert_tokens (int, optional): max number of BERT tokens in each
+            batch (default: None).
+        cache_dir (str, optional): directory in which to cache the batches,
+            keyed by a fingerprint of the sizes and batching options
+            (default: None).
+
+    Returns:
+        List[List[int]]: mini-batches of indices
     """
-    max_tokens = max_tokens if max_tokens is not None else float('Inf')
-    max_sentences = max_sentences if max_sentences is not None else float('Inf')
-    bsz_mult = required_batch_size_multiple
-
-    batch = []
-
-    def is_batch_full(num_tokens):
-        if len(batch) == 0:
-            return False
-        if len(batch) == max_sentences:
-            return True
-        if num_tokens > max_tokens:
-            return True
-        return False
-
-    sample_len = 0
-    sample_lens = []
-    for idx in indices:
-        sample_lens.append(num_tokens_fn(idx))
-        sample_len = max(sample_len, sample_lens[-1])
-        assert sample_len <= max_tokens, (
-            "sentence at index {} of size {} exceeds max_tokens "
-            "limit of {}!".format(idx, sample_len, max_tokens)
+    indices = np.fromiter(indices, dtype=np.int64)
+    if num_tokens_vec is None:
+        num_tokens_vec = np.fromiter(
+            (num_tokens_fn(idx) for idx in indices), dtype=np.int64, count=len(indices),
         )
-        num_tokens = (len(batch) + 1) * sample_len
-        if is_batch_full(num_tokens):
-            mod_len = max(
-                bsz_mult * (len(batch) // bsz_mult),
-                len(batch) % bsz_mult,
-            )
-            yield batch[:mod_len]
-            batch = batch[mod_len:]
-            sample_lens = sample_lens[mod_len:]
-            sample_len = max(sample_lens) if len(sample_lens) > 0 else 0
+    budgets = [(np.asarray(num_tokens_vec), max_tokens, 'max_tokens')]
+    if max_bert_tokens is not None:
+        assert bert_num_tokens_vec is not None, 'max_bert_tokens requires bert_num_tokens_vec'
+        budgets.append((np.asarray(bert_num_tokens_vec), max_bert_tokens, 'max_bert_tokens'))
+    for sizes, _, _ in budgets:
+        assert len(sizes) == len(indices)
+
+    cache_path = None
+    if cache_dir is not None:
+        fingerprint = hashlib.sha1()
+        fingerprint.update(np.ascontiguousarray(indices))
+        for sizes, _, _ in budgets:
+            fingerprint.update(np.ascontiguousarray(sizes))
+        fingerprint.update(repr((
+            max_tokens, max_sentences, required_batch_size_multiple, max_bert_tokens,
+        )).encode('utf-8'))
+        cache_path = os.path.join(cache_dir, 'batches.{}.npy'.format(fingerprint.hexdigest()))
+        if os.path.exists(cache_path):
+            return _split_batches(indices, np.load(cache_path))
+
+    for sizes, limit, name in budgets:
+        if limit is None:
+            continue
+        too_long = np.nonzero(sizes > limit)[0]
+        assert len(too_long) == 0, (
+            "sentence at index {} of size {} exceeds {} "
+            "limit of {}!".format(indices[too_long[0]], sizes[too_long[0]], name, limit)
+        )
+
+    offsets = _batch_offsets(
+        [(sizes, limit) for sizes, limit, _ in budgets if limit is not None],
+        len(indices), max_sentences, required_batch_size_multiple,
+    )
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, offsets)
+        os.replace(tmp_path, cache_path)
+
+    return _split_batches(indices, offsets)
+
+
+def quadratic_cost(num_tokens, weight):
+    """Cost of sentences of *num_tokens* tokens in token equivalents, where
+    the quadratic term accounts for self-attention. A batch padded to length
+    *n* then costs its size times ``n + weight * n ** 2``."""
+    num_tokens = np.asarray(num_tokens, dtype=np.float64)
+    return num_tokens + weight * num_tokens ** 2
+
+
+def filter_by_cost(indices, budgets, raise_exception=False):
+    """
+    Filter indices whose cost (see :func:`quadratic_cost`) alone exceeds the
+    limit of a batch, which :func:`batch_by_size` rejects.
+
+    Args:
+        indices (np.array): ordered array of dataset indices
+        budgets (List[tuple]): ``(costs, limit, option)`` triples, where
+            *costs* holds the cost of each index and *option* names the
+            command-line option of the *limit*, which may be None
+        raise_exception (bool, optional): if ``True``, raise an exception if
+            any elements are filtered (default: False).
+
+    Returns:
+        tuple: the kept indices and their costs, in the order of *budgets*
+    """
+    keep = np.ones(len(indices), dtype=np.bool_)
+    for costs, limit, option in budgets:
+        if limit is None:
+            continue
+        too_costly = costs > limit
+        if too_costly.any() and raise_exception:
+            first = np.nonzero(too_costly)[0][0]
+            raise Exception((
+                'Cost of sample #{} (={:.0f}) exceeds {}={} with --quadratic-cost-weight, '
+                'lower the weight or skip this example with --skip-invalid-size-inputs-valid-test'
+            ).format(indices[first], costs[first], option, limit))
+        keep &= ~too_costly
+
+    if not keep.all():
+        print((
+            '| WARNING: {} samples cost more than a batch with --quadratic-cost-weight and will '
+            'be skipped, first few sample ids={}'
+        ).format(int((~keep).sum()), indices[~keep][:10].tolist()))
+    return (indices[keep],) + tuple(
+        costs[keep] if costs is not None else None for costs, _, _ in budgets
+    )
+
+
+def _split_batches(indices, offsets):
+    if len(indices) == 0:
+        return []
+    return [batch.tolist() for batch in np.split(indices, offsets[1:-1])]
+
+
+def _batch_offsets(budgets, num_samples, max_sentences, bsz_mult):
+    """Return the boundaries of the batches built greedily over *num_samples*
+    ordered samples, such that ``offsets[i]:offsets[i + 1]`` is the i-th batch.
+
+    A sample closes the current batch when the batch already holds
+    *max_sentences* samples, or when adding it would make the padded size
+    (batch size times the longest sample) exceed the limit of any of the
+    ``(sizes, limit)`` *budgets*. The closed batch is trimmed to a multiple of
+    *bsz_mult* and the remainder is carried over together with that sample.
+    Both the running maximum and the batch size only grow while a batch is
+    filled, so the closing sample is found with one vectorized scan over a
+    window of samples instead of a Python loop over all of them.
+    """
+    offsets = [0]
+    start = pos = 0
+    sample_lens = [0] * len(budgets)
+    window = 64
+    while pos < num_samples:
+        end = min(num_samples, pos + window)
+        count = np.arange(pos - start + 1, end - start + 1)
+        if max_sentences is not None:
+            full = count - 1 == max_sentences
+        else:
+            full = np.zeros(end - pos, dtype=np.bool_)
+        run_max = []
+        for (sizes, limit), sample_len in zip(budgets, sample_lens):
+            lens = np.maximum(np.maximum.accumulate(sizes[pos:end]), sample_len)
+            full |= count * lens > limit
+            run_max.append(lens)
+        full &= count > 1
+
+        if not full.any():
+            # the batch is still open; scan further with a bigger window
+            sample_lens = [lens[-1] for lens in run_max]
+            pos = end
+            window *= 2
+            continue
 
-        batch.append(idx)
+        idx = pos + int(np.argmax(full))
+        batch_len = idx - start
+        mod_len = max(bsz_mult * (batch_len // bsz_mult), batch_len % bsz_mult)
+        start += mod_len
+        offsets.append(start)
+        sample_lens = [sizes[start:idx + 1].max() for sizes, _ in budgets]
+        pos = idx + 1
+        window = max(64, 2 * batch_len)
 
-    if len(batch) > 0:
-        yield batch
+    if start < num_samples:
+        offsets.append(num_samples)
+    return np.array(offsets, dtype=np.int64)
 
 
 def process_bpe_symbol(sentence: str, bpe_symbol: str):
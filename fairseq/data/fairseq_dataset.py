@@ -5,6 +5,7 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import numpy as np
 import torch.utils.data
 
 
@@ -33,6 +34,19 @@ class FairseqDataset(torch.utils.data.Dataset):
         enforce ``--max-tokens`` during batching."""
         raise NotImplementedError
 
+    def num_tokens_vec(self, indices):
+        """Return the number of tokens for each of the given indices as a
+        NumPy array. Datasets backed by size arrays should override this with
+        a vectorized version of :func:`num_tokens`."""
+        return np.fromiter((self.num_tokens(index) for index in indices), dtype=np.int64, count=len(indices))
+
+    def branch_num_tokens_vec(self, indices):
+        """Return the number of NMT tokens and the number of BERT input tokens
+        for each of the given indices, used to enforce ``--max-tokens`` and
+        ``--max-bert-tokens`` separately. Datasets without BERT input return
+        ``None`` for the latter."""
+        return self.num_tokens_vec(indices), None
+
     def size(self, index):
         """Return an example's size as a float or tuple. This value is used when
         filtering a dataset with ``--max-positions``."""
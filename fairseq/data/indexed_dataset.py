@@ -478,3 +478,163 @@ class MMapIndexedDatasetBuilder(object):
 
         with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
             index.write(self._sizes)
+
+
+class MMapBertFeatureDataset(torch.utils.data.Dataset):
+    """Memory-mapped store of precomputed BERT hidden states.
+
+    Each item is a ``(seq_len, hidden_dim)`` fp16 tensor holding the
+    ``--bert-output-layer`` states of one sentence of the matching
+    ``{split}.bert.{src}-{tgt}.{src}`` dataset, see
+    ``scripts/extract_bert_features.py``.
+    """
+
+    class Index(object):
+        _HDR_MAGIC = b'MMBFIDX\x00\x00'
+
+        @classmethod
+        def writer(cls, path, hidden_dim, output_layer):
+            class _Writer(object):
+                def __enter__(self):
+                    self._file = open(path, 'wb')
+
+                    self._file.write(cls._HDR_MAGIC)
+                    self._file.write(struct.pack('<Q', 1))
+                    self._file.write(struct.pack('<Q', hidden_dim))
+                    self._file.write(struct.pack('<q', output_layer))
+
+                    return self
+
+                def write(self, sizes):
+                    sizes = np.array(sizes, dtype=np.int32)
+                    pointers = np.zeros(len(sizes), dtype=np.int64)
+                    item_bytes = sizes.astype(np.int64) * hidden_dim * np.dtype(np.float16).itemsize
+                    np.cumsum(item_bytes[:-1], out=pointers[1:])
+
+                    self._file.write(struct.pack('<Q', len(sizes)))
+                    self._file.write(sizes.tobytes(order='C'))
+                    self._file.write(pointers.tobytes(order='C'))
+
+                def __exit__(self, exc_type, exc_val, exc_tb):
+                    self._file.close()
+
+            return _Writer()
+
+        def __init__(self, path):
+            with open(path, 'rb') as stream:
+                magic_test = stream.read(9)
+                assert self._HDR_MAGIC == magic_test, (
+                    'Index file doesn\'t match expected format. '
+                    'Make sure the file was written by scripts/extract_bert_features.py.'
+                )
+                version = struct.unpack('<Q', stream.read(8))
+                assert (1,) == version
+
+                self._hidden_dim, = struct.unpack('<Q', stream.read(8))
+                self._output_layer, = struct.unpack('<q', stream.read(8))
+                self._len = struct.unpack('<Q', stream.read(8))[0]
+                offset = stream.tell()
+
+            self._bin_buffer = memoryview(np.memmap(path, mode='r', order='C'))
+            self._sizes = np.frombuffer(self._bin_buffer, dtype=np.int32, count=self._len, offset=offset)
+            self._pointers = np.frombuffer(self._bin_buffer, dtype=np.int64, count=self._len,
+                                           offset=offset + self._sizes.nbytes)
+
+        @property
+        def hidden_dim(self):
+            return self._hidden_dim
+
+        @property
+        def output_layer(self):
+            return self._output_layer
+
+        @property
+        def sizes(self):
+            return self._sizes
+
+        def __getitem__(self, i):
+            return self._pointers[i], self._sizes[i]
+
+        def __len__(self):
+            return self._len
+
+    def __init__(self, path):
+        super().__init__()
+
+        self._path = None
+        self._index = None
+        self._bin_buffer = None
+
+        self._do_init(path)
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._do_init(state)
+
+    def _do_init(self, path):
+        self._path = path
+        self._index = self.Index(index_file_path(self._path))
+        self._bin_buffer = memoryview(np.memmap(data_file_path(self._path), mode='r', order='C'))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        ptr, size = self._index[i]
+        hidden_dim = self._index.hidden_dim
+        array = np.frombuffer(self._bin_buffer, dtype=np.float16, count=size * hidden_dim, offset=ptr)
+        return torch.from_numpy(array).view(size, hidden_dim)
+
+    @property
+    def sizes(self):
+        return self._index.sizes
+
+    @property
+    def hidden_dim(self):
+        return self._index.hidden_dim
+
+    @property
+    def output_layer(self):
+        return self._index.output_layer
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+    @staticmethod
+    def exists(path):
+        return (
+            os.path.exists(index_file_path(path)) and os.path.exists(data_file_path(path))
+        )
+
+
+class MMapBertFeatureDatasetBuilder(object):
+    def __init__(self, out_file, hidden_dim, output_layer=-1):
+        self._data_file = open(out_file, 'wb')
+        self._hidden_dim = hidden_dim
+        self._output_layer = output_layer
+        self._sizes = []
+
+    def add_item(self, tensor):
+        assert tensor.dim() == 2 and tensor.size(1) == self._hidden_dim
+        np_array = tensor.detach().cpu().to(torch.float16).numpy()
+        self._data_file.write(np_array.tobytes(order='C'))
+        self._sizes.append(np_array.shape[0])
+
+    def merge_file_(self, another_file):
+        index = MMapBertFeatureDataset.Index(index_file_path(another_file))
+        assert index.hidden_dim == self._hidden_dim
+        assert index.output_layer == self._output_layer
+
+        self._sizes.extend(index.sizes.tolist())
+
+        with open(data_file_path(another_file), 'rb') as f:
+            shutil.copyfileobj(f, self._data_file)
+
+    def finalize(self, index_file):
+        self._data_file.close()
+
+        with MMapBertFeatureDataset.Index.writer(index_file, self._hidden_dim, self._output_layer) as index:
+            index.write(self._sizes)
@@ -13,10 +13,12 @@ from . import data_utils, FairseqDataset
 
 def collate(
     samples, pad_idx, eos_idx,bert_pad_idx, left_pad_source=True, left_pad_target=False,
-    input_feeding=True,
+    input_feeding=True, left_pad_bert=None,
 ):
     if len(samples) == 0:
         return {}
+    if left_pad_bert is None:
+        left_pad_bert = left_pad_source
 
     def merge(key, left_pad, move_eos_to_beginning=False, bert_input=False):
         return data_utils.collate_tokens(
@@ -26,7 +28,7 @@ def collate(
 
     id = torch.LongTensor([s['id'] for s in samples])
     src_tokens = merge('source', left_pad=left_pad_source)
-    src_bert_tokens = merge('source_bert', left_pad=left_pad_source, bert_input=True)
+    src_bert_tokens = merge('source_bert', left_pad=left_pad_bert, bert_input=True)
     # sort by descending source length
     src_lengths = torch.LongTensor([s['source'].numel() for s in samples])
     src_lengths, sort_order = src_lengths.sort(descending=True)
@@ -34,6 +36,22 @@ def collate(
     src_tokens = src_tokens.index_select(0, sort_order)
     src_bert_tokens = src_bert_tokens.index_select(0, sort_order)
 
+    src_bert_features = None
+    if samples[0].get('source_bert_features', None) is not None:
+        # precomputed BERT states are padded exactly like *source_bert*, so
+        # the padding mask derived from ``bert_input`` stays valid
+        features = [s['source_bert_features'] for s in samples]
+        max_len = src_bert_tokens.size(1)
+        src_bert_features = features[0].new_zeros(len(features), max_len, features[0].size(-1))
+        for i, f in enumerate(features):
+            assert f.size(0) == samples[i]['source_bert'].numel(), \
+                'precomputed BERT features do not match the BERT input length'
+            if left_pad_bert:
+                src_bert_features[i, max_len - f.size(0):].copy_(f)
+            else:
+                src_bert_features[i, :f.size(0)].copy_(f)
+        src_bert_features = src_bert_features.index_select(0, sort_order)
+
     prev_output_tokens = None
     target = None
     if samples[0].get('target', None) is not None:
@@ -66,6 +84,8 @@ def collate(
     }
     if prev_output_tokens is not None:
         batch['net_input']['prev_output_tokens'] = prev_output_tokens
+    if src_bert_features is not None:
+        batch['net_input']['bert_features'] = src_bert_features
     return batch
 
 
@@ -97,6 +117,13 @@ class LanguagePairDataset(FairseqDataset):
             of source if it's present (default: False).
         append_eos_to_target (bool, optional): if set, appends eos to end of
             target if it's absent (default: False).
+        srcbert_features (torch.utils.data.Dataset, optional): precomputed
+            BERT hidden states aligned with *srcbert*. When given, batches
+            contain a ``bert_features`` tensor and the model skips the BERT
+            forward (default: None).
+        left_pad_bert (bool, optional): pad BERT input tensors on the left
+            side. BERT positions count from the first column, so left padding
+            shifts them (default: same as *left_pad_source*).
     """
 
     def __init__(
@@ -106,6 +133,7 @@ class LanguagePairDataset(FairseqDataset):
         left_pad_source=True, left_pad_target=False,
         max_source_positions=1024, max_target_positions=1024,
         shuffle=True, input_feeding=True, remove_eos_from_source=False, append_eos_to_target=False,
+        srcbert_features=None, left_pad_bert=None,
     ):
         if tgt_dict is not None:
             assert src_dict.pad() == tgt_dict.pad()
@@ -114,6 +142,7 @@ class LanguagePairDataset(FairseqDataset):
         self.src = src
         self.tgt = tgt
         self.srcbert = srcbert
+        self.srcbert_features = srcbert_features
         self.src_sizes = np.array(src_sizes)
         self.tgt_sizes = np.array(tgt_sizes) if tgt_sizes is not None else None
         self.srcbert_sizes = np.array(srcbert_sizes) if srcbert_sizes is not None else None
@@ -122,6 +151,7 @@ class LanguagePairDataset(FairseqDataset):
         self.berttokenizer = berttokenizer
         self.left_pad_source = left_pad_source
         self.left_pad_target = left_pad_target
+        self.left_pad_bert = left_pad_bert if left_pad_bert is not None else left_pad_source
         self.max_source_positions = max_source_positions
         self.max_target_positions = max_target_positions
         self.shuffle = shuffle
@@ -147,12 +177,15 @@ class LanguagePairDataset(FairseqDataset):
             if self.src[index][-1] == eos:
                 src_item = self.src[index][:-1]
 
-        return {
+        example = {
             'id': index,
             'source': src_item,
             'target': tgt_item,
             'source_bert': src_bert_item
         }
+        if self.srcbert_features is not None:
+            example['source_bert_features'] = self.srcbert_features[index]
+        return example
 
     def __len__(self):
         return len(self.src)
@@ -181,6 +214,12 @@ class LanguagePairDataset(FairseqDataset):
                     tgt_len)`. This key will not be present if *input_feeding*
                     is ``False``. Padding will appear on the left if
                     *left_pad_target* is ``True``.
+                  - `bert_input` (LongTensor): a padded 2D Tensor of BERT input
+                    tokens of shape `(bsz, bert_len)`. Padding will appear on
+                    the left if *left_pad_bert* is ``True``.
+                  - `bert_features` (HalfTensor): precomputed BERT states of
+                    shape `(bsz, bert_len, hidden_dim)`, padded like
+                    `bert_input`. Only present if *srcbert_features* is set.
 
                 - `target` (LongTensor): a padded 2D Tensor of tokens in the
                   target sentence of shape `(bsz, tgt_len)`. Padding will appear
@@ -189,7 +228,7 @@ class LanguagePairDataset(FairseqDataset):
         return collate(
             samples, pad_idx=self.src_dict.pad(), eos_idx=self.src_dict.eos(), bert_pad_idx=self.berttokenizer.pad(),
             left_pad_source=self.left_pad_source, left_pad_target=self.left_pad_target,
-            input_feeding=self.input_feeding,
+            input_feeding=self.input_feeding, left_pad_bert=self.left_pad_bert,
         )
 
     def num_tokens(self, index):
@@ -199,6 +238,20 @@ class LanguagePairDataset(FairseqDataset):
         a = max(self.src_sizes[index], self.tgt_sizes[index] if self.tgt_sizes is not None else 0)
         return max(a, self.srcbert_sizes[index])
 
+    def num_tokens_vec(self, indices):
+        """Vectorized version of :func:`num_tokens`."""
+        sizes, bert_sizes = self.branch_num_tokens_vec(indices)
+        if bert_sizes is not None:
+            sizes = np.maximum(sizes, bert_sizes)
+        return sizes
+
+    def branch_num_tokens_vec(self, indices):
+        sizes = self.src_sizes[indices]
+        if self.tgt_sizes is not None:
+            sizes = np.maximum(sizes, self.tgt_sizes[indices])
+        bert_sizes = self.srcbert_sizes[indices] if self.srcbert_sizes is not None else None
+        return sizes, bert_sizes
+
     def size(self, index):
         """Return an example's size as a float or tuple. This value is used when
         filtering a dataset with ``--max-positions``."""
@@ -227,3 +280,5 @@ class LanguagePairDataset(FairseqDataset):
         if self.tgt is not None:
             self.tgt.prefetch(indices)
         self.srcbert.prefetch(indices)
+        if self.srcbert_features is not None and getattr(self.srcbert_features, 'supports_prefetch', False):
+            self.srcbert_features.prefetch(indices)
@@ -67,6 +67,10 @@ def distributed_init(args):
     if args.distributed_world_size == 1:
         raise ValueError('Cannot initialize distributed with distributed_world_size=1')
 
+    if getattr(args, 'cpu', False) and args.distributed_backend == 'nccl':
+        # NCCL only supports CUDA tensors
+        args.distributed_backend = 'gloo'
+
     if torch.distributed.is_initialized():
         warnings.warn('Distributed is already initialized, cannot initialize twice!')
     else:
@@ -82,7 +86,7 @@ def distributed_init(args):
             socket.gethostname(), args.distributed_rank), flush=True)
 
         # perform a dummy all-reduce to initialize the NCCL communicator
-        dist.all_reduce(torch.rand(1).cuda())
+        dist.all_reduce(torch.rand(1, device=get_device()))
 
         suppress_output(is_master(args))
 
@@ -115,10 +119,33 @@ def get_default_group():
     return dist.group.WORLD
 
 
-def all_reduce(tensor, group=None):
+def get_device(group=None):
+    """The device of the tensors exchanged through *group*: CUDA with NCCL,
+    which only supports CUDA tensors, and the CPU otherwise."""
+    if group is None:
+        group = get_default_group()
+    if dist.get_backend(group) == dist.Backend.NCCL:
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def all_reduce(tensor, group=None, async_op=False):
     if group is None:
         group = get_default_group()
-    return dist.all_reduce(tensor, group=group)
+    return dist.all_reduce(tensor, group=group, async_op=async_op)
+
+
+def all_reduce_sum(values, group=None):
+    """Sum a list of numbers over all workers with a single float64
+    all_reduce. Unlike :func:`all_gather_list`, nothing is pickled.
+
+    Args:
+        values (List[float]): numbers of the local worker
+        group (optional): group of the collective
+    """
+    buffer = torch.tensor(values, dtype=torch.float64, device=get_device(group))
+    all_reduce(buffer, group=group)
+    return buffer.tolist()
 
 
 def all_gather_list(data, group=None, max_size=16384):
@@ -135,12 +162,16 @@ def all_gather_list(data, group=None, max_size=16384):
     """
     rank = get_rank()
     world_size = get_world_size()
+    device = get_device(group)
 
     buffer_size = max_size * world_size
     if not hasattr(all_gather_list, '_buffer') or \
-            all_gather_list._buffer.numel() < buffer_size:
-        all_gather_list._buffer = torch.cuda.ByteTensor(buffer_size)
-        all_gather_list._cpu_buffer = torch.ByteTensor(max_size).pin_memory()
+            all_gather_list._buffer.numel() < buffer_size or \
+            all_gather_list._buffer.device != device:
+        all_gather_list._buffer = torch.zeros(buffer_size, dtype=torch.uint8, device=device)
+        all_gather_list._cpu_buffer = torch.zeros(max_size, dtype=torch.uint8)
+        if device.type == 'cuda':
+            all_gather_list._cpu_buffer = all_gather_list._cpu_buffer.pin_memory()
     buffer = all_gather_list._buffer
     buffer.zero_()
     cpu_buffer = all_gather_list._cpu_buffer
@@ -12,10 +12,12 @@ computation (e.g., AdaptiveSoftmax) and which therefore do not work with the
 c10d version of DDP.
 
 This version also supports the *accumulate_grads* feature, which allows faster
-training with `--update-freq`.
+training with `--update-freq`, and overlaps the all-reduce of gradient buckets
+with the rest of the backward pass.
 """
 
 import copy
+import weakref
 
 import torch
 from torch import nn
@@ -24,6 +26,23 @@ from torch.autograd import Variable
 from . import distributed_utils
 
 
+class _Bucket(object):
+    """Parameters whose gradients are flattened into one buffer and
+    all-reduced together."""
+
+    def __init__(self, params):
+        self.params = params
+        self.numel = sum(p.numel() for p in params)
+        self.buffer = None
+        self.num_ready = 0
+        self.work = None
+        self.reduced = None
+
+    @property
+    def ready(self):
+        return self.num_ready == len(self.params)
+
+
 class LegacyDistributedDataParallel(nn.Module):
     """Implements distributed data parallelism at the module level.
 
@@ -31,26 +50,39 @@ class LegacyDistributedDataParallel(nn.Module):
     This version uses a c10d process group for communication and does not
     broadcast buffers.
 
+    The trainable parameters are grouped into buckets, from the last
+    parameter to the first, since this is roughly the order in which
+    backward produces their gradients. Once all the gradients of a bucket
+    have been accumulated, the bucket is all-reduced asynchronously while
+    backward carries on. Buckets are launched in the same order on all
+    workers, and the parameters which get no gradient are zero-filled when
+    backward has finished. The gradients of each bucket are copied into a
+    buffer of their own, unless the bucket holds a single parameter.
+
+    Parameters with ``requires_grad=False`` when the module is built, e.g. a
+    frozen BERT, are neither bucketed nor reduced; rebuild the module after
+    changing which parameters are trained.
+
     Args:
         module (~torch.nn.Module): module to be parallelized
         world_size (int): number of parallel workers
         process_group (optional): the c10d process group to be used for
             distributed data all-reduction. If None, the default process group
             will be used.
-        buffer_size (int, optional): number of elements to buffer before
-            performing all-reduce (default: 256M).
+        buffer_size (int, optional): number of gradient elements per bucket;
+            bigger parameters get a bucket of their own (default: 256M).
+        overlap_reduction (bool, optional): start all-reducing the buckets
+            during backward, rather than once it has finished (default: True).
     """
 
-    def __init__(self, module, world_size, process_group=None, buffer_size=2**28):
+    def __init__(self, module, world_size, process_group=None, buffer_size=2**28, overlap_reduction=True):
         super().__init__()
 
         self.module = module
         self.world_size = world_size
         self.process_group = process_group
-
-        # Never use a bigger buffer than the number of model params
-        self.buffer_size = min(buffer_size, sum(p.numel() for p in module.parameters()))
-        self.buffer = None
+        self.buffer_size = buffer_size
+        self.overlap_reduction = overlap_reduction
 
         # Flag used by the NCCL backend to make sure we only reduce gradients
         # one time in the execution engine
@@ -68,6 +100,9 @@ class LegacyDistributedDataParallel(nn.Module):
 
     def __getstate__(self):
         attrs = copy.copy(self.__dict__)
+        # autograd nodes can't be pickled, they are rebuilt on unpickling
+        del attrs['_buckets']
+        del attrs['_grad_accs']
         return attrs
 
     def __setstate__(self, state):
@@ -77,96 +112,113 @@ class LegacyDistributedDataParallel(nn.Module):
     def forward(self, *inputs, **kwargs):
         return self.module(*inputs, **kwargs)
 
+    def _build_buckets(self):
+        self._buckets = []
+        params, numel = [], 0
+        for p in reversed([p for p in self.module.parameters() if p.requires_grad]):
+            if len(params) > 0 and (numel + p.numel() > self.buffer_size or p.dtype != params[0].dtype):
+                self._buckets.append(_Bucket(params))
+                params, numel = [], 0
+            params.append(p)
+            numel += p.numel()
+        if len(params) > 0:
+            self._buckets.append(_Bucket(params))
+        self._next_bucket = 0
+
     def _register_grad_hook(self):
         """
-        This function registers the callback all-reduction function for the
-        NCCL backend. All gradients will be all reduced in one single step.
-        The NCCL reduction will directly be enqueued into the default CUDA
-        stream. Therefore, no synchronization is needed.
+        This function registers a hook on the gradient accumulator of every
+        trainable parameter, i.e. it runs once the parameter's gradient for
+        the whole backward pass is in ``p.grad``. The NCCL reductions are
+        enqueued into the default CUDA stream, and the callback queued in the
+        execution engine waits for them at the end of backward.
         """
+        self._build_buckets()
 
-        def all_reduce(params):
-            buffer = self.buffer
-            nonzero_buffer = False
-            if len(params) > 1:
-                offset = 0
-                for p in params:
-                    sz = p.numel()
-                    if p.grad is not None:
-                        buffer[offset:offset+sz].copy_(p.grad.data.view(-1))
-                        nonzero_buffer = True
-                    else:
-                        buffer[offset:offset+sz].zero_()
-                    offset += sz
-            else:
-                # we only have a single grad to all-reduce
-                p = params[0]
-                if p.grad is not None:
-                    buffer = p.grad.data
-                    nonzero_buffer = True
-                elif p.numel() <= self.buffer.numel():
-                    buffer = buffer[:p.numel()]
-                    buffer.zero_()
-                else:
-                    buffer = torch.zeros_like(p)
-
-            if nonzero_buffer:
-                buffer.div_(self.world_size)
-
-            distributed_utils.all_reduce(buffer, self.process_group)
+        # the hooks outlive this module when it is rebuilt, e.g. once more
+        # BERT layers are trained, so they must not keep it alive
+        self_ref = weakref.ref(self)
 
-            # copy all-reduced grads back into their original place
+        def make_hook(bucket):
+            def allreduce_hook(*unused):
+                ddp = self_ref()
+                if ddp is None or ddp.accumulate_grads:
+                    return
+                ddp._mark_ready(bucket)
+            return allreduce_hook
+
+        self._grad_accs = []
+        # autograd is disabled e.g. when the module is first built to validate
+        with torch.enable_grad():
+            for bucket in self._buckets:
+                for p in bucket.params:
+                    grad_acc = p.expand_as(p).grad_fn.next_functions[0][0]
+                    grad_acc.register_hook(make_hook(bucket))
+                    self._grad_accs.append(grad_acc)
+
+    def _mark_ready(self, bucket):
+        if not self.need_reduction:
+            self.need_reduction = True
+            Variable._execution_engine.queue_callback(self._reduction_fn)
+        bucket.num_ready += 1
+        if self.overlap_reduction:
+            self._launch_ready_buckets()
+
+    def _launch_ready_buckets(self, all_buckets=False):
+        # every worker must issue the all-reduces in the same order
+        while self._next_bucket < len(self._buckets):
+            bucket = self._buckets[self._next_bucket]
+            if not (all_buckets or bucket.ready):
+                break
+            self._all_reduce(bucket)
+            self._next_bucket += 1
+
+    def _all_reduce(self, bucket):
+        for p in bucket.params:
+            if p.grad is not None and p.grad.requires_grad:
+                raise RuntimeError("DistributedDataParallel only works "
+                                   "with gradients that don't require "
+                                   "grad")
+        if len(bucket.params) == 1 and bucket.params[0].grad is not None:
+            # we only have a single grad to all-reduce
+            buffer = bucket.params[0].grad.data
+        else:
+            if bucket.buffer is None:
+                bucket.buffer = bucket.params[0].new(bucket.numel)
+            buffer = bucket.buffer
             offset = 0
-            for p in params:
+            for p in bucket.params:
                 sz = p.numel()
                 if p.grad is not None:
-                    p.grad.data.copy_(buffer[offset:offset+sz].view_as(p))
+                    buffer[offset:offset+sz].copy_(p.grad.data.view(-1))
                 else:
-                    p.grad = buffer[offset:offset+sz].view_as(p).clone()
+                    buffer[offset:offset+sz].zero_()
                 offset += sz
+        buffer.div_(self.world_size)
+        bucket.work = distributed_utils.all_reduce(buffer, self.process_group, async_op=True)
+        bucket.reduced = buffer
+
+    def _reduction_fn(self):
+        # This function only needs to be called once
+        if not self.need_reduction:
+            return
+        self.need_reduction = False
 
-        def reduction_fn():
-            # This function only needs to be called once
-            if not self.need_reduction or self.accumulate_grads:
-                return
-            self.need_reduction = False
-
-            if self.buffer is None:
-                self.buffer = next(self.module.parameters()).new(self.buffer_size)
-
-            # All-reduce the gradients in buckets
-            offset = 0
-            buffered_params = []
-            for param in self.module.parameters():
-                if not param.requires_grad:
-                    continue
-                if param.grad is None:
-                    param.grad = torch.zeros_like(param)
-                if param.grad.requires_grad:
-                    raise RuntimeError("DistributedDataParallel only works "
-                                       "with gradients that don't require "
-                                       "grad")
-                sz = param.numel()
-                if sz > self.buffer.numel():
-                    # all-reduce big params directly
-                    all_reduce([param])
-                else:
-                    if offset + sz > self.buffer.numel():
-                        all_reduce(buffered_params)
-                        offset = 0
-                        buffered_params.clear()
-                    buffered_params.append(param)
+        # the parameters that got no gradient are reduced as zeros
+        self._launch_ready_buckets(all_buckets=True)
+        for bucket in self._buckets:
+            bucket.work.wait()
+            if bucket.reduced is bucket.buffer:
+                # copy all-reduced grads back into their original place
+                offset = 0
+                for p in bucket.params:
+                    sz = p.numel()
+                    if p.grad is not None:
+                        p.grad.data.copy_(bucket.buffer[offset:offset+sz].view_as(p))
+                    else:
+                        p.grad = bucket.buffer[offset:offset+sz].view_as(p).clone()
                     offset += sz
-
-            if len(buffered_params) > 0:
-                all_reduce(buffered_params)
-
-        # Now register the reduction hook on the parameters
-        for p in self.module.parameters():
-
-            def allreduce_hook(*unused):
-                self.need_reduction = True
-                Variable._execution_engine.queue_callback(reduction_fn)
-
-            if p.requires_grad:
-                p.register_hook(allreduce_hook)
+            bucket.num_ready = 0
+            bucket.work = None
+            bucket.reduced = None
+        self._next_bucket = 0
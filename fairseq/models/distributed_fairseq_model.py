@@ -7,6 +7,7 @@
 
 import inspect
 
+import torch
 from torch.nn import parallel
 
 from fairseq.legacy_distributed_data_parallel import LegacyDistributedDataParallel
@@ -30,24 +31,36 @@ def DistributedFairseqModel(args, model):
     assert isinstance(model, BaseFairseqModel)
     if args.ddp_backend == 'c10d':
         ddp_class = parallel.DistributedDataParallel
+        # CPU modules are not given any device
+        use_cuda = torch.cuda.is_available() and not getattr(args, 'cpu', False)
         init_kwargs = dict(
             module=model,
-            device_ids=[args.device_id],
-            output_device=args.device_id,
+            device_ids=[args.device_id] if use_cuda else None,
+            output_device=args.device_id if use_cuda else None,
             broadcast_buffers=False,
             bucket_cap_mb=args.bucket_cap_mb,
         )
         # Maintain backward compatibility
-        if 'check_reduction' in inspect.getargspec(ddp_class)[0]:
+        if 'check_reduction' in inspect.getfullargspec(ddp_class)[0]:
             init_kwargs['check_reduction'] = True
-        if 'find_unused_parameters' in inspect.getargspec(ddp_class)[0]:
-            init_kwargs['find_unused_parameters'] = args.find_unused_parameters
+        if 'find_unused_parameters' in inspect.getfullargspec(ddp_class)[0]:
+            # drop-net doesn't run the attention branch it gives no weight,
+            # so each worker may leave different parameters without gradient
+            init_kwargs['find_unused_parameters'] = (
+                args.find_unused_parameters or getattr(args, 'encoder_bert_dropout', False)
+            )
+        elif getattr(args, 'encoder_bert_dropout', False):
+            raise ValueError(
+                '--encoder-bert-dropout requires a DistributedDataParallel with find_unused_parameters, '
+                'use --ddp-backend no_c10d instead'
+            )
     elif args.ddp_backend == 'no_c10d':
         ddp_class = LegacyDistributedDataParallel
         init_kwargs = dict(
             module=model,
             world_size=args.distributed_world_size,
-            buffer_size=2**28,
+            # as many gradient elements as fit in --bucket-cap-mb
+            buffer_size=args.bucket_cap_mb * 2**20 // next(model.parameters()).element_size(),
         )
     else:
         raise ValueError('Unknown --ddp-backend: ' + args.ddp_backend)
@@ -89,3 +89,16 @@ class FairseqIncrementalDecoder(FairseqDecoder):
 
             self.apply(apply_set_beam_size)
             self._beam_size = beam_size
+
+    def set_max_decode_len(self, max_len):
+        """Sets the maximum number of incremental decoding steps in the
+        decoder and all children, e.g. to preallocate their caches."""
+        seen = set()
+
+        def apply_set_max_decode_len(module):
+            if module != self and hasattr(module, 'set_max_decode_len') \
+                    and module not in seen:
+                seen.add(module)
+                module.set_max_decode_len(max_len)
+
+        self.apply(apply_set_max_decode_len)
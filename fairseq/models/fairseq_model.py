@@ -8,6 +8,7 @@
 Base classes for various fairseq models.
 """
 
+import hashlib
 import os
 from typing import Dict, List, Optional
 
@@ -195,6 +196,11 @@ class FairseqEncoderDecoderModel(BaseFairseqModel):
         self.berttokenizer = berttokenizer
         self.mask_cls_sep = mask_cls_sep
         self.bert_output_layer = getattr(args, 'bert_output_layer', -1)
+        self.packed_bert = getattr(args, 'packed_bert', False)
+        # run BERT in a background thread while the encoder runs, if the
+        # encoder doesn't attend to it
+        self.concurrent_bert = getattr(args, 'concurrent_bert', False)
+        self.bert_threads = getattr(args, 'bert_threads', None)
         # outdim = self.encoder.layers[0].embed_dim
         # indim = self.bert_encoder.encoder.hidden_size
         # if not outdim == indim:
@@ -213,7 +219,78 @@ class FairseqEncoderDecoderModel(BaseFairseqModel):
         if self.trans_bias is not None:
             nn.init.constant_(self.trans_bias, 0.)
 
-    def forward(self, src_tokens, src_lengths, prev_output_tokens, bert_input, **kwargs):
+    def bert_fingerprint(self):
+        """
+        Hash of the BERT encoder's weights, used to run BERT only once for
+        the members of an ensemble that share it.
+
+        The hash is computed on first use, i.e. when the first batch is
+        generated after loading, and again only after the weights have been
+        changed in place or moved.
+        """
+        state = self.bert_encoder.state_dict(keep_vars=True)
+        version = tuple((t.data_ptr(), t._version) for t in state.values())
+        if getattr(self, '_bert_fingerprint', (None, None))[0] != version:
+            h = hashlib.sha1()
+            for name, t in state.items():
+                t = t.detach().cpu().contiguous()
+                h.update('{} {} {}'.format(name, t.dtype, tuple(t.size())).encode())
+                h.update(t.numpy().tobytes())
+            self._bert_fingerprint = (version, h.hexdigest())
+        return self._bert_fingerprint[1]
+
+    def bert_modules(self):
+        """The BERT embeddings and the layers up to `bert_output_layer`,
+        bottom up, i.e. the parts of BERT that are trained with
+        --finetune-bert."""
+        num_layers = self.bert_encoder.resolve_output_layer(self.bert_output_layer) + 1
+        return [self.bert_encoder.embeddings] + list(self.bert_encoder.encoder.layer[:num_layers])
+
+    def bert_features(self, bert_input, output_layer=None):
+        """
+        Run BERT and return the `output_layer` (default: `bert_output_layer`)
+        states of shape `(batch, bert_len, hidden_dim)`, i.e. what
+        *bert_features* of :func:`forward_bert` holds when precomputed.
+        """
+        if output_layer is None:
+            output_layer = self.bert_output_layer
+        attention_mask = bert_input.ne(self.berttokenizer.pad()).long()
+        bert_encoder_out, _ = self.bert_encoder(bert_input, attention_mask=attention_mask,
+                                                packed=self.packed_bert, output_layer=output_layer)
+        return bert_encoder_out
+
+    def forward_bert(self, bert_input, bert_features=None, output_layer=None):
+        """
+        Compute the BERT memory attended to by the encoder/decoder.
+
+        Args:
+            bert_input (LongTensor): BERT token ids of shape `(batch, bert_len)`
+            bert_features (Tensor, optional): precomputed `bert_output_layer`
+                states of shape `(batch, bert_len, hidden_dim)`. If given, the
+                BERT forward is skipped.
+            output_layer (int, optional): BERT layer to use instead of
+                `bert_output_layer`
+
+        Returns:
+            dict: with `bert_encoder_out` of shape `(bert_len, batch, hidden_dim)`
+            and `bert_encoder_padding_mask` of shape `(batch, bert_len)`
+        """
+        bert_encoder_padding_mask = bert_input.eq(self.berttokenizer.pad())
+        if bert_features is not None:
+            bert_encoder_out = bert_features.to(next(self.encoder.parameters()).dtype)
+        else:
+            bert_encoder_out = self.bert_features(bert_input, output_layer)
+        if self.mask_cls_sep:
+            bert_encoder_padding_mask += bert_input.eq(self.berttokenizer.cls())
+            bert_encoder_padding_mask += bert_input.eq(self.berttokenizer.sep())
+        bert_encoder_out = bert_encoder_out.permute(1,0,2).contiguous()
+        # bert_encoder_out = F.linear(bert_encoder_out, self.trans_weight, self.trans_bias)
+        return {
+            'bert_encoder_out': bert_encoder_out,
+            'bert_encoder_padding_mask': bert_encoder_padding_mask,
+        }
+
+    def forward(self, src_tokens, src_lengths, prev_output_tokens, bert_input, bert_features=None, **kwargs):
         """
         Run the forward pass for an encoder-decoder model.
 
@@ -230,25 +307,24 @@ class FairseqEncoderDecoderModel(BaseFairseqModel):
             src_lengths (LongTensor): source sentence lengths of shape `(batch)`
             prev_output_tokens (LongTensor): previous decoder outputs of shape
                 `(batch, tgt_len)`, for input feeding/teacher forcing
+            bert_input (LongTensor): BERT token ids of shape `(batch, bert_len)`
+            bert_features (Tensor, optional): precomputed BERT states, see
+                :func:`forward_bert`
 
         Returns:
             tuple:
                 - the decoder's output of shape `(batch, tgt_len, vocab)`
                 - a dictionary with any model-specific outputs
         """
-        encoder_out = self.encoder(src_tokens, src_lengths=src_lengths, **kwargs)
-        bert_encoder_padding_mask = bert_input.eq(self.berttokenizer.pad())
-        bert_encoder_out, _ =  self.bert_encoder(bert_input, output_all_encoded_layers=True, attention_mask= 1. - bert_encoder_padding_mask)
-        bert_encoder_out = bert_encoder_out[self.bert_output_layer]
-        if self.mask_cls_sep:
-            bert_encoder_padding_mask += bert_input.eq(self.berttokenizer.cls())
-            bert_encoder_padding_mask += bert_input.eq(self.berttokenizer.sep())
-        bert_encoder_out = bert_encoder_out.permute(1,0,2).contiguous()
-        # bert_encoder_out = F.linear(bert_encoder_out, self.trans_weight, self.trans_bias)
-        bert_encoder_out = {
-            'bert_encoder_out': bert_encoder_out,
-            'bert_encoder_padding_mask': bert_encoder_padding_mask,
-        }
+        if self.concurrent_bert:
+            bert_encoder_out = utils.fork(
+                self.forward_bert, bert_input, bert_features, num_threads=self.bert_threads,
+            )
+            encoder_out = self.encoder(src_tokens, src_lengths=src_lengths, **kwargs)
+            bert_encoder_out = bert_encoder_out.result()
+        else:
+            encoder_out = self.encoder(src_tokens, src_lengths=src_lengths, **kwargs)
+            bert_encoder_out = self.forward_bert(bert_input, bert_features)
         decoder_out = self.decoder(prev_output_tokens, encoder_out=encoder_out, bert_encoder_out=bert_encoder_out, **kwargs)
         return decoder_out
 
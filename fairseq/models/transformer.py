@@ -30,7 +30,47 @@ from bert import BertTokenizer
 DEFAULT_MAX_SOURCE_POSITIONS = 1024
 DEFAULT_MAX_TARGET_POSITIONS = 1024
 
-from bert import BertModel
+from bert import BertConfig, BertModel
+
+
+def build_bert_encoder(args):
+    """Build the BERT encoder of a bert-fused model.
+
+    The pretrained weights are only loaded for a fresh model. Models restored
+    from a checkpoint carry the BERT config in their args and are built from it
+    directly, since the checkpoint tensors overwrite the BERT weights anyway.
+
+    With ``--truncate-bert`` the layers above ``--bert-output-layer`` and the
+    pooler are dropped, as only that layer is ever attended to.
+    """
+    bert_config = getattr(args, 'bert_config', None)
+    if bert_config is not None:
+        bertencoder = BertModel(BertConfig.from_dict(bert_config))
+    else:
+        bertencoder = BertModel.from_pretrained(args.bert_model_name)
+        args.bert_config = bertencoder.config.to_dict()
+    if getattr(args, 'truncate_bert', False):
+        bertencoder.truncate(getattr(args, 'bert_output_layer', -1))
+    return bertencoder
+
+
+def precompute_static_kv(layers, encoder_out, bert_encoder_out, incremental_state):
+    memories = [
+        ('encoder_attn', encoder_out['encoder_out'] if encoder_out is not None else None),
+        ('bert_attn', bert_encoder_out['bert_encoder_out'] if bert_encoder_out is not None else None),
+    ]
+    for i, (name, memory) in enumerate(memories):
+        attns = [
+            getattr(layer, name, None) for layer in layers
+            # not for the branches the layers skip
+            if not hasattr(layer, 'runs_branch') or layer.runs_branch(i)
+        ]
+        attns = [attn for attn in attns if attn is not None]
+        if memory is None or len(attns) == 0:
+            continue
+        for attn, (k, v) in zip(attns, MultiheadAttention.project_static_kv(attns, memory)):
+            attn._set_input_buffer(incremental_state, {'prev_key': k, 'prev_value': v})
+
 
 @register_model('transformer')
 class TransformerModel(FairseqEncoderDecoderModel):
@@ -157,7 +197,7 @@ class TransformerModel(FairseqEncoderDecoderModel):
             decoder_embed_tokens = build_embedding(
                 tgt_dict, args.decoder_embed_dim, args.decoder_embed_path
             )
-        bertencoder = BertModel.from_pretrained(args.bert_model_name)
+        bertencoder = build_bert_encoder(args)
         args.bert_out_dim = bertencoder.hidden_size
         encoder = cls.build_encoder(args, src_dict, encoder_embed_tokens)
         decoder = cls.build_decoder(args, tgt_dict, decoder_embed_tokens)
@@ -297,7 +337,7 @@ class TransformerS2Model(FairseqEncoderDecoderModel):
             decoder_embed_tokens = build_embedding(
                 tgt_dict, args.decoder_embed_dim, args.decoder_embed_path
             )
-        bertencoder = BertModel.from_pretrained(args.bert_model_name)
+        bertencoder = build_bert_encoder(args)
         args.bert_out_dim = bertencoder.hidden_size
         encoder = cls.build_encoder(args, src_dict, encoder_embed_tokens)
         decoder = cls.build_decoder(args, tgt_dict, decoder_embed_tokens)
@@ -312,7 +352,7 @@ class TransformerS2Model(FairseqEncoderDecoderModel):
     def build_decoder(cls, args, tgt_dict, embed_tokens):
         return TransformerDecoder(args, tgt_dict, embed_tokens)
 
-    def forward(self, src_tokens, src_lengths, prev_output_tokens, bert_input, **kwargs):
+    def forward(self, src_tokens, src_lengths, prev_output_tokens, bert_input, bert_features=None, **kwargs):
         """
         Run the forward pass for an encoder-decoder model.
 
@@ -335,17 +375,7 @@ class TransformerS2Model(FairseqEncoderDecoderModel):
                 - the decoder's output of shape `(batch, tgt_len, vocab)`
                 - a dictionary with any model-specific outputs
         """
-        bert_encoder_padding_mask = bert_input.eq(self.berttokenizer.pad())
-        bert_encoder_out, _ =  self.bert_encoder(bert_input, output_all_encoded_layers=True, attention_mask= 1. - bert_encoder_padding_mask)
-        bert_encoder_out = bert_encoder_out[self.bert_output_layer]
-        if self.mask_cls_sep:
-            bert_encoder_padding_mask += bert_input.eq(self.berttokenizer.cls())
-            bert_encoder_padding_mask += bert_input.eq(self.berttokenizer.sep())
-        bert_encoder_out = bert_encoder_out.permute(1,0,2).contiguous()
-        bert_encoder_out = {
-            'bert_encoder_out': bert_encoder_out,
-            'bert_encoder_padding_mask': bert_encoder_padding_mask,
-        }
+        bert_encoder_out = self.forward_bert(bert_input, bert_features)
         encoder_out = self.encoder(src_tokens, src_lengths=src_lengths, bert_encoder_out=bert_encoder_out)
         decoder_out = self.decoder(prev_output_tokens, encoder_out=encoder_out, bert_encoder_out=bert_encoder_out, **kwargs)
         return decoder_out
@@ -476,7 +506,7 @@ class TransformerModelStack(FairseqEncoderDecoderModel):
             decoder_embed_tokens = build_embedding(
                 tgt_dict, args.decoder_embed_dim, args.decoder_embed_path
             )
-        bertencoder = BertModel.from_pretrained(args.bert_model_name)
+        bertencoder = build_bert_encoder(args)
         args.bert_out_dim = bertencoder.hidden_size
         encoder = cls.build_encoder(args, src_dict, encoder_embed_tokens)
         decoder = cls.build_decoder(args, tgt_dict, decoder_embed_tokens)
@@ -853,7 +883,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
                 - a dictionary with any model-specific outputs
         """
         x, extra = self.extract_features(prev_output_tokens, encoder_out, bert_encoder_out, incremental_state)
-        x = self.output_layer(x)
+        x = self.output_layer(x, incremental_state=incremental_state)
         return x, extra
 
     def extract_features(self, prev_output_tokens, encoder_out=None, bert_encoder_out=None, incremental_state=None, **unused):
@@ -916,9 +946,13 @@ class TransformerDecoder(FairseqIncrementalDecoder):
 
         return x, {'attn': attn, 'inner_states': inner_states}
 
-    def output_layer(self, features, **kwargs):
-        """Project features to the vocabulary size."""
+    def output_layer(self, features, incremental_state=None, **kwargs):
+        """Project features to the vocabulary size, or to the tokens given to
+        :func:`set_output_vocab` for this *incremental_state*."""
         if self.adaptive_softmax is None:
+            output_weight = utils.get_incremental_state(self, incremental_state, 'output_weight')
+            if output_weight is not None:
+                return F.linear(features, output_weight)
             # project back to size of vocabulary
             if self.share_input_output_embed:
                 return F.linear(features, self.embed_tokens.weight)
@@ -927,12 +961,26 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         else:
             return features
 
+    def set_output_vocab(self, vocab, incremental_state):
+        """Only compute the scores of the target tokens *vocab* (a sorted
+        LongTensor), e.g. a shortlist of likely translations, when decoding
+        with *incremental_state*."""
+        assert self.adaptive_softmax is None, 'output vocabulary restriction requires a full softmax'
+        weight = self.embed_tokens.weight if self.share_input_output_embed else self.embed_out
+        utils.set_incremental_state(self, incremental_state, 'output_weight', weight.index_select(0, vocab))
+
     def max_positions(self):
         """Maximum output length supported by the decoder."""
         if self.embed_positions is None:
             return self.max_target_positions
         return min(self.max_target_positions, self.embed_positions.max_positions())
 
+    def precompute_static_kv(self, encoder_out, bert_encoder_out, incremental_state):
+        """Compute the keys/values of all layers' encoder and BERT attention
+        before the first decoding step, with one matmul per memory, and store
+        them in *incremental_state*."""
+        precompute_static_kv(self.layers, encoder_out, bert_encoder_out, incremental_state)
+
     def buffered_future_mask(self, tensor):
         dim = tensor.size(0)
         if not hasattr(self, '_future_mask') or self._future_mask is None or self._future_mask.device != tensor.device:
@@ -1056,7 +1104,7 @@ class TransformerDecoderStack(FairseqIncrementalDecoder):
                 - a dictionary with any model-specific outputs
         """
         x, extra = self.extract_features(prev_output_tokens, encoder_out, bert_encoder_out, incremental_state)
-        x = self.output_layer(x)
+        x = self.output_layer(x, incremental_state=incremental_state)
         return x, extra
 
     def extract_features(self, prev_output_tokens, encoder_out=None, bert_encoder_out=None, incremental_state=None, **unused):
@@ -1119,9 +1167,13 @@ class TransformerDecoderStack(FairseqIncrementalDecoder):
 
         return x, {'attn': attn, 'inner_states': inner_states}
 
-    def output_layer(self, features, **kwargs):
-        """Project features to the vocabulary size."""
+    def output_layer(self, features, incremental_state=None, **kwargs):
+        """Project features to the vocabulary size, or to the tokens given to
+        :func:`set_output_vocab` for this *incremental_state*."""
         if self.adaptive_softmax is None:
+            output_weight = utils.get_incremental_state(self, incremental_state, 'output_weight')
+            if output_weight is not None:
+                return F.linear(features, output_weight)
             # project back to size of vocabulary
             if self.share_input_output_embed:
                 return F.linear(features, self.embed_tokens.weight)
@@ -1130,12 +1182,26 @@ class TransformerDecoderStack(FairseqIncrementalDecoder):
         else:
             return features
 
+    def set_output_vocab(self, vocab, incremental_state):
+        """Only compute the scores of the target tokens *vocab* (a sorted
+        LongTensor), e.g. a shortlist of likely translations, when decoding
+        with *incremental_state*."""
+        assert self.adaptive_softmax is None, 'output vocabulary restriction requires a full softmax'
+        weight = self.embed_tokens.weight if self.share_input_output_embed else self.embed_out
+        utils.set_incremental_state(self, incremental_state, 'output_weight', weight.index_select(0, vocab))
+
     def max_positions(self):
         """Maximum output length supported by the decoder."""
         if self.embed_positions is None:
             return self.max_target_positions
         return min(self.max_target_positions, self.embed_positions.max_positions())
 
+    def precompute_static_kv(self, encoder_out, bert_encoder_out, incremental_state):
+        """Compute the keys/values of all layers' encoder and BERT attention
+        before the first decoding step, with one matmul per memory, and store
+        them in *incremental_state*."""
+        precompute_static_kv(self.layers, encoder_out, bert_encoder_out, incremental_state)
+
     def buffered_future_mask(self, tensor):
         dim = tensor.size(0)
         if not hasattr(self, '_future_mask') or self._future_mask is None or self._future_mask.device != tensor.device:
@@ -1313,6 +1379,7 @@ class TransformerS2EncoderLayer(nn.Module):
         assert self.encoder_bert_dropout_ratio >= 0. and self.encoder_bert_dropout_ratio <= 0.5
         self.encoder_bert_mixup = getattr(args, 'encoder_bert_mixup', False)
 
+        self.bert_gate = bert_gate
         if not bert_gate:
             self.bert_ratio = 0.
             self.encoder_bert_dropout = False
@@ -1349,12 +1416,17 @@ class TransformerS2EncoderLayer(nn.Module):
         """
         residual = x
         x = self.maybe_layer_norm(self.self_attn_layer_norm, x, before=True)
-        x1, _ = self.self_attn(query=x, key=x, value=x, key_padding_mask=encoder_padding_mask)
-        x2, _ = self.bert_attn(query=x, key=bert_encoder_out, value=bert_encoder_out, key_padding_mask=bert_encoder_padding_mask)
-        x1 = F.dropout(x1, p=self.dropout, training=self.training)
-        x2 = F.dropout(x2, p=self.dropout, training=self.training)
+        # decide the drop-net branches first so a zero-weighted attention is not computed at all
         ratios = self.get_ratio()
-        x = residual + ratios[0] * x1 + ratios[1] * x2
+        if ratios[0] != 0:
+            x1, _ = self.self_attn(query=x, key=x, value=x, key_padding_mask=encoder_padding_mask)
+            x1 = F.dropout(x1, p=self.dropout, training=self.training)
+            residual = residual + ratios[0] * x1
+        if ratios[1] != 0:
+            x2, _ = self.bert_attn(query=x, key=bert_encoder_out, value=bert_encoder_out, key_padding_mask=bert_encoder_padding_mask)
+            x2 = F.dropout(x2, p=self.dropout, training=self.training)
+            residual = residual + ratios[1] * x2
+        x = residual
         x = self.maybe_layer_norm(self.self_attn_layer_norm, x, after=True)
 
         residual = x
@@ -1367,6 +1439,12 @@ class TransformerS2EncoderLayer(nn.Module):
         x = self.maybe_layer_norm(self.final_layer_norm, x, after=True)
         return x
 
+    def set_ratios(self, encoder_ratio, bert_ratio):
+        """Change the branch weights used without drop-net, e.g. to try other
+        ones at inference."""
+        self.encoder_ratio = encoder_ratio
+        self.bert_ratio = bert_ratio if self.bert_gate else 0.
+
     def get_ratio(self):
         if self.encoder_bert_dropout:
             frand = float(uniform(0, 1))
@@ -1463,6 +1541,7 @@ class TransformerDecoderLayer(nn.Module):
         assert self.encoder_bert_dropout_ratio >= 0. and self.encoder_bert_dropout_ratio <= 0.5
         self.encoder_bert_mixup = getattr(args, 'encoder_bert_mixup', False)
 
+        self.bert_gate = bert_gate
         if not bert_gate:
             self.bert_ratio = 0.
             self.encoder_bert_dropout = False
@@ -1523,28 +1602,38 @@ class TransformerDecoderLayer(nn.Module):
                 prev_key, prev_value = prev_attn_state
                 saved_state = {"prev_key": prev_key, "prev_value": prev_value}
                 self.encoder_attn._set_input_buffer(incremental_state, saved_state)
-            x1, attn = self.encoder_attn(
-                query=x,
-                key=encoder_out,
-                value=encoder_out,
-                key_padding_mask=encoder_padding_mask,
-                incremental_state=incremental_state,
-                static_kv=True,
-                need_weights=(not self.training and self.need_attn),
-            )
-            x2, _ = self.bert_attn(
-                query=x,
-                key=bert_encoder_out,
-                value=bert_encoder_out,
-                key_padding_mask=bert_encoder_padding_mask,
-                incremental_state=incremental_state,
-                static_kv=True,
-                need_weights=(not self.training and self.need_attn),
-            )
-            x1 = F.dropout(x1, p=self.dropout, training=self.training)
-            x2 = F.dropout(x2, p=self.dropout, training=self.training)
+            # Skip a zero-weighted branch entirely. Its static key/value cache is
+            # then never filled; since the encoder/BERT outputs are still passed
+            # as key/value, a later step that does use the branch projects them
+            # on demand.
             ratios = self.get_ratio()
-            x = residual + ratios[0] * x1 + ratios[1] * x2
+            if ratios[0] != 0:
+                x1, attn = self.encoder_attn(
+                    query=x,
+                    key=encoder_out,
+                    value=encoder_out,
+                    key_padding_mask=encoder_padding_mask,
+                    incremental_state=incremental_state,
+                    static_kv=True,
+                    need_weights=(not self.training and self.need_attn),
+                )
+                x1 = F.dropout(x1, p=self.dropout, training=self.training)
+                residual = residual + ratios[0] * x1
+            else:
+                attn = None
+            if ratios[1] != 0:
+                x2, _ = self.bert_attn(
+                    query=x,
+                    key=bert_encoder_out,
+                    value=bert_encoder_out,
+                    key_padding_mask=bert_encoder_padding_mask,
+                    incremental_state=incremental_state,
+                    static_kv=True,
+                    need_weights=(not self.training and self.need_attn),
+                )
+                x2 = F.dropout(x2, p=self.dropout, training=self.training)
+                residual = residual + ratios[1] * x2
+            x = residual
             x = self.maybe_layer_norm(self.encoder_attn_layer_norm, x, after=True)
 
         residual = x
@@ -1561,6 +1650,17 @@ class TransformerDecoderLayer(nn.Module):
             return x, attn, self_attn_state
         return x, attn
 
+    def set_ratios(self, encoder_ratio, bert_ratio):
+        """Change the branch weights used without drop-net, e.g. to try other
+        ones at inference."""
+        self.encoder_ratio = encoder_ratio
+        self.bert_ratio = bert_ratio if self.bert_gate else 0.
+
+    def runs_branch(self, i):
+        """Whether the encoder (0) or BERT (1) attention runs at inference,
+        where a branch weighted 0 without drop-net is skipped."""
+        return self.encoder_bert_dropout or [self.encoder_ratio, self.bert_ratio][i] != 0
+
     def get_ratio(self):
         if self.encoder_bert_dropout:
             frand = float(uniform(0, 1))
@@ -1654,6 +1754,7 @@ class TransformerStandardDecoderLayer(nn.Module):
         self.onnx_trace = False
         self.encoder_ratio = args.encoder_ratio
         self.bert_ratio = args.bert_ratio
+        self.bert_gate = bert_gate
         if not bert_gate:
             self.bert_ratio = 0.
         self.encoder_bert_dropout = getattr(args, 'encoder_bert_dropout', False)
@@ -1754,6 +1855,12 @@ class TransformerStandardDecoderLayer(nn.Module):
             return x, attn, self_attn_state
         return x, attn
 
+    def set_ratios(self, encoder_ratio, bert_ratio):
+        """Change the branch weights used without drop-net, e.g. to try other
+        ones at inference."""
+        self.encoder_ratio = encoder_ratio
+        self.bert_ratio = bert_ratio if self.bert_gate else 0.
+
     def get_ratio(self):
         if self.encoder_bert_dropout:
             frand = float(uniform(0, 1))
@@ -15,6 +15,7 @@ from .dynamic_convolution import DynamicConv1dTBC
 from .gelu import gelu, gelu_accurate
 from .grad_multiply import GradMultiply
 from .highway import Highway
+from .kv_cache import KVCache
 from .layer_norm import LayerNorm
 from .learned_positional_embedding import LearnedPositionalEmbedding
 from .lightweight_convolution import LightweightConv1dTBC
@@ -41,6 +42,7 @@ __all__ = [
     'gelu_accurate',
     'GradMultiply',
     'Highway',
+    'KVCache',
     'LayerNorm',
     'LearnedPositionalEmbedding',
     'LightweightConv1dTBC',
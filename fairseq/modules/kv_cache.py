@@ -0,0 +1,96 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import torch
+
+
+class KVCache(object):
+    """Keys and values of a self-attention layer during incremental decoding.
+
+    The keys and values are written in place, one step at a time, into buffers
+    of shape `(max_len, bsz, num_heads, head_dim)` that are allocated once for
+    the whole decoding (and doubled if *max_len* turns out to be too small).
+
+    Reordering the batch, e.g. when beam search picks new beams, does not move
+    any keys or values. It only reorders *rows*, the buffer row that holds
+    each step of each hypothesis, and the keys and values are gathered
+    through it when they are read.
+
+    Args:
+        bsz (int): batch size (times the beam size) at the first step
+        num_heads (int): number of attention heads
+        head_dim (int): dimension of each head
+        max_len (int): number of steps to allocate the buffers for
+    """
+
+    def __init__(self, bsz, num_heads, head_dim, max_len, dtype=None, device=None):
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.key = torch.empty(max_len, bsz, num_heads, head_dim, dtype=dtype, device=device)
+        self.value = torch.empty_like(self.key)
+        # rows[i, t] is the buffer row holding step t of hypothesis i
+        self.rows = torch.empty(bsz, max_len, dtype=torch.long, device=device)
+        self.length = 0
+        self.reordered = False
+        self._index = None
+
+    def __len__(self):
+        return self.length
+
+    def append(self, k, v):
+        """Add the keys/values of new steps and return those of all steps.
+
+        Args:
+            k, v (Tensor): of shape `(bsz * num_heads, steps, head_dim)`
+
+        Returns:
+            tuple: keys and values of shape `(bsz * num_heads, length, head_dim)`
+        """
+        bsz, steps = self.rows.size(0), k.size(1)
+        assert k.size(0) == bsz * self.num_heads
+        if self.length + steps > self.key.size(0):
+            self._grow(max(self.length + steps, 2 * self.key.size(0)))
+
+        new = slice(self.length, self.length + steps)
+        self.key[new, :bsz] = k.view(bsz, self.num_heads, steps, self.head_dim).permute(2, 0, 1, 3)
+        self.value[new, :bsz] = v.view(bsz, self.num_heads, steps, self.head_dim).permute(2, 0, 1, 3)
+        self.rows[:, new] = torch.arange(bsz, device=self.rows.device).unsqueeze(1)
+        self.length += steps
+        self._index = None
+        return self._read(self.key), self._read(self.value)
+
+    def reorder(self, new_order):
+        """Select the hypotheses in *new_order*, which may drop some of them."""
+        self.rows = self.rows.index_select(0, new_order)
+        self.reordered = True
+        self._index = None
+
+    def _read(self, buf):
+        bsz, length = self.rows.size(0), self.length
+        if not self.reordered:
+            return buf[:length, :bsz].permute(1, 2, 0, 3).reshape(bsz * self.num_heads, length, self.head_dim)
+        if self._index is None:
+            # flat index of (step, row, head) in the buffer, in (hypothesis, head, step) order
+            steps = torch.arange(length, device=self.rows.device)
+            rows = self.rows[:, :length] + steps * buf.size(1)
+            heads = torch.arange(self.num_heads, device=self.rows.device)
+            self._index = (rows.unsqueeze(1) * self.num_heads + heads.view(1, -1, 1)).view(-1)
+        return buf.view(-1, self.head_dim).index_select(0, self._index).view(
+            bsz * self.num_heads, length, self.head_dim,
+        )
+
+    def _grow(self, max_len):
+        def grow(buf):
+            new_buf = buf.new_empty((max_len,) + buf.size()[1:])
+            new_buf[:self.length] = buf[:self.length]
+            return new_buf
+
+        self.key = grow(self.key)
+        self.value = grow(self.value)
+        rows = self.rows.new_empty(self.rows.size(0), max_len)
+        rows[:, :self.length] = self.rows[:, :self.length]
+        self.rows = rows
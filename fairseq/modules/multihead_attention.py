@@ -11,6 +11,7 @@ from torch.nn import Parameter
 import torch.nn.functional as F
 
 from fairseq import utils
+from fairseq.modules.kv_cache import KVCache
 
 
 class MultiheadAttention(nn.Module):
@@ -66,6 +67,8 @@ class MultiheadAttention(nn.Module):
         self.reset_parameters()
 
         self.onnx_trace = False
+        self.beam_size = None
+        self.max_decode_len = None
 
     def prepare_for_onnx_export_(self):
         self.onnx_trace = True
@@ -95,6 +98,11 @@ class MultiheadAttention(nn.Module):
         `attn_mask` argument. Padding elements can be excluded from
         the key by passing a binary ByteTensor (`key_padding_mask`) with shape:
         batch x src_len, where padding elements are indicated by 1s.
+
+        For encoder-decoder attention the key/value batch may be smaller than
+        the query batch by a factor of the beam size. In that case each
+        source sentence is stored once and shared by the consecutive beams
+        of the query batch.
         """
 
         tgt_len, bsz, embed_dim = query.size()
@@ -129,12 +137,23 @@ class MultiheadAttention(nn.Module):
             q = self.in_proj_q(query)
             k = self.in_proj_k(key)
             v = self.in_proj_v(value)
-        q *= self.scaling
+        # not in-place: q can be a view of the packed projection
+        q = q * self.scaling
+
+        # batch size of the keys/values; smaller than bsz if they are shared
+        # across the beams of each sentence
+        kv_bsz = bsz
+        if self.encoder_decoder_attention:
+            if k is not None:
+                kv_bsz = k.size(1)
+            elif saved_state is not None and 'prev_key' in saved_state:
+                kv_bsz = saved_state['prev_key'].size(0)
+        assert bsz % kv_bsz == 0
 
         if self.bias_k is not None:
             assert self.bias_v is not None
-            k = torch.cat([k, self.bias_k.repeat(1, bsz, 1)])
-            v = torch.cat([v, self.bias_v.repeat(1, bsz, 1)])
+            k = torch.cat([k, self.bias_k.repeat(1, kv_bsz, 1)])
+            v = torch.cat([v, self.bias_v.repeat(1, kv_bsz, 1)])
             if attn_mask is not None:
                 attn_mask = torch.cat([attn_mask, attn_mask.new_zeros(attn_mask.size(0), 1)], dim=1)
             if key_padding_mask is not None:
@@ -143,26 +162,34 @@ class MultiheadAttention(nn.Module):
 
         q = q.contiguous().view(tgt_len, bsz * self.num_heads, self.head_dim).transpose(0, 1)
         if k is not None:
-            k = k.contiguous().view(-1, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+            k = k.contiguous().view(-1, kv_bsz * self.num_heads, self.head_dim).transpose(0, 1)
         if v is not None:
-            v = v.contiguous().view(-1, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+            v = v.contiguous().view(-1, kv_bsz * self.num_heads, self.head_dim).transpose(0, 1)
 
-        if saved_state is not None:
+        if saved_state is not None and self._use_kv_cache(saved_state):
+            if 'kv_cache' not in saved_state:
+                saved_state['kv_cache'] = KVCache(
+                    bsz, self.num_heads, self.head_dim, max(self.max_decode_len or 0, tgt_len),
+                    dtype=k.dtype, device=k.device,
+                )
+                self._set_input_buffer(incremental_state, saved_state)
+            k, v = saved_state['kv_cache'].append(k, v)
+        elif saved_state is not None:
             # saved states are stored with shape (bsz, num_heads, seq_len, head_dim)
             if 'prev_key' in saved_state:
-                prev_key = saved_state['prev_key'].view(bsz * self.num_heads, -1, self.head_dim)
+                prev_key = saved_state['prev_key'].view(kv_bsz * self.num_heads, -1, self.head_dim)
                 if static_kv:
                     k = prev_key
                 else:
                     k = torch.cat((prev_key, k), dim=1)
             if 'prev_value' in saved_state:
-                prev_value = saved_state['prev_value'].view(bsz * self.num_heads, -1, self.head_dim)
+                prev_value = saved_state['prev_value'].view(kv_bsz * self.num_heads, -1, self.head_dim)
                 if static_kv:
                     v = prev_value
                 else:
                     v = torch.cat((prev_value, v), dim=1)
-            saved_state['prev_key'] = k.view(bsz, self.num_heads, -1, self.head_dim)
-            saved_state['prev_value'] = v.view(bsz, self.num_heads, -1, self.head_dim)
+            saved_state['prev_key'] = k.view(kv_bsz, self.num_heads, -1, self.head_dim)
+            saved_state['prev_value'] = v.view(kv_bsz, self.num_heads, -1, self.head_dim)
 
             self._set_input_buffer(incremental_state, saved_state)
 
@@ -174,9 +201,19 @@ class MultiheadAttention(nn.Module):
             key_padding_mask = None
 
         if key_padding_mask is not None:
-            assert key_padding_mask.size(0) == bsz
+            assert key_padding_mask.size(0) == kv_bsz
             assert key_padding_mask.size(1) == src_len
 
+        beam_size = bsz // kv_bsz
+        if beam_size > 1:
+            # fold the beams into the query length, so that all beams of a
+            # sentence attend to its single copy of the keys/values:
+            # (bsz * heads, tgt_len, head_dim) -> (kv_bsz * heads, beam * tgt_len, head_dim)
+            assert attn_mask is None and not self.onnx_trace
+            q = q.view(kv_bsz, beam_size, self.num_heads, tgt_len, self.head_dim).transpose(1, 2)
+            q = q.contiguous().view(kv_bsz * self.num_heads, beam_size * tgt_len, self.head_dim)
+        attn_bsz, attn_len = kv_bsz, beam_size * tgt_len
+
         if self.add_zero_attn:
             src_len += 1
             k = torch.cat([k, k.new_zeros((k.size(0), 1) + k.size()[2:])], dim=1)
@@ -188,7 +225,7 @@ class MultiheadAttention(nn.Module):
                     [key_padding_mask, torch.zeros(key_padding_mask.size(0), 1).type_as(key_padding_mask)], dim=1)
 
         attn_weights = torch.bmm(q, k.transpose(1, 2))
-        assert list(attn_weights.size()) == [bsz * self.num_heads, tgt_len, src_len]
+        assert list(attn_weights.size()) == [attn_bsz * self.num_heads, attn_len, src_len]
 
         if attn_mask is not None:
             attn_mask = attn_mask.unsqueeze(0)
@@ -198,7 +235,7 @@ class MultiheadAttention(nn.Module):
 
         if key_padding_mask is not None:
             # don't attend to padding symbols
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.view(attn_bsz, self.num_heads, attn_len, src_len)
             if self.onnx_trace:
                 attn_weights = torch.where(
                     key_padding_mask.unsqueeze(1).unsqueeze(2),
@@ -210,7 +247,7 @@ class MultiheadAttention(nn.Module):
                     key_padding_mask.unsqueeze(1).unsqueeze(2),
                     float('-inf'),
                 )
-            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.view(attn_bsz * self.num_heads, attn_len, src_len)
 
         attn_weights = utils.softmax(
             attn_weights, dim=-1, onnx_trace=self.onnx_trace,
@@ -218,8 +255,11 @@ class MultiheadAttention(nn.Module):
         attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
 
         attn = torch.bmm(attn_weights, v)
-        assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
-        if (self.onnx_trace and attn.size(1) == 1):
+        assert list(attn.size()) == [attn_bsz * self.num_heads, attn_len, self.head_dim]
+        if beam_size > 1:
+            attn = attn.view(kv_bsz, self.num_heads, beam_size, tgt_len, self.head_dim)
+            attn = attn.permute(3, 0, 2, 1, 4).contiguous().view(tgt_len, bsz, embed_dim)
+        elif (self.onnx_trace and attn.size(1) == 1):
             # when ONNX tracing a single decoder step (sequence length == 1)
             # the transpose is a no-op copy before view, thus unnecessary
             attn = attn.contiguous().view(tgt_len, bsz, embed_dim)
@@ -229,13 +269,54 @@ class MultiheadAttention(nn.Module):
 
         if need_weights:
             # average attention weights over heads
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.view(attn_bsz, self.num_heads, attn_len, src_len)
             attn_weights = attn_weights.sum(dim=1) / self.num_heads
+            attn_weights = attn_weights.view(bsz, tgt_len, src_len)
         else:
             attn_weights = None
 
         return attn, attn_weights
 
+    def in_proj_kv_weight(self):
+        """Weight and bias that project the memory of encoder-decoder
+        attention to its keys and values, concatenated along the output
+        dimension."""
+        assert self.kdim == self.vdim
+        if self.qkv_same_dim:
+            weight = self.in_proj_weight[self.embed_dim:]
+        else:
+            weight = torch.cat([self.k_proj_weight, self.v_proj_weight])
+        bias = self.in_proj_bias
+        if bias is not None:
+            bias = bias[self.embed_dim:]
+        return weight, bias
+
+    @staticmethod
+    def project_static_kv(attns, memory):
+        """Compute the static keys and values of several encoder-decoder
+        attentions over the same *memory* with a single matmul.
+
+        Args:
+            attns (List[MultiheadAttention]): attentions with the same
+                dimensions
+            memory (Tensor): the keys (= values) of shape
+                `(src_len, bsz, kdim)`
+
+        Returns:
+            List[Tuple[Tensor, Tensor]]: the keys and values of each
+            attention, of shape `(bsz, num_heads, src_len, head_dim)` like
+            their `prev_key`/`prev_value` buffers. All of them are views of
+            one contiguous tensor.
+        """
+        num_heads, head_dim = attns[0].num_heads, attns[0].head_dim
+        weights, biases = zip(*[attn.in_proj_kv_weight() for attn in attns])
+        bias = torch.cat(biases) if biases[0] is not None else None
+        kv = F.linear(memory, torch.cat(weights), bias)
+        src_len, bsz = memory.size(0), memory.size(1)
+        # (src_len, bsz, attns * 2 * heads * head_dim) -> (attns, 2, bsz, heads, src_len, head_dim)
+        kv = kv.view(src_len, bsz, len(attns), 2, num_heads, head_dim).permute(2, 3, 1, 4, 0, 5).contiguous()
+        return [(kv[i, 0], kv[i, 1]) for i in range(len(attns))]
+
     def in_proj_qkv(self, query):
         return self._in_proj(query).chunk(3, dim=-1)
 
@@ -276,14 +357,43 @@ class MultiheadAttention(nn.Module):
             bias = bias[start:end]
         return F.linear(input, weight, bias)
 
+    def _use_kv_cache(self, saved_state):
+        # keys/values given as prev_key/prev_value (ONNX export) keep the
+        # concatenated layout, as do the learned bias_k/bias_v
+        return (
+            self.self_attention and not self.onnx_trace and self.bias_k is None
+            and 'prev_key' not in saved_state
+        )
+
     def reorder_incremental_state(self, incremental_state, new_order):
         """Reorder buffered internal state (for incremental generation)."""
         input_buffer = self._get_input_buffer(incremental_state)
         if input_buffer is not None:
             for k in input_buffer.keys():
+                if k == 'kv_cache':
+                    input_buffer[k].reorder(new_order)
+                    continue
+                if self.encoder_decoder_attention and self.beam_size is not None:
+                    # static keys/values are shared across beams and beams
+                    # only move within their sentence, so this only needs to
+                    # drop the sentences that have finished
+                    if input_buffer[k].size(0) * self.beam_size != new_order.size(0):
+                        sent_order = new_order.view(-1, self.beam_size)[:, 0] // self.beam_size
+                        input_buffer[k] = input_buffer[k].index_select(0, sent_order)
+                    continue
                 input_buffer[k] = input_buffer[k].index_select(0, new_order)
             self._set_input_buffer(incremental_state, input_buffer)
 
+    def set_beam_size(self, beam_size):
+        """Set the number of consecutive beams that share each sentence's
+        static (encoder-decoder) keys/values during incremental decoding."""
+        self.beam_size = beam_size
+
+    def set_max_decode_len(self, max_len):
+        """Set the number of steps to preallocate the self-attention
+        key/value cache for during incremental decoding."""
+        self.max_decode_len = max_len
+
     def _get_input_buffer(self, incremental_state):
         return utils.get_incremental_state(
             self,
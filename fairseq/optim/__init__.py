@@ -28,7 +28,12 @@ _build_optimizer, register_optimizer, OPTIMIZER_REGISTRY = registry.setup_regist
 
 
 def build_optimizer(args, params, *extra_args, **extra_kwargs):
-    params = list(filter(lambda p: p.requires_grad, params))
+    """Build the --optimizer for *params*, an iterable of parameters or of
+    parameter group dicts. Parameter groups may have an ``lr_scale``, see
+    :func:`FairseqOptimizer.set_lr`."""
+    params = list(params)
+    if len(params) == 0 or not isinstance(params[0], dict):
+        params = list(filter(lambda p: p.requires_grad, params))
     return _build_optimizer(args, params, *extra_args, **extra_kwargs)
 
 
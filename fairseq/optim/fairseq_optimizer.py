@@ -15,7 +15,10 @@ class FairseqOptimizer(object):
     def __init__(self, args, params):
         super().__init__()
         self.args = args
-        self.params = list(params)
+        params = list(params)
+        if len(params) > 0 and isinstance(params[0], dict):
+            params = [p for group in params for p in group['params']]
+        self.params = params
 
     @staticmethod
     def add_args(parser):
@@ -43,12 +46,14 @@ class FairseqOptimizer(object):
 
     def get_lr(self):
         """Return the current learning rate."""
-        return self.optimizer.param_groups[0]['lr']
+        param_group = self.optimizer.param_groups[0]
+        return param_group['lr'] / param_group.get('lr_scale', 1.)
 
     def set_lr(self, lr):
-        """Set the learning rate."""
+        """Set the learning rate, times the ``lr_scale`` of each parameter
+        group that has one."""
         for param_group in self.optimizer.param_groups:
-            param_group['lr'] = lr
+            param_group['lr'] = lr * param_group.get('lr_scale', 1.)
 
     def state_dict(self):
         """Return the optimizer's state dict."""
@@ -62,7 +67,12 @@ class FairseqOptimizer(object):
         allows us to resume training from a checkpoint using a new set of
         optimizer args.
         """
+        # the learning rate scales come from the current args
+        lr_scales = [group.get('lr_scale', None) for group in self.optimizer.param_groups]
         self.optimizer.load_state_dict(state_dict)
+        for group, lr_scale in zip(self.optimizer.param_groups, lr_scales):
+            if lr_scale is not None:
+                group['lr_scale'] = lr_scale
 
         if optimizer_overrides is not None and len(optimizer_overrides) > 0:
             # override learning rate, momentum, etc. with latest values
@@ -63,6 +63,11 @@ class FP16Optimizer(optim.FairseqOptimizer):
         super().__init__(args, params)
         self.fp32_optimizer = fp32_optimizer
         self.fp32_params = fp32_params
+        # the FP16 parameters of each FP32 parameter group, see build_optimizer
+        if len(params) > 0 and isinstance(params[0], dict):
+            self.param_groups = [group['params'] for group in params]
+        else:
+            self.param_groups = [self.params]
 
         if getattr(args, 'fp16_scale_window', None) is None:
             if len(args.update_freq) > 1:
@@ -86,20 +91,39 @@ class FP16Optimizer(optim.FairseqOptimizer):
         """
         Args:
             args (argparse.Namespace): fairseq args
-            params (iterable): iterable of parameters to optimize
+            params (iterable): iterable of parameters to optimize, or of
+                parameter group dicts
         """
+        params = list(params)
+        if len(params) > 0 and isinstance(params[0], dict):
+            groups, flat_params = params, [p for group in params for p in group['params']]
+        else:
+            groups, flat_params = None, params
+
         # create FP32 copy of parameters and grads
-        total_param_size = sum(p.data.numel() for p in params)
-        fp32_params = params[0].new(0).float().new(total_param_size)
+        total_param_size = sum(p.data.numel() for p in flat_params)
+        fp32_params = flat_params[0].new(0).float().new(total_param_size)
         offset = 0
-        for p in params:
+        for p in flat_params:
             numel = p.data.numel()
             fp32_params[offset:offset+numel].copy_(p.data.view(-1))
             offset += numel
         fp32_params = torch.nn.Parameter(fp32_params)
         fp32_params.grad = fp32_params.data.new(total_param_size)
 
-        fp32_optimizer = optim.build_optimizer(args, [fp32_params])
+        if groups is None:
+            fp32_optimizer = optim.build_optimizer(args, [fp32_params])
+        else:
+            # each group is optimized as a slice of the flat FP32 copy
+            fp32_groups = []
+            offset = 0
+            for group in groups:
+                numel = sum(p.data.numel() for p in group['params'])
+                group_params = torch.nn.Parameter(fp32_params.data[offset:offset+numel])
+                group_params.grad = fp32_params.grad.data[offset:offset+numel]
+                fp32_groups.append(dict(group, params=[group_params]))
+                offset += numel
+            fp32_optimizer = optim.build_optimizer(args, fp32_groups)
         return cls(args, params, fp32_optimizer, fp32_params)
 
     @property
@@ -150,8 +174,6 @@ class FP16Optimizer(optim.FairseqOptimizer):
             # copy FP16 grads to FP32
             offset = 0
             for p in self.params:
-                if not p.requires_grad:
-                    continue
                 grad_data = p.grad.data if p.grad is not None else p.data.new_zeros(p.data.shape)
                 numel = grad_data.numel()
                 self.fp32_params.grad.data[offset:offset+numel].copy_(grad_data.view(-1))
@@ -192,15 +214,28 @@ class FP16Optimizer(optim.FairseqOptimizer):
     def step(self, closure=None):
         """Performs a single optimization step."""
         self._sync_fp16_grads_to_fp32()
+
+        # groups of frozen parameters (e.g. BERT layers that are not unfrozen
+        # yet) are skipped, just like parameters without gradients
+        frozen = [
+            group['params'][0] for group, params in zip(self.fp32_optimizer.optimizer.param_groups, self.param_groups)
+            if not any(p.requires_grad for p in params)
+        ]
+        grads = [p.grad for p in frozen]
+        for p in frozen:
+            p.grad = None
         self.fp32_optimizer.step(closure)
+        for p, grad in zip(frozen, grads):
+            p.grad = grad
 
         # copy FP32 params back into FP16 model
         offset = 0
         for p in self.params:
-            if not p.requires_grad:
-                continue
             numel = p.data.numel()
-            p.data.copy_(self.fp32_params.data[offset:offset+numel].view_as(p.data))
+            if p.requires_grad:
+                p.data.copy_(self.fp32_params.data[offset:offset+numel].view_as(p.data))
+            else:
+                self.fp32_params.data[offset:offset+numel].copy_(p.data.view(-1))
             offset += numel
 
     def zero_grad(self):
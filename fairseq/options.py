@@ -234,8 +234,18 @@ def add_dataset_args(parser, train=False, gen=False):
                        help='maximum number of tokens in a batch')
     group.add_argument('--max-sentences', '--batch-size', type=int, metavar='N',
                        help='maximum number of sentences in a batch')
+    group.add_argument('--max-bert-tokens', type=int, metavar='N',
+                       help='maximum number of BERT input tokens in a batch; if set, '
+                            '--max-tokens only counts the NMT source and target tokens')
+    group.add_argument('--quadratic-cost-weight', default=0., type=float, metavar='W',
+                       help='count a sentence of length n as n + W * n^2 tokens against '
+                            '--max-tokens and --max-bert-tokens, to account for the '
+                            'quadratic cost of self-attention (about 1 / (6 * hidden size))')
     group.add_argument('--required-batch-size-multiple', default=8, type=int, metavar='N',
                        help='batch size will be a multiplier of this value')
+    group.add_argument('--batch-cache-dir', metavar='DIR', default=None,
+                       help='cache the training batches in this directory, keyed by '
+                            'a fingerprint of the dataset sizes and batching options')
     parser.add_argument('--dataset-impl', metavar="FORMAT", help='output dataset implementation',
                         choices=['raw', 'lazy', 'cached', 'mmap'], default='cached')
     if train:
@@ -270,11 +280,12 @@ def add_distributed_training_args(parser):
     # fmt: off
     group.add_argument('--distributed-world-size', type=int, metavar='N',
                        default=max(1, torch.cuda.device_count()),
-                       help='total number of GPUs across all nodes (default: all visible GPUs)')
+                       help='total number of GPUs across all nodes (default: all visible GPUs), '
+                            'or of CPU worker processes with --cpu')
     group.add_argument('--distributed-rank', default=0, type=int,
                        help='rank of the current worker')
     group.add_argument('--distributed-backend', default='nccl', type=str,
-                       help='distributed backend')
+                       help='distributed backend (gloo with --cpu)')
     group.add_argument('--distributed-init-method', default=None, type=str,
                        help='typically tcp://hostname:port that will be used to '
                             'establish initial connetion')
@@ -288,7 +299,7 @@ def add_distributed_training_args(parser):
                        choices=['c10d', 'no_c10d'],
                        help='DistributedDataParallel backend')
     group.add_argument('--bucket-cap-mb', default=25, type=int, metavar='MB',
-                       help='bucket size for reduction')
+                       help='bucket size for reduction (also used by the no_c10d ddp-backend)')
     group.add_argument('--fix-batches-to-gpus', action='store_true',
                        help='don\'t shuffle batches between GPUs; this reduces overall '
                             'randomness and may affect precision but avoids the cost of '
@@ -354,6 +365,10 @@ def add_checkpoint_args(parser):
                        help='don\'t save models or checkpoints')
     group.add_argument('--no-epoch-checkpoints', action='store_true',
                        help='only store last and best checkpoints')
+    group.add_argument('--dedup-frozen-params', action='store_true',
+                       help='store parameters that are not trained (e.g. a frozen BERT) once '
+                            'in a content-hashed file next to the checkpoints, which only '
+                            'reference it')
     # fmt: on
     return group
 
@@ -444,6 +459,25 @@ def add_generation_args(parser):
     group.add_argument('--print-alignment', action='store_true',
                        help='if set, uses attention feedback to compute and print alignment to source tokens')
     group.add_argument('--change-ratio', action='store_true')
+    group.add_argument('--sweep-beam', type=int, nargs='+', metavar='N',
+                       help='decode with each of these beam sizes, reusing the encoder and BERT outputs')
+    group.add_argument('--sweep-lenpen', type=float, nargs='+', metavar='LP',
+                       help='decode with each of these length penalties, reusing the encoder and BERT outputs')
+    group.add_argument('--sweep-ratio', type=str, nargs='+', metavar='ENC,BERT',
+                       help='decode with each of these encoder_ratio,bert_ratio pairs, reusing the BERT outputs')
+    group.add_argument('--sweep-output-dir', default='.', metavar='DIR',
+                       help='where to write the hypotheses of each --sweep-* configuration')
+    group.add_argument('--bert-cache-dir', metavar='DIR',
+                       help='cache the BERT states of the generated sentences in this directory '
+                            'and reuse them in later runs with the same BERT weights')
+    group.add_argument('--bert-cache-size', default=10., type=float, metavar='GB',
+                       help='maximum size of the --bert-cache-dir cache, beyond which the '
+                            'least recently used states are evicted')
+    group.add_argument('--shortlist', metavar='FILE',
+                       help='only score the target tokens of this shortlist for the sentences of each batch '
+                            '(see scripts/build_shortlist.py)')
+    group.add_argument('--shortlist-size', type=int, metavar='N',
+                       help='number of --shortlist candidates per source token to use (default: all)')
     # fmt: on
     return group
 
@@ -455,6 +489,8 @@ def add_interactive_args(parser):
                        help='read this many sentences into a buffer before processing them')
     group.add_argument('--input', default='-', type=str, metavar='FILE',
                        help='file to read from; use - for stdin')
+    group.add_argument('--input-cache-size', default=10000, type=int, metavar='N',
+                       help='number of recently seen input lines whose encodings are cached')
     # fmt: on
 
 
@@ -86,6 +86,10 @@ class SequenceGenerator(object):
         self.match_source_len = match_source_len
         self.no_repeat_ngram_size = no_repeat_ngram_size
         self.bert_output_layer = args.bert_output_layer
+        # optional BertOutputCache, see --bert-cache-dir
+        self.bert_cache = None
+        # optional Shortlist of the target tokens to score, see --shortlist
+        self.shortlist = None
 
         assert sampling_topk < 0 or sampling, '--sampling-topk requires --sampling'
         assert temperature > 0, '--temperature must be greater than 0'
@@ -101,6 +105,46 @@ class SequenceGenerator(object):
         else:
             self.search = search.BeamSearch(tgt_dict)
 
+    @torch.no_grad()
+    def forward_memories(self, models, sample, bert_outs=None):
+        """Compute the encoder and BERT outputs that :func:`generate` attends to.
+
+        Args:
+            models (List[~fairseq.models.FairseqModel]): ensemble of models
+            sample (dict): batch
+            bert_outs (List[dict], optional): BERT outputs of a previous call
+                to reuse, e.g. when only the encoder depends on a setting
+
+        Returns:
+            tuple: the encoder outputs and BERT outputs of each model
+        """
+        model = EnsembleModel(models)
+        if not self.retain_dropout:
+            model.eval()
+
+        # model.forward normally channels prev_output_tokens into the decoder
+        # separately, but SequenceGenerator directly calls model.encoder
+        encoder_input = {
+            k: v for k, v in sample['net_input'].items()
+            if k != 'prev_output_tokens' and k != 'bert_input' and k != 'bert_features'
+        }
+        bert_args = (
+            sample['net_input']['bert_input'],
+            # precomputed BERT states, see MMapBertFeatureDataset
+            sample['net_input'].get('bert_features', None),
+            self.bert_output_layer,
+            self.bert_cache,
+        )
+        if bert_outs is None and model.concurrent_bert():
+            # the encoders don't need the BERT outputs, so they run meanwhile
+            bert_outs = utils.fork(model.forward_bert, *bert_args, num_threads=models[0].bert_threads)
+            encoder_outs = model.forward_encoder(encoder_input, [None] * len(models))
+            return encoder_outs, bert_outs.result()
+        if bert_outs is None:
+            bert_outs = model.forward_bert(*bert_args)
+        encoder_outs = model.forward_encoder(encoder_input, bert_outs)
+        return encoder_outs, bert_outs
+
     @torch.no_grad()
     def generate(
         self,
@@ -108,6 +152,7 @@ class SequenceGenerator(object):
         sample,
         prefix_tokens=None,
         bos_token=None,
+        memories=None,
         **kwargs
     ):
         """Generate a batch of translations.
@@ -117,19 +162,23 @@ class SequenceGenerator(object):
             sample (dict): batch
             prefix_tokens (torch.LongTensor, optional): force decoder to begin
                 with these tokens
+            memories (tuple, optional): encoder and BERT outputs from
+                :func:`forward_memories`, which are left unchanged and can be
+                reused across calls, e.g. with different decoding settings
         """
         model = EnsembleModel(models)
+        try:
+            return self._generate(model, models, sample, prefix_tokens, bos_token, memories)
+        finally:
+            # the beam size is set on the decoders, which e.g. SequenceScorer
+            # may run next on outputs it expands over the beams itself
+            model.set_beam_size(None)
+
+    def _generate(self, model, models, sample, prefix_tokens=None, bos_token=None, memories=None):
         if not self.retain_dropout:
             model.eval()
 
-        # model.forward normally channels prev_output_tokens into the decoder
-        # separately, but SequenceGenerator directly calls model.encoder
-        encoder_input = {
-            k: v for k, v in sample['net_input'].items()
-            if k != 'prev_output_tokens' and k != 'bert_input'
-        }
-
-        src_tokens = encoder_input['src_tokens']
+        src_tokens = sample['net_input']['src_tokens']
         src_lengths = (src_tokens.ne(self.eos) & src_tokens.ne(self.pad)).long().sum(dim=1)
         input_size = src_tokens.size()
         # batch dimension goes first followed by source lengths
@@ -147,25 +196,29 @@ class SequenceGenerator(object):
             )
 
         # compute the encoder output for each beam
-        bertinput = sample['net_input']['bert_input']
-        bert_encoder_padding_mask = bertinput.eq(model.models[0].berttokenizer.pad())
-        bert_outs, _ = model.models[0].bert_encoder(bertinput, output_all_encoded_layers=True, attention_mask= 1. - bert_encoder_padding_mask)
-        bert_outs = bert_outs[self.bert_output_layer]
-        if model.models[0].mask_cls_sep:
-            bert_encoder_padding_mask += bertinput.eq(model.models[0].berttokenizer.cls())
-            bert_encoder_padding_mask += bertinput.eq(model.models[0].berttokenizer.sep())
-        bert_outs = bert_outs.permute(1,0,2).contiguous()
-        # bert_outs = F.linear(bert_outs, model.models[0].trans_weight, model.models[0].trans_bias)
-        bert_outs = [{
-            'bert_encoder_out': bert_outs,
-            'bert_encoder_padding_mask': bert_encoder_padding_mask,
-        }]
-        if model.models[0].__class__.__name__ == 'TransformerS2Model':
-            encoder_input['bert_encoder_out'] = bert_outs[0]
-        encoder_outs = model.forward_encoder(encoder_input)
-        new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
-        new_order = new_order.to(src_tokens.device).long()
-        encoder_outs, bert_outs = model.reorder_encoder_out(encoder_outs, bert_outs, new_order)
+        if memories is None:
+            encoder_outs, bert_outs = self.forward_memories(models, sample)
+        else:
+            # the outputs are reordered in place below
+            encoder_outs, bert_outs = model.copy_memories(*memories)
+        # encoder and BERT outputs are kept once per sentence; the decoder's
+        # encoder/BERT attention broadcasts them over the beams, so only the
+        # decoder self-attention state follows the beam reordering
+        model.set_beam_size(beam_size)
+        # the decoder is run for at most max_len + 1 steps
+        model.set_max_decode_len(max_len + 1)
+        model.precompute_static_kv(encoder_outs, bert_outs)
+        if self.shortlist is not None:
+            vocab = self.shortlist.vocab(src_tokens)
+            if prefix_tokens is not None:
+                vocab = torch.cat([vocab, prefix_tokens.view(-1)]).unique()
+            model.set_output_vocab(vocab)
+
+        if (
+            beam_size == 1 and type(self.search) is search.BeamSearch
+            and self.stop_early and prefix_tokens is None
+        ):
+            return self._generate_greedy(model, src_tokens, encoder_outs, bert_outs, bos_token, max_len)
 
         # initialize buffers
         scores = src_tokens.new(bsz * beam_size, max_len + 1).float().fill_(0)
@@ -322,8 +375,9 @@ class SequenceGenerator(object):
                     # update beam indices to take into account removed sentences
                     corr = batch_idxs - torch.arange(batch_idxs.numel()).type_as(batch_idxs)
                     reorder_state.view(-1, beam_size).add_(corr.unsqueeze(-1) * beam_size)
+                    # drop finished sentences from the shared encoder/BERT outputs
+                    encoder_outs, bert_outs = model.reorder_encoder_out(encoder_outs, bert_outs, batch_idxs)
                 model.reorder_incremental_state(reorder_state)
-                encoder_outs, bert_outs = model.reorder_encoder_out(encoder_outs, bert_outs, reorder_state)
 
             lprobs, avg_attn_scores = model.forward_decoder(
                 tokens[:, :step + 1], encoder_outs, bert_outs, temperature=self.temperature,
@@ -332,15 +386,6 @@ class SequenceGenerator(object):
             lprobs[:, self.pad] = -math.inf  # never select pad
             lprobs[:, self.unk] -= self.unk_penalty  # apply unk penalty
 
-            if self.no_repeat_ngram_size > 0:
-                # for each beam and batch sentence, generate a list of previous ngrams
-                gen_ngrams = [{} for bbsz_idx in range(bsz * beam_size)]
-                for bbsz_idx in range(bsz * beam_size):
-                    gen_tokens = tokens[bbsz_idx].tolist()
-                    for ngram in zip(*[gen_tokens[i:] for i in range(self.no_repeat_ngram_size)]):
-                        gen_ngrams[bbsz_idx][tuple(ngram[:-1])] = \
-                                gen_ngrams[bbsz_idx].get(tuple(ngram[:-1]), []) + [ngram[-1]]
-
             # Record attention scores
             if avg_attn_scores is not None:
                 if attn is None:
@@ -357,19 +402,7 @@ class SequenceGenerator(object):
                 self.search.set_src_lengths(src_lengths)
 
                 if self.no_repeat_ngram_size > 0:
-                    def calculate_banned_tokens(bbsz_idx):
-                        # before decoding the next token, prevent decoding of ngrams that have already appeared
-                        ngram_index = tuple(tokens[bbsz_idx, step + 2 - self.no_repeat_ngram_size:step + 1].tolist())
-                        return gen_ngrams[bbsz_idx].get(ngram_index, [])
-
-                    if step + 2 - self.no_repeat_ngram_size >= 0:
-                        # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-                        banned_tokens = [calculate_banned_tokens(bbsz_idx) for bbsz_idx in range(bsz * beam_size)]
-                    else:
-                        banned_tokens = [[] for bbsz_idx in range(bsz * beam_size)]
-
-                    for bbsz_idx in range(bsz * beam_size):
-                        lprobs[bbsz_idx, banned_tokens[bbsz_idx]] = -math.inf
+                    self._ban_repeated_ngrams(tokens, lprobs, step)
 
                 if prefix_tokens is not None and step < prefix_tokens.size(1):
                     assert isinstance(self.search, search.BeamSearch), \
@@ -560,6 +593,131 @@ class SequenceGenerator(object):
 
         return finalized
 
+    def _generate_greedy(self, model, src_tokens, encoder_outs, bert_outs, bos_token, max_len):
+        """Beam search with a beam size of 1, without the beam bookkeeping.
+
+        Each step takes the best continuation of each sentence, or the second
+        best if the best is EOS before *min_len*. Sentences are only removed
+        from the batch once they end, so the decoder state is never reordered
+        otherwise. The hypotheses and scores are those of :func:`generate`
+        with ``beam_size=1``.
+        """
+        bsz = src_tokens.size(0)
+        tokens = src_tokens.new_full((bsz, max_len + 2), self.pad)
+        tokens[:, 0] = bos_token or self.eos
+        scores = None
+        attn, nonpad_idxs = None, None
+        # original index of each sentence still being decoded
+        sent_idxs = torch.arange(bsz, device=src_tokens.device)
+        finalized = [[] for i in range(bsz)]
+
+        def finalize(step, rows, eos_scores):
+            """Finalize the hypotheses of *rows*, which end at *step*."""
+            hypo_tokens = tokens[rows, 1:step + 2]
+            hypo_tokens[:, step] = self.eos
+            pos_scores = scores[rows, :step + 1]
+            pos_scores[:, step] = eos_scores
+            # convert from cumulative to per-position scores
+            pos_scores[:, 1:] = pos_scores[:, 1:] - pos_scores[:, :-1]
+            if self.normalize_scores:
+                eos_scores /= (step + 1) ** self.len_penalty
+            hypo_attn = attn[rows, :, 1:step + 2] if attn is not None else None
+            for i, (sent, score) in enumerate(zip(sent_idxs[rows].tolist(), eos_scores.tolist())):
+                hypo = {
+                    'tokens': hypo_tokens[i],
+                    'score': score,
+                    'attention': None,
+                    'alignment': None,
+                    'positional_scores': pos_scores[i],
+                }
+                if hypo_attn is not None:
+                    # remove padding tokens from attn scores
+                    hypo['attention'] = hypo_attn[i][nonpad_idxs[sent]]
+                    _, hypo['alignment'] = hypo['attention'].max(dim=0)
+                finalized[sent].append(hypo)
+
+        for step in range(max_len + 1):  # one extra step for EOS marker
+            lprobs, avg_attn_scores = model.forward_decoder(
+                tokens[:, :step + 1], encoder_outs, bert_outs, temperature=self.temperature,
+            )
+            lprobs[:, self.pad] = -math.inf  # never select pad
+            lprobs[:, self.unk] -= self.unk_penalty  # apply unk penalty
+
+            if scores is None:
+                scores = lprobs.new_zeros(bsz, max_len + 1)
+            if avg_attn_scores is not None:
+                if attn is None:
+                    attn = scores.new(bsz, src_tokens.size(1), max_len + 2)
+                    nonpad_idxs = src_tokens.ne(self.pad)
+                attn[:, :, step + 1].copy_(avg_attn_scores)
+
+            if step == max_len:
+                # finalize all remaining hypotheses with EOS
+                eos_scores = lprobs[:, self.eos] + scores[:, step - 1]
+                finalize(step, torch.arange(tokens.size(0), device=tokens.device), eos_scores)
+                break
+
+            if self.no_repeat_ngram_size > 0:
+                self._ban_repeated_ngrams(tokens, lprobs, step)
+            if step > 0:
+                # make probs contain cumulative scores for each hypothesis
+                lprobs.add_(scores[:, step - 1].unsqueeze(-1))
+            cand_scores, cand_indices = lprobs.topk(min(2, lprobs.size(1) - 1), dim=1)
+
+            # continue with the second best token where the best is EOS
+            eos_mask = cand_indices[:, 0].eq(self.eos)
+            if step >= self.min_len and eos_mask.any():
+                ended = eos_mask.nonzero().squeeze(-1)
+                finalize(step, ended, cand_scores[ended, 0])
+                if ended.numel() == tokens.size(0):
+                    break
+
+                # drop the finished sentences
+                keep = (~eos_mask).nonzero().squeeze(-1)
+                encoder_outs, bert_outs = model.reorder_encoder_out(encoder_outs, bert_outs, keep)
+                model.reorder_incremental_state(keep)
+                sent_idxs, tokens, scores = sent_idxs[keep], tokens[keep], scores[keep]
+                cand_scores, cand_indices = cand_scores[keep], cand_indices[keep]
+                eos_mask = eos_mask[keep]
+                if attn is not None:
+                    attn = attn[keep]
+
+            best = eos_mask.long().unsqueeze(1)
+            tokens[:, step + 1] = cand_indices.gather(1, best).squeeze(1)
+            scores[:, step] = cand_scores.gather(1, best).squeeze(1)
+
+        return finalized
+
+    def _ban_repeated_ngrams(self, tokens, lprobs, step):
+        """Set the *lprobs* of the tokens that would repeat an ngram of
+        *tokens* (up to *step*) to -inf."""
+        n = self.no_repeat_ngram_size
+        if step + 2 - n < 0:
+            # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
+            return
+        # the tokens after step + 1 are still padding
+        tokens = tokens[:, :step + 2]
+        # all the ngrams of each hypothesis: (bsz * beam_size, num_ngrams, n)
+        ngrams = tokens.unfold(1, n, 1)
+        # before decoding the next token, prevent decoding of ngrams that have already appeared,
+        # i.e. the last token of those starting with the n - 1 last tokens
+        last_tokens = tokens[:, step + 2 - n:step + 1].unsqueeze(1)
+        matches = ngrams[:, :, :-1].eq(last_tokens).all(dim=2).nonzero()
+        hypos, ngram_idxs = matches[:, 0], matches[:, 1]
+        lprobs[hypos, ngrams[hypos, ngram_idxs, -1]] = -math.inf
+
+def bert_groups(models):
+    """For each model, the index of the first model of *models* with the same
+    BERT encoder (by :func:`bert_fingerprint`) and BERT settings, whose BERT
+    output it can reuse."""
+    if len(models) == 1:
+        return [0]
+    keys = [
+        (m.bert_fingerprint(), m.bert_output_layer, m.packed_bert, m.mask_cls_sep)
+        for m in models
+    ]
+    return [keys.index(key) for key in keys]
+
 
 class EnsembleModel(torch.nn.Module):
     """A wrapper around an ensemble of models."""
@@ -570,23 +728,73 @@ class EnsembleModel(torch.nn.Module):
         self.incremental_states = None
         if all(isinstance(m.decoder, FairseqIncrementalDecoder) for m in models):
             self.incremental_states = {m: {} for m in models}
+        self.bert_groups = bert_groups(models)
+        self.output_vocab = None
 
     def has_encoder(self):
         return hasattr(self.models[0], 'encoder')
 
+    def encoder_uses_bert(self):
+        return any(m.__class__.__name__ == 'TransformerS2Model' for m in self.models)
+
+    def concurrent_bert(self):
+        """Whether BERT can run alongside the encoders, as requested by
+        --concurrent-bert."""
+        return (
+            self.has_encoder() and not self.encoder_uses_bert()
+            and all(getattr(m, 'concurrent_bert', False) for m in self.models)
+        )
+
     def max_decoder_positions(self):
         return min(m.max_decoder_positions() for m in self.models)
 
     @torch.no_grad()
-    def forward_encoder(self, encoder_input):
+    def forward_bert(self, bert_input, bert_features=None, output_layer=None, bert_cache=None):
+        """BERT output of each model. BERT runs once per group of models with
+        identical BERT encoders, which then share the same output dict. With
+        a *bert_cache*, it only runs on the sentences missing from it.
+
+        Each model uses its own `bert_output_layer`; *output_layer* only
+        overrides it for a single model."""
+        if len(self.models) > 1:
+            output_layer = None
+        bert_outs = []
+        for i, model in enumerate(self.models):
+            j = self.bert_groups[i]
+            if j < i:
+                bert_outs.append(bert_outs[j])
+            else:
+                features = bert_features
+                if features is None and bert_cache is not None:
+                    features = bert_cache.bert_features(model, bert_input, output_layer)
+                bert_outs.append(model.forward_bert(bert_input, features, output_layer=output_layer))
+        return bert_outs
+
+    def copy_memories(self, encoder_outs, bert_outs):
+        """Shallow copies of the encoder and BERT output dicts, keeping the
+        BERT outputs shared between models shared."""
+        if encoder_outs is not None:
+            encoder_outs = [dict(encoder_out) for encoder_out in encoder_outs]
+        copies = {}
+        bert_outs = [copies.setdefault(id(bert_out), dict(bert_out)) for bert_out in bert_outs]
+        return encoder_outs, bert_outs
+
+    @torch.no_grad()
+    def forward_encoder(self, encoder_input, bert_outs):
         if not self.has_encoder():
             return None
-        return [model.encoder(**encoder_input) for model in self.models]
+        encoder_outs = []
+        for model, bert_out in zip(self.models, bert_outs):
+            if model.__class__.__name__ == 'TransformerS2Model':
+                encoder_outs.append(model.encoder(bert_encoder_out=bert_out, **encoder_input))
+            else:
+                encoder_outs.append(model.encoder(**encoder_input))
+        return encoder_outs
 
     @torch.no_grad()
     def forward_decoder(self, tokens, encoder_outs, bert_outs, temperature=1.):
         if len(self.models) == 1:
-            return self._decode_one(
+            probs, attn = self._decode_one(
                 tokens,
                 self.models[0],
                 encoder_outs[0] if self.has_encoder() else None,
@@ -595,14 +803,16 @@ class EnsembleModel(torch.nn.Module):
                 log_probs=True,
                 temperature=temperature,
             )
+            return self._expand_output_vocab(probs), attn
 
         log_probs = []
         avg_attn = None
-        for model, encoder_out in zip(self.models, encoder_outs):
+        for model, encoder_out, bert_out in zip(self.models, encoder_outs, bert_outs):
             probs, attn = self._decode_one(
                 tokens,
                 model,
                 encoder_out,
+                bert_out,
                 self.incremental_states,
                 log_probs=True,
                 temperature=temperature,
@@ -616,7 +826,23 @@ class EnsembleModel(torch.nn.Module):
         avg_probs = torch.logsumexp(torch.stack(log_probs, dim=0), dim=0) - math.log(len(self.models))
         if avg_attn is not None:
             avg_attn.div_(len(self.models))
-        return avg_probs, avg_attn
+        return self._expand_output_vocab(avg_probs), avg_attn
+
+    def set_output_vocab(self, vocab):
+        """Only score the target tokens *vocab*, if all decoders support it;
+        the other tokens get a log probability of -inf."""
+        if self.incremental_states is None or not all(hasattr(m.decoder, 'set_output_vocab') for m in self.models):
+            return
+        for model in self.models:
+            model.decoder.set_output_vocab(vocab, self.incremental_states[model])
+        self.output_vocab = vocab
+
+    def _expand_output_vocab(self, lprobs):
+        if self.output_vocab is None:
+            return lprobs
+        full_lprobs = lprobs.new_full((lprobs.size(0), len(self.models[0].decoder.dictionary)), -math.inf)
+        full_lprobs[:, self.output_vocab] = lprobs
+        return full_lprobs
 
     def _decode_one(
         self, tokens, model, encoder_out, bert_out, incremental_states, log_probs,
@@ -643,10 +869,38 @@ class EnsembleModel(torch.nn.Module):
     def reorder_encoder_out(self, encoder_outs, bert_outs, new_order):
         if not self.has_encoder():
             return
-        model = self.models[0]
-        encoder_outs, bert_outs = model.encoder.reorder_encoder_out(encoder_outs[0], bert_outs[0], new_order)
-        return [encoder_outs], [bert_outs]
+        new_encoder_outs, new_bert_outs = [], []
+        for i, (model, encoder_out, bert_out) in enumerate(zip(self.models, encoder_outs, bert_outs)):
+            j = self.bert_groups[i]
+            if j < i:
+                # the shared BERT output was reordered with model j already
+                encoder_out, _ = model.encoder.reorder_encoder_out(
+                    encoder_out, {'bert_encoder_out': None, 'bert_encoder_padding_mask': None}, new_order,
+                )
+                bert_out = new_bert_outs[j]
+            else:
+                encoder_out, bert_out = model.encoder.reorder_encoder_out(encoder_out, bert_out, new_order)
+            new_encoder_outs.append(encoder_out)
+            new_bert_outs.append(bert_out)
+        return new_encoder_outs, new_bert_outs
+
+
+    def set_beam_size(self, beam_size):
+        for model in self.models:
+            if hasattr(model.decoder, 'set_beam_size'):
+                model.decoder.set_beam_size(beam_size)
+
+    def precompute_static_kv(self, encoder_outs, bert_outs):
+        if self.incremental_states is None or not self.has_encoder():
+            return
+        for model, encoder_out, bert_out in zip(self.models, encoder_outs, bert_outs):
+            if hasattr(model.decoder, 'precompute_static_kv'):
+                model.decoder.precompute_static_kv(encoder_out, bert_out, self.incremental_states[model])
 
+    def set_max_decode_len(self, max_len):
+        for model in self.models:
+            if hasattr(model.decoder, 'set_max_decode_len'):
+                model.decoder.set_max_decode_len(max_len)
 
     def reorder_incremental_state(self, new_order):
         if self.incremental_states is None:
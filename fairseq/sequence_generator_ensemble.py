@@ -11,6 +11,7 @@ import torch
 
 from fairseq import search, utils
 from fairseq.models import FairseqIncrementalDecoder
+from fairseq.sequence_generator import bert_groups
 import torch.nn.functional as F
 
 class SequenceGenerator(object):
@@ -126,7 +127,7 @@ class SequenceGenerator(object):
         # separately, but SequenceGenerator directly calls model.encoder
         encoder_input = {
             k: v for k, v in sample['net_input'].items()
-            if k != 'prev_output_tokens' and k != 'bert_input'
+            if k != 'prev_output_tokens' and k != 'bert_input' and k != 'bert_features'
         }
 
         src_tokens = encoder_input['src_tokens']
@@ -147,22 +148,12 @@ class SequenceGenerator(object):
             )
 
         # compute the encoder output for each beam
-        bertinput = sample['net_input']['bert_input']
-        bert_encoder_padding_mask = bertinput.eq(model.models[0].berttokenizer.pad())
-        bert_outs, _ = model.models[0].bert_encoder(bertinput, output_all_encoded_layers=True, attention_mask= 1. - bert_encoder_padding_mask)
-        bert_outs = bert_outs[self.bert_output_layer]
-        if model.models[0].mask_cls_sep:
-            bert_encoder_padding_mask += bertinput.eq(model.models[0].berttokenizer.cls())
-            bert_encoder_padding_mask += bertinput.eq(model.models[0].berttokenizer.sep())
-        bert_outs = bert_outs.permute(1,0,2).contiguous()
-        # bert_outs = F.linear(bert_outs, model.models[0].trans_weight, model.models[0].trans_bias)
-        bert_outs = [{
-            'bert_encoder_out': bert_outs ,
-            'bert_encoder_padding_mask': bert_encoder_padding_mask ,
-        } for i in range(len(models))]
-        if model.models[0].__class__.__name__ == 'TransformerS2Model':
-            encoder_input['bert_encoder_out'] = bert_outs[0]
-        encoder_outs = model.forward_encoder(encoder_input)
+        bert_outs = model.forward_bert(
+            sample['net_input']['bert_input'],
+            sample['net_input'].get('bert_features', None),
+            self.bert_output_layer,
+        )
+        encoder_outs = model.forward_encoder(encoder_input, bert_outs)
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
         new_order = new_order.to(src_tokens.device).long()
         encoder_outs, bert_outs = model.reorder_encoder_out(encoder_outs, bert_outs, new_order)
@@ -570,6 +561,7 @@ class EnsembleModel(torch.nn.Module):
         self.incremental_states = None
         if all(isinstance(m.decoder, FairseqIncrementalDecoder) for m in models):
             self.incremental_states = {m: {} for m in models}
+        self.bert_groups = bert_groups(models)
 
     def has_encoder(self):
         return hasattr(self.models[0], 'encoder')
@@ -578,10 +570,35 @@ class EnsembleModel(torch.nn.Module):
         return min(m.max_decoder_positions() for m in self.models)
 
     @torch.no_grad()
-    def forward_encoder(self, encoder_input):
+    def forward_bert(self, bert_input, bert_features=None, output_layer=None):
+        """BERT output of each model. BERT runs once per group of models with
+        identical BERT encoders; as the outputs are reordered per model, each
+        model gets its own dict.
+
+        Each model uses its own `bert_output_layer`; *output_layer* only
+        overrides it for a single model."""
+        if len(self.models) > 1:
+            output_layer = None
+        bert_outs = []
+        for i, model in enumerate(self.models):
+            j = self.bert_groups[i]
+            if j < i:
+                bert_outs.append(dict(bert_outs[j]))
+            else:
+                bert_outs.append(model.forward_bert(bert_input, bert_features, output_layer=output_layer))
+        return bert_outs
+
+    @torch.no_grad()
+    def forward_encoder(self, encoder_input, bert_outs):
         if not self.has_encoder():
             return None
-        return [model.encoder(**encoder_input) for model in self.models]
+        encoder_outs = []
+        for model, bert_out in zip(self.models, bert_outs):
+            if model.__class__.__name__ == 'TransformerS2Model':
+                encoder_outs.append(model.encoder(bert_encoder_out=bert_out, **encoder_input))
+            else:
+                encoder_outs.append(model.encoder(**encoder_input))
+        return encoder_outs
 
     @torch.no_grad()
     def forward_decoder(self, tokens, encoder_outs, bert_outs, temperature=1.):
@@ -0,0 +1,79 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import numpy as np
+import torch
+
+
+class Shortlist(object):
+    """Target tokens worth scoring when translating a given source sentence.
+
+    These are the most frequent target tokens, plus the likeliest
+    translations of each source token, as collected from the training data
+    by ``scripts/build_shortlist.py``.
+
+    Args:
+        candidates (LongTensor): the candidate target tokens of each source
+            token, best first, of shape `(src_vocab, size)` and padded with -1
+        frequent (LongTensor): target tokens that are always scored
+    """
+
+    def __init__(self, candidates, frequent):
+        self.candidates = candidates
+        self.frequent = frequent
+
+    @classmethod
+    def build(cls, pair_codes, pair_counts, tgt_counts, src_vocab_size, size, num_frequent, nspecial):
+        """Build a shortlist from token statistics.
+
+        Args:
+            pair_codes (np.ndarray): distinct (source token, target token)
+                pairs, as ``src * len(tgt_counts) + tgt``
+            pair_counts (np.ndarray): number of occurrences of each pair
+            tgt_counts (np.ndarray): number of occurrences of each target token
+            src_vocab_size (int): size of the source dictionary
+            size (int): number of candidates per source token
+            num_frequent (int): number of most frequent target tokens to add
+            nspecial (int): number of special symbols, which are always added
+        """
+        src, tgt = np.divmod(pair_codes, len(tgt_counts))
+        # the special symbols, e.g. EOS, are always scored anyway
+        regular = tgt >= nspecial
+        src, tgt, pair_counts = src[regular], tgt[regular], pair_counts[regular]
+        # by source token, then by decreasing count
+        order = np.lexsort((-pair_counts, src))
+        src, tgt = src[order], tgt[order]
+        first = np.searchsorted(src, src, side='left')
+        rank = np.arange(len(src)) - first
+        keep = rank < size
+
+        candidates = np.full((src_vocab_size, size), -1, dtype=np.int64)
+        candidates[src[keep], rank[keep]] = tgt[keep]
+        frequent = np.argsort(-tgt_counts[nspecial:], kind='mergesort')[:num_frequent] + nspecial
+        frequent = np.concatenate([np.arange(nspecial), frequent])
+        return cls(torch.from_numpy(candidates), torch.from_numpy(np.sort(frequent)))
+
+    @classmethod
+    def load(cls, path, size=None):
+        """Load a shortlist, keeping the best *size* candidates per source
+        token if given."""
+        state = torch.load(path)
+        candidates = state['candidates']
+        if size is not None:
+            candidates = candidates[:, :size]
+        return cls(candidates.contiguous(), state['frequent'])
+
+    def save(self, path):
+        torch.save({'candidates': self.candidates, 'frequent': self.frequent}, path)
+
+    def vocab(self, src_tokens):
+        """The sorted target tokens to score for the sentences *src_tokens*."""
+        if self.candidates.device != src_tokens.device:
+            self.candidates = self.candidates.to(src_tokens.device)
+            self.frequent = self.frequent.to(src_tokens.device)
+        candidates = self.candidates[src_tokens.unique()].view(-1)
+        return torch.cat([self.frequent, candidates[candidates.ge(0)]]).unique()
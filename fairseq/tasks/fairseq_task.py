@@ -5,6 +5,7 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import numpy as np
 import torch
 
 from fairseq import tokenizer
@@ -93,6 +94,7 @@ class FairseqTask(object):
         self, dataset, max_tokens=None, max_sentences=None, max_positions=None,
         ignore_invalid_inputs=False, required_batch_size_multiple=1,
         seed=1, num_shards=1, shard_id=0, num_workers=0, epoch=0,
+        batch_cache_dir=None, max_bert_tokens=None, quadratic_cost_weight=0.,
     ):
         """
         Get an iterator that yields batches of data from the given dataset.
@@ -120,6 +122,14 @@ class FairseqTask(object):
                 (default: 0).
             epoch (int, optional): the epoch to start the iterator from
                 (default: 0).
+            batch_cache_dir (str, optional): directory in which to cache the
+                mini-batches across runs (default: None).
+            max_bert_tokens (int, optional): max number of BERT input tokens
+                in each batch. If set, *max_tokens* only counts the NMT source
+                and target tokens (default: None).
+            quadratic_cost_weight (float, optional): count a sentence of length
+                *n* as ``n + quadratic_cost_weight * n ** 2`` tokens when
+                enforcing *max_tokens* and *max_bert_tokens* (default: 0).
 
         Returns:
             ~fairseq.iterators.EpochBatchIterator: a batched iterator over the
@@ -132,14 +142,34 @@ class FairseqTask(object):
             indices = dataset.ordered_indices()
 
         # filter examples that are too large
-        indices = data_utils.filter_by_size(
+        indices = np.fromiter(data_utils.filter_by_size(
             indices, dataset.size, max_positions, raise_exception=(not ignore_invalid_inputs),
-        )
+        ), dtype=np.int64)
+
+        # count tokens, with a separate budget for the BERT input if requested
+        bert_num_tokens_vec = None
+        if max_bert_tokens is not None:
+            num_tokens_vec, bert_num_tokens_vec = dataset.branch_num_tokens_vec(indices)
+            if bert_num_tokens_vec is None:
+                max_bert_tokens = None
+        else:
+            num_tokens_vec = dataset.num_tokens_vec(indices)
+        if quadratic_cost_weight > 0:
+            num_tokens_vec = data_utils.quadratic_cost(num_tokens_vec, quadratic_cost_weight)
+            if bert_num_tokens_vec is not None:
+                bert_num_tokens_vec = data_utils.quadratic_cost(bert_num_tokens_vec, quadratic_cost_weight)
+            # sentences within max_positions may still cost more than a batch
+            indices, num_tokens_vec, bert_num_tokens_vec = data_utils.filter_by_cost(indices, [
+                (num_tokens_vec, max_tokens, '--max-tokens'),
+                (bert_num_tokens_vec, max_bert_tokens, '--max-bert-tokens'),
+            ], raise_exception=(not ignore_invalid_inputs))
 
         # create mini-batches with given size constraints
         batch_sampler = data_utils.batch_by_size(
             indices, dataset.num_tokens, max_tokens=max_tokens, max_sentences=max_sentences,
             required_batch_size_multiple=required_batch_size_multiple,
+            num_tokens_vec=num_tokens_vec, bert_num_tokens_vec=bert_num_tokens_vec,
+            max_bert_tokens=max_bert_tokens, cache_dir=batch_cache_dir,
         )
 
         # return a reusable, sharded iterator
@@ -256,6 +286,11 @@ class FairseqTask(object):
     def aggregate_logging_outputs(self, logging_outputs, criterion):
         return criterion.__class__.aggregate_logging_outputs(logging_outputs)
 
+    def logging_keys(self, criterion):
+        """The keys of the logging outputs of :func:`train_step` and
+        :func:`valid_step`, see :func:`FairseqCriterion.logging_keys`."""
+        return criterion.__class__.logging_keys()
+
     def max_positions(self):
         """Return the max input length allowed by the task."""
         return None
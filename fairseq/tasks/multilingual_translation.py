@@ -305,6 +305,10 @@ class MultilingualTranslationTask(FairseqTask):
     def grad_denom(self, sample_sizes, criterion):
         return criterion.__class__.grad_denom(sample_sizes)
 
+    def logging_keys(self, criterion):
+        # the logging outputs are nested by language pair
+        return None
+
     def aggregate_logging_outputs(self, logging_outputs, criterion, logging_output_keys=None):
         logging_output_keys = logging_output_keys or self.eval_lang_pairs
         # aggregate logging outputs for each language pair
@@ -14,6 +14,7 @@ from fairseq.data import (
     data_utils,
     indexed_dataset,
     LanguagePairDataset,
+    MMapBertFeatureDataset,
 )
 
 from . import FairseqTask, register_task
@@ -24,7 +25,8 @@ def load_langpair_dataset(
     src, src_dict,
     tgt, tgt_dict,
     combine, dataset_impl, upsample_primary,
-    left_pad_source, left_pad_target, max_source_positions, max_target_positions, bert_model_name
+    left_pad_source, left_pad_target, max_source_positions, max_target_positions, bert_model_name,
+    precomputed_bert=False, bert_output_layer=-1, left_pad_bert=None,
 ):
     def split_exists(split, src, tgt, lang, data_path):
         filename = os.path.join(data_path, '{}.{}-{}.{}'.format(split, src, tgt, lang))
@@ -33,6 +35,7 @@ def load_langpair_dataset(
     src_datasets = []
     tgt_datasets = []
     srcbert_datasets = []
+    srcbert_feature_datasets = []
 
     for k in itertools.count():
         split_k = split + (str(k) if k > 0 else '')
@@ -41,9 +44,11 @@ def load_langpair_dataset(
         if split_exists(split_k, src, tgt, src, data_path):
             prefix = os.path.join(data_path, '{}.{}-{}.'.format(split_k, src, tgt))
             bertprefix = os.path.join(data_path, '{}.bert.{}-{}.'.format(split_k, src, tgt))
+            bertfeatprefix = os.path.join(data_path, '{}.bertfeat.{}-{}.'.format(split_k, src, tgt))
         elif split_exists(split_k, tgt, src, src, data_path):
             prefix = os.path.join(data_path, '{}.{}-{}.'.format(split_k, tgt, src))
             bertprefix =  os.path.join(data_path, '{}.bert.{}-{}.'.format(split_k, tgt, src))
+            bertfeatprefix = os.path.join(data_path, '{}.bertfeat.{}-{}.'.format(split_k, tgt, src))
         else:
             if k > 0:
                 break
@@ -56,6 +61,17 @@ def load_langpair_dataset(
                                                          fix_lua_indexing=True, dictionary=tgt_dict))
         srcbert_datasets.append(indexed_dataset.make_dataset(bertprefix + src, impl=dataset_impl,
                                                          fix_lua_indexing=True, ))
+        if precomputed_bert:
+            if not MMapBertFeatureDataset.exists(bertfeatprefix + src):
+                raise FileNotFoundError('Precomputed BERT features not found: {} ({})'.format(
+                    bertfeatprefix + src, 'see scripts/extract_bert_features.py'))
+            features = MMapBertFeatureDataset(bertfeatprefix + src)
+            if features.output_layer != bert_output_layer:
+                raise ValueError('BERT features in {} were extracted from layer {}, but '
+                                 '--bert-output-layer is {}'.format(
+                                     bertfeatprefix + src, features.output_layer, bert_output_layer))
+            assert len(features) == len(srcbert_datasets[-1])
+            srcbert_feature_datasets.append(features)
 
         print('| {} {} {}-{} {} examples'.format(data_path, split_k, src, tgt, len(src_datasets[-1])))
 
@@ -64,14 +80,20 @@ def load_langpair_dataset(
 
     assert len(src_datasets) == len(tgt_datasets)
 
+    srcbert_features = None
     if len(src_datasets) == 1:
         src_dataset, tgt_dataset = src_datasets[0], tgt_datasets[0]
         srcbert_datasets = srcbert_datasets[0]
+        if precomputed_bert:
+            srcbert_features = srcbert_feature_datasets[0]
     else:
         sample_ratios = [1] * len(src_datasets)
         sample_ratios[0] = upsample_primary
         src_dataset = ConcatDataset(src_datasets, sample_ratios)
         tgt_dataset = ConcatDataset(tgt_datasets, sample_ratios)
+        srcbert_datasets = ConcatDataset(srcbert_datasets, sample_ratios)
+        if precomputed_bert:
+            srcbert_features = ConcatDataset(srcbert_feature_datasets, sample_ratios)
 
     berttokenizer = BertTokenizer.from_pretrained(bert_model_name)
     return LanguagePairDataset(
@@ -82,6 +104,8 @@ def load_langpair_dataset(
         left_pad_target=left_pad_target,
         max_source_positions=max_source_positions,
         max_target_positions=max_target_positions,
+        srcbert_features=srcbert_features,
+        left_pad_bert=left_pad_bert,
     )
 
 
@@ -125,6 +149,8 @@ class TranslationTask(FairseqTask):
                             help='pad the source on the left')
         parser.add_argument('--left-pad-target', default='False', type=str, metavar='BOOL',
                             help='pad the target on the left')
+        parser.add_argument('--left-pad-bert', default=None, type=str, metavar='BOOL',
+                            help='pad the BERT input on the left (default: same as --left-pad-source)')
         parser.add_argument('--max-source-positions', default=1024, type=int, metavar='N',
                             help='max number of tokens in the source sequence')
         parser.add_argument('--max-target-positions', default=1024, type=int, metavar='N',
@@ -135,6 +161,16 @@ class TranslationTask(FairseqTask):
         parser.add_argument('--encoder-ratio', default=1., type=float)
         parser.add_argument('--bert-ratio', default=1., type=float)
         parser.add_argument('--finetune-bert', action='store_true')
+        parser.add_argument('--finetune-bert-top-layers', type=int, metavar='K',
+                            help='with --finetune-bert, only fine-tune the top K BERT layers '
+                                 'and keep the embeddings and lower layers frozen')
+        parser.add_argument('--finetune-bert-after', default=0, type=int, metavar='N',
+                            help='with --finetune-bert, keep BERT frozen for the first N updates')
+        parser.add_argument('--bert-lr-scale', default=1., type=float, metavar='S',
+                            help='learning rate of the top fine-tuned BERT layer, relative to --lr')
+        parser.add_argument('--bert-layer-lr-decay', default=1., type=float, metavar='D',
+                            help='learning rate scale of each BERT layer relative to the one above it, '
+                                 'the embeddings being below the bottom layer')
         parser.add_argument('--mask-cls-sep', action='store_true')
         parser.add_argument('--warmup-from-nmt', action='store_true', )
         parser.add_argument('--warmup-nmt-file', default='checkpoint_nmt.pt', )
@@ -145,6 +181,20 @@ class TranslationTask(FairseqTask):
         parser.add_argument('--bert-output-layer', default=-1, type=int)
         parser.add_argument('--encoder-bert-mixup', action='store_true')
         parser.add_argument('--decoder-no-bert', action='store_true')
+        parser.add_argument('--truncate-bert', action='store_true',
+                            help='drop the BERT layers above --bert-output-layer and the pooler')
+        parser.add_argument('--packed-bert', action='store_true',
+                            help='run BERT on the non-padding tokens only')
+        parser.add_argument('--concurrent-bert', action='store_true',
+                            help='run BERT in a background thread while the encoder runs '
+                                 '(only with encoders that do not attend to BERT)')
+        parser.add_argument('--bert-threads', type=int, metavar='N',
+                            help='number of intra-op threads of the --concurrent-bert thread')
+        parser.add_argument('--precomputed-bert', action='store_true',
+                            help='read frozen BERT states from {split}.bertfeat.* files '
+                                 'instead of running BERT (see scripts/extract_bert_features.py); '
+                                 'requires --left-pad-bert False, also when generating; the states '
+                                 'are extracted without the BERT dropout applied in training otherwise')
 
         # fmt: on
 
@@ -163,6 +213,10 @@ class TranslationTask(FairseqTask):
         """
         args.left_pad_source = options.eval_bool(args.left_pad_source)
         args.left_pad_target = options.eval_bool(args.left_pad_target)
+        if getattr(args, 'left_pad_bert', None) is None:
+            args.left_pad_bert = args.left_pad_source
+        elif not isinstance(args.left_pad_bert, bool):
+            args.left_pad_bert = options.eval_bool(args.left_pad_bert)
         if getattr(args, 'raw_text', False):
             utils.deprecation_warning('--raw-text is deprecated, please use --dataset-impl=raw')
             args.dataset_impl = 'raw'
@@ -187,6 +241,19 @@ class TranslationTask(FairseqTask):
         print('| [{}] dictionary: {} types'.format(args.source_lang, len(src_dict)))
         print('| [{}] dictionary: {} types'.format(args.target_lang, len(tgt_dict)))
 
+        if getattr(args, 'precomputed_bert', False) and getattr(args, 'finetune_bert', False):
+            raise ValueError('--precomputed-bert cannot be combined with --finetune-bert')
+        if getattr(args, 'precomputed_bert', False) and args.left_pad_bert:
+            # BERT positions start at the first column, so left-padded
+            # sentences would not see the positions of the extracted states
+            raise ValueError('--precomputed-bert requires --left-pad-bert False, the features are '
+                             'extracted from right-padded BERT input')
+        if not getattr(args, 'finetune_bert', False) and (
+            getattr(args, 'finetune_bert_top_layers', None) is not None
+            or getattr(args, 'finetune_bert_after', 0) > 0
+        ):
+            raise ValueError('--finetune-bert-top-layers and --finetune-bert-after require --finetune-bert')
+
         return cls(args, src_dict, tgt_dict)
 
     def load_dataset(self, split, epoch=0, combine=False, **kwargs):
@@ -210,11 +277,17 @@ class TranslationTask(FairseqTask):
             left_pad_target=self.args.left_pad_target,
             max_source_positions=self.args.max_source_positions,
             max_target_positions=self.args.max_target_positions,
-            bert_model_name = self.bert_model_name
+            bert_model_name = self.bert_model_name,
+            precomputed_bert=getattr(self.args, 'precomputed_bert', False),
+            bert_output_layer=getattr(self.args, 'bert_output_layer', -1),
+            left_pad_bert=self.args.left_pad_bert,
         )
 
     def build_dataset_for_inference(self, src_tokens, src_lengths, srcbert, srcbert_sizes, berttokenizer):
-        return LanguagePairDataset(src_tokens, src_lengths, self.source_dictionary, srcbert=srcbert, srcbert_sizes=srcbert_sizes, berttokenizer=berttokenizer)
+        return LanguagePairDataset(
+            src_tokens, src_lengths, self.source_dictionary, srcbert=srcbert, srcbert_sizes=srcbert_sizes,
+            berttokenizer=berttokenizer, left_pad_bert=getattr(self.args, 'left_pad_bert', None),
+        )
 
     def max_positions(self):
         """Return the max sentence length allowed by the task."""
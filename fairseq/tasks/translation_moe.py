@@ -212,6 +212,10 @@ class TranslationMoETask(TranslationTask):
                 bos_token=self.expert_index(expert),
             )
 
+    def logging_keys(self, criterion):
+        # the logging outputs also hold the expert posteriors
+        return None
+
     def aggregate_logging_outputs(self, logging_outputs, criterion):
         agg_logging_outputs = criterion.__class__.aggregate_logging_outputs(logging_outputs)
         agg_logging_outputs['posterior'] = sum(
@@ -55,6 +55,12 @@ class Trainer(object):
         self._optimizer = None
         self._prev_grad_norm = None
         self._wrapped_model = None
+        self._frozen_state_cache = None
+
+        self._bert_schedule = self._build_bert_schedule()
+        self._bert_unfrozen = None
+        if self._bert_schedule is not None:
+            self._set_bert_trainable()
 
         self.init_meters(args)
 
@@ -99,8 +105,73 @@ class Trainer(object):
             self._build_optimizer()  # this will initialize self._lr_scheduler
         return self._lr_scheduler
 
+    def _build_bert_schedule(self):
+        """The BERT modules fine-tuned with their own learning rate scales or
+        from a later update on (see --bert-lr-scale, --bert-layer-lr-decay,
+        --finetune-bert-top-layers and --finetune-bert-after), as a list of
+        `(module, lr_scale)`. None if BERT is frozen or trained like the rest
+        of the model."""
+        args = self.args
+        if not getattr(args, 'finetune_bert', False) or not hasattr(self._model, 'bert_modules'):
+            return None
+        lr_scale = getattr(args, 'bert_lr_scale', 1.)
+        lr_decay = getattr(args, 'bert_layer_lr_decay', 1.)
+        top_layers = getattr(args, 'finetune_bert_top_layers', None)
+        if (
+            lr_scale == 1. and lr_decay == 1. and top_layers is None
+            and getattr(args, 'finetune_bert_after', 0) == 0
+        ):
+            return None
+
+        modules = self._model.bert_modules()
+        schedule = [
+            (module, lr_scale * lr_decay ** (len(modules) - 1 - i))
+            for i, module in enumerate(modules)
+        ]
+        if top_layers is not None:
+            # the embeddings come first
+            schedule = schedule[1:][max(len(schedule) - 1 - top_layers, 0):]
+        return schedule
+
+    def _set_bert_trainable(self):
+        """Only train the scheduled BERT modules, once --finetune-bert-after
+        updates are done. The other BERT parameters stay out of autograd and
+        of the optimizer state."""
+        unfrozen = self.get_num_updates() >= getattr(self.args, 'finetune_bert_after', 0)
+        if unfrozen == self._bert_unfrozen:
+            return
+        for p in self._model.bert_encoder.parameters():
+            p.requires_grad = False
+        if unfrozen:
+            for module, _ in self._bert_schedule:
+                for p in module.parameters():
+                    p.requires_grad = True
+            if self._bert_unfrozen is not None:
+                print('| unfreezing {} BERT modules at update {}'.format(
+                    len(self._bert_schedule), self.get_num_updates()))
+        if self._bert_unfrozen is not None:
+            # DistributedDataParallel only reduces the gradients of the
+            # parameters that were trained when it was built
+            self._wrapped_model = None
+        self._bert_unfrozen = unfrozen
+
+    def _param_groups(self):
+        """The parameters to optimize. With a BERT schedule, the scheduled
+        BERT modules are included even while frozen, each in a group with its
+        own ``lr_scale``, so the optimizer doesn't change when they are
+        unfrozen."""
+        if self._bert_schedule is None:
+            return list(filter(lambda p: p.requires_grad, self.model.parameters()))
+        bert_params = set(self._model.bert_encoder.parameters())
+        groups = [{'params': [
+            p for p in self._model.parameters() if p.requires_grad and p not in bert_params
+        ]}]
+        for module, lr_scale in self._bert_schedule:
+            groups.append({'params': list(module.parameters()), 'lr_scale': lr_scale})
+        return groups
+
     def _build_optimizer(self):
-        params = list(filter(lambda p: p.requires_grad, self.model.parameters()))
+        params = self._param_groups()
         if self.args.fp16:
             if self.cuda and torch.cuda.get_device_capability(0)[0] < 7:
                 print('| WARNING: your device does NOT support faster training with --fp16, '
@@ -113,6 +184,8 @@ class Trainer(object):
             if self.cuda and torch.cuda.get_device_capability(0)[0] >= 7:
                 print('| NOTICE: your device may support faster training with --fp16')
             self._optimizer = optim.build_optimizer(self.args, params)
+        # apply the lr_scale of the parameter groups
+        self._optimizer.set_lr(self._optimizer.get_lr())
 
         # We should initialize the learning rate scheduler immediately after
         # building the optimizer, so that the initial learning rate is set.
@@ -120,14 +193,51 @@ class Trainer(object):
         self._lr_scheduler.step_update(0)
 
     def save_checkpoint(self, filename, extra_state):
-        """Save all training state in a checkpoint file."""
+        """Save all training state in a checkpoint file.
+
+        Returns the name of the frozen state file the checkpoint references
+        with --dedup-frozen-params, if any."""
         if distributed_utils.is_master(self.args):  # only save one checkpoint
             extra_state['train_meters'] = self.meters
+            model_state_dict = self.get_model().state_dict()
+            frozen_model_state = None
+            if getattr(self.args, 'dedup_frozen_params', False):
+                model_state_dict, frozen_model_state = self._split_frozen_state(
+                    model_state_dict, os.path.dirname(filename),
+                )
             checkpoint_utils.save_state(
-                filename, self.args, self.get_model().state_dict(), self.criterion,
+                filename, self.args, model_state_dict, self.criterion,
                 self.optimizer, self.lr_scheduler, self.get_num_updates(),
-                self._optim_history, extra_state,
+                self._optim_history, extra_state, frozen_model_state,
+            )
+            return frozen_model_state
+
+    def _split_frozen_state(self, model_state_dict, save_dir):
+        """Store the parameters that are not trained (e.g., a frozen BERT)
+        once in *save_dir* and strip them from *model_state_dict*."""
+        frozen_params = [
+            (name, p) for name, p in self.get_model().named_parameters() if not p.requires_grad
+        ]
+        if len(frozen_params) == 0:
+            return model_state_dict, None
+        # the optimizer does not update parameters without gradients, so the
+        # frozen file only needs to be hashed and written again if other
+        # parameters are frozen or a checkpoint is loaded (which resets it)
+        key = (save_dir, tuple(name for name, _ in frozen_params))
+        if (
+            self._frozen_state_cache is None
+            or self._frozen_state_cache[0] != key
+            or not os.path.exists(os.path.join(save_dir, self._frozen_state_cache[1]))
+        ):
+            _, frozen_file = checkpoint_utils.save_frozen_state(
+                model_state_dict, [name for name, _ in frozen_params], save_dir,
             )
+            self._frozen_state_cache = (key, frozen_file)
+        frozen_keys = set(name for name, _ in frozen_params)
+        model_state_dict = OrderedDict(
+            (k, v) for k, v in model_state_dict.items() if k not in frozen_keys
+        )
+        return model_state_dict, self._frozen_state_cache[1]
 
     def load_checkpoint(
         self,
@@ -148,6 +258,7 @@ class Trainer(object):
             try:
                 # loaded_results = self.get_model().load_state_dict(state['model'], strict=False if warmup_from_nmt else True)
                 self.get_model().load_state_dict(state['model'], strict=False if warmup_from_nmt else True)
+                self._frozen_state_cache = None
             except Exception:
                 raise Exception(
                     'Cannot load model parameters from checkpoint, '
@@ -221,6 +332,9 @@ class Trainer(object):
             shard_id=self.args.distributed_rank,
             num_workers=self.args.num_workers,
             epoch=epoch,
+            batch_cache_dir=getattr(self.args, 'batch_cache_dir', None),
+            max_bert_tokens=getattr(self.args, 'max_bert_tokens', None),
+            quadratic_cost_weight=getattr(self.args, 'quadratic_cost_weight', 0.),
         )
 
     def train_step(self, samples, dummy_batch=False, raise_oom=False):
@@ -296,13 +410,17 @@ class Trainer(object):
 
         # gather logging outputs from all replicas
         if self.args.distributed_world_size > 1:
-            logging_outputs, sample_sizes, ooms, prev_norms = \
-                zip(*distributed_utils.all_gather_list(
-                    [logging_outputs, sample_sizes, ooms, self._prev_grad_norm],
-                ))
-            logging_outputs = list(chain.from_iterable(logging_outputs))
-            sample_sizes = list(chain.from_iterable(sample_sizes))
-            ooms = sum(ooms)
+            summed = self._all_reduce_logging_outputs(logging_outputs, sample_sizes, ooms, self._prev_grad_norm)
+            if summed is not None:
+                logging_outputs, sample_sizes, ooms, prev_norms = summed
+            else:
+                logging_outputs, sample_sizes, ooms, prev_norms = \
+                    zip(*distributed_utils.all_gather_list(
+                        [logging_outputs, sample_sizes, ooms, self._prev_grad_norm],
+                    ))
+                logging_outputs = list(chain.from_iterable(logging_outputs))
+                sample_sizes = list(chain.from_iterable(sample_sizes))
+                ooms = sum(ooms)
             assert (
                 all(norm == prev_norms[0] for norm in prev_norms)
                 or all(math.isnan(norm) or math.isinf(norm) for norm in prev_norms)
@@ -406,11 +524,15 @@ class Trainer(object):
 
         # gather logging outputs from all replicas
         if self.args.distributed_world_size > 1:
-            logging_output, sample_size = zip(*distributed_utils.all_gather_list(
-                [logging_output, sample_size],
-            ))
-            logging_output = list(logging_output)
-            sample_size = list(sample_size)
+            summed = self._all_reduce_logging_outputs([logging_output], [sample_size])
+            if summed is not None:
+                logging_output, sample_size, _, _ = summed
+            else:
+                logging_output, sample_size = zip(*distributed_utils.all_gather_list(
+                    [logging_output, sample_size],
+                ))
+                logging_output = list(logging_output)
+                sample_size = list(sample_size)
         else:
             logging_output = [logging_output]
             sample_size = [sample_size]
@@ -452,6 +574,44 @@ class Trainer(object):
     def zero_grad(self):
         self.optimizer.zero_grad()
 
+    def _all_reduce_logging_outputs(self, logging_outputs, sample_sizes, ooms=0, grad_norm=None):
+        """Sum the logging outputs, sample sizes and OOMs of all workers with
+        a single all_reduce, if the task declares the logging keys (see
+        :func:`~fairseq.criterions.FairseqCriterion.logging_keys`).
+
+        Returns:
+            tuple: the summed logging output and sample size, each in a list,
+            the total number of OOMs and the *grad_norm* of each worker, or
+            None if the logging outputs must be gathered instead
+        """
+        types = self.task.logging_keys(self.criterion)
+        if types is None:
+            return None
+        keys = list(types.keys())
+        undeclared = set(k for log in logging_outputs for k in log if k not in types)
+        if len(undeclared) > 0:
+            print('| WARNING: logging outputs {} are missing from the logging keys of {}, '
+                  'gathering the logging outputs instead'.format(
+                      ', '.join(sorted(undeclared)), self.criterion.__class__.__name__))
+
+        values = [sum(log.get(k, 0) for log in logging_outputs) for k in keys] + [sum(sample_sizes)]
+        # each worker fills its own slot of the gradient norms
+        norms = [0.] * self.args.distributed_world_size
+        norms[self.args.distributed_rank] = float('nan') if grad_norm is None else float(grad_norm)
+        # the workers all fall back to gathering if any has undeclared keys
+        sums = distributed_utils.all_reduce_sum(
+            [float(v) for v in values] + [float(ooms), float(len(undeclared) > 0)] + norms
+        )
+        if sums[len(values) + 1] > 0:
+            return None
+        # counts, e.g. ntokens, stay integers whatever the local values
+        logging_output = {
+            k: int(round(s)) if types[k] is int else s for k, s in zip(keys, sums)
+        }
+        sample_size = sums[len(keys)]
+        ooms = int(round(sums[len(values)]))
+        return [logging_output], [sample_size], ooms, sums[len(values) + 2:]
+
     def lr_step(self, epoch, val_loss=None):
         """Adjust the learning rate based on the validation loss."""
         _lr = self.lr_scheduler.step(epoch, val_loss)
@@ -483,6 +643,8 @@ class Trainer(object):
     def set_num_updates(self, num_updates):
         """Set the number of parameters updates."""
         self._num_updates = num_updates
+        if self._bert_schedule is not None:
+            self._set_bert_trainable()
         self.lr_step_update()
 
     def _prepare_sample(self, sample):
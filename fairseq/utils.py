@@ -6,6 +6,7 @@
 # can be found in the PATENTS file in the same directory.
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import importlib.util
 import math
@@ -51,6 +52,31 @@ def move_to_cuda(sample):
     return _move_to_cuda(sample)
 
 
+BACKGROUND_EXECUTORS = {}
+
+
+def fork(fn, *args, num_threads=None, **kwargs):
+    """Start ``fn(*args, **kwargs)`` in a background thread and return a
+    future whose ``result()`` waits for it, e.g. to run two independent parts
+    of a model at once. PyTorch ops release the GIL, so they overlap with
+    those of the calling thread. *num_threads* is the number of intra-op
+    threads of the background thread (with OpenMP builds)."""
+    if num_threads not in BACKGROUND_EXECUTORS:
+        BACKGROUND_EXECUTORS[num_threads] = ThreadPoolExecutor(
+            max_workers=1,
+            initializer=torch.set_num_threads if num_threads is not None else None,
+            initargs=(num_threads,) if num_threads is not None else (),
+        )
+    # grad mode is thread local
+    grad_enabled = torch.is_grad_enabled()
+
+    def run():
+        with torch.set_grad_enabled(grad_enabled):
+            return fn(*args, **kwargs)
+
+    return BACKGROUND_EXECUTORS[num_threads].submit(run)
+
+
 INCREMENTAL_STATE_INSTANCE_ID = defaultdict(lambda: 0)
 
 
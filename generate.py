@@ -9,10 +9,93 @@
 Translate pre-processed data with a trained model.
 """
 
+import copy
+import functools
+import itertools
+import os
+
 import torch
 
 from fairseq import bleu, checkpoint_utils, options, progress_bar, tasks, utils
+from fairseq.bert_output_cache import BertOutputCache
 from fairseq.meters import StopwatchMeter, TimeMeter
+from fairseq.shortlist import Shortlist
+
+
+def process_batch(args, task, sample, hypos, src_dict, tgt_dict, align_dict, scorer, output=None):
+    """Print the source, target and hypotheses of a batch (unless --quiet),
+    or write them to *output*, and score the top hypotheses."""
+    if output is not None:
+        print_fn = functools.partial(print, file=output)
+    elif not args.quiet:
+        print_fn = print
+    else:
+        print_fn = None
+    has_target = True
+    for i, sample_id in enumerate(sample['id'].tolist()):
+        has_target = sample['target'] is not None
+
+        # Remove padding
+        src_tokens = utils.strip_pad(sample['net_input']['src_tokens'][i, :], tgt_dict.pad())
+        target_tokens = None
+        if has_target:
+            target_tokens = utils.strip_pad(sample['target'][i, :], tgt_dict.pad()).int().cpu()
+
+        # Either retrieve the original sentences or regenerate them from tokens.
+        if align_dict is not None:
+            src_str = task.dataset(args.gen_subset).src.get_original_text(sample_id)
+            target_str = task.dataset(args.gen_subset).tgt.get_original_text(sample_id)
+        else:
+            if src_dict is not None:
+                src_str = src_dict.string(src_tokens, args.remove_bpe)
+            else:
+                src_str = ""
+            if has_target:
+                target_str = tgt_dict.string(target_tokens, args.remove_bpe, escape_unk=True)
+
+        if print_fn is not None:
+            if src_dict is not None:
+                print_fn('S-{}\t{}'.format(sample_id, src_str))
+            if has_target:
+                print_fn('T-{}\t{}'.format(sample_id, target_str))
+
+        # Process top predictions
+        for i, hypo in enumerate(hypos[i][:min(len(hypos), args.nbest)]):
+            hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
+                hypo_tokens=hypo['tokens'].int().cpu(),
+                src_str=src_str,
+                alignment=hypo['alignment'].int().cpu() if hypo['alignment'] is not None else None,
+                align_dict=align_dict,
+                tgt_dict=tgt_dict,
+                remove_bpe=args.remove_bpe,
+            )
+
+            if print_fn is not None:
+                print_fn('H-{}\t{}\t{}'.format(sample_id, hypo['score'], hypo_str))
+                print_fn('P-{}\t{}'.format(
+                    sample_id,
+                    ' '.join(map(
+                        lambda x: '{:.4f}'.format(x),
+                        hypo['positional_scores'].tolist(),
+                    ))
+                ))
+
+                if args.print_alignment:
+                    print_fn('A-{}\t{}'.format(
+                        sample_id,
+                        ' '.join(map(lambda x: str(utils.item(x)), alignment))
+                    ))
+
+            # Score only the top hypothesis
+            if has_target and i == 0:
+                if align_dict is not None or args.remove_bpe is not None:
+                    # Convert back to tokens for evaluation with unk replacement and/or without BPE
+                    target_tokens = tgt_dict.encode_line(target_str, add_if_not_exist=True)
+                if hasattr(scorer, 'add_string'):
+                    scorer.add_string(target_str, hypo_str)
+                else:
+                    scorer.add(target_tokens, hypo_tokens)
+    return has_target
 
 
 def main(args):
@@ -67,6 +150,16 @@ def main(args):
     # (None if no unknown word replacement, empty if no path to align dictionary)
     align_dict = utils.load_align_dict(args.replace_unk)
 
+    # BERT states persisted across runs
+    bert_cache = None
+    if args.bert_cache_dir is not None:
+        bert_cache = BertOutputCache(args.bert_cache_dir, int(args.bert_cache_size * 2 ** 30))
+
+    # Restrict the scored target tokens
+    shortlist = None
+    if args.shortlist is not None:
+        shortlist = Shortlist.load(args.shortlist, args.shortlist_size)
+
     # Load dataset (possibly sharded)
     itr = task.get_batch_iterator(
         dataset=task.dataset(args.gen_subset),
@@ -81,11 +174,18 @@ def main(args):
         num_shards=args.num_shards,
         shard_id=args.shard_id,
         num_workers=args.num_workers,
+        max_bert_tokens=args.max_bert_tokens,
+        quadratic_cost_weight=args.quadratic_cost_weight,
     ).next_epoch_itr(shuffle=False)
 
+    if args.sweep_beam or args.sweep_lenpen or args.sweep_ratio:
+        return sweep(args, task, models, itr, use_cuda, src_dict, tgt_dict, align_dict, bert_cache, shortlist)
+
     # Initialize generator
     gen_timer = StopwatchMeter()
     generator = task.build_generator(args)
+    generator.bert_cache = bert_cache
+    generator.shortlist = shortlist
 
     # Generate and compute BLEU score
     if args.sacrebleu:
@@ -110,74 +210,13 @@ def main(args):
             num_generated_tokens = sum(len(h[0]['tokens']) for h in hypos)
             gen_timer.stop(num_generated_tokens)
 
-            for i, sample_id in enumerate(sample['id'].tolist()):
-                has_target = sample['target'] is not None
-
-                # Remove padding
-                src_tokens = utils.strip_pad(sample['net_input']['src_tokens'][i, :], tgt_dict.pad())
-                target_tokens = None
-                if has_target:
-                    target_tokens = utils.strip_pad(sample['target'][i, :], tgt_dict.pad()).int().cpu()
-
-                # Either retrieve the original sentences or regenerate them from tokens.
-                if align_dict is not None:
-                    src_str = task.dataset(args.gen_subset).src.get_original_text(sample_id)
-                    target_str = task.dataset(args.gen_subset).tgt.get_original_text(sample_id)
-                else:
-                    if src_dict is not None:
-                        src_str = src_dict.string(src_tokens, args.remove_bpe)
-                    else:
-                        src_str = ""
-                    if has_target:
-                        target_str = tgt_dict.string(target_tokens, args.remove_bpe, escape_unk=True)
-
-                if not args.quiet:
-                    if src_dict is not None:
-                        print('S-{}\t{}'.format(sample_id, src_str))
-                    if has_target:
-                        print('T-{}\t{}'.format(sample_id, target_str))
-
-                # Process top predictions
-                for i, hypo in enumerate(hypos[i][:min(len(hypos), args.nbest)]):
-                    hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
-                        hypo_tokens=hypo['tokens'].int().cpu(),
-                        src_str=src_str,
-                        alignment=hypo['alignment'].int().cpu() if hypo['alignment'] is not None else None,
-                        align_dict=align_dict,
-                        tgt_dict=tgt_dict,
-                        remove_bpe=args.remove_bpe,
-                    )
-
-                    if not args.quiet:
-                        print('H-{}\t{}\t{}'.format(sample_id, hypo['score'], hypo_str))
-                        print('P-{}\t{}'.format(
-                            sample_id,
-                            ' '.join(map(
-                                lambda x: '{:.4f}'.format(x),
-                                hypo['positional_scores'].tolist(),
-                            ))
-                        ))
-
-                        if args.print_alignment:
-                            print('A-{}\t{}'.format(
-                                sample_id,
-                                ' '.join(map(lambda x: str(utils.item(x)), alignment))
-                            ))
-
-                    # Score only the top hypothesis
-                    if has_target and i == 0:
-                        if align_dict is not None or args.remove_bpe is not None:
-                            # Convert back to tokens for evaluation with unk replacement and/or without BPE
-                            target_tokens = tgt_dict.encode_line(target_str, add_if_not_exist=True)
-                        if hasattr(scorer, 'add_string'):
-                            scorer.add_string(target_str, hypo_str)
-                        else:
-                            scorer.add(target_tokens, hypo_tokens)
+            has_target = process_batch(args, task, sample, hypos, src_dict, tgt_dict, align_dict, scorer)
 
             wps_meter.update(num_generated_tokens)
             t.log({'wps': round(wps_meter.avg)})
             num_sentences += sample['nsentences']
 
+    close_bert_cache(bert_cache)
     print('| Translated {} sentences ({} tokens) in {:.1f}s ({:.2f} sentences/s, {:.2f} tokens/s)'.format(
         num_sentences, gen_timer.n, gen_timer.sum, num_sentences / gen_timer.sum, 1. / gen_timer.avg))
     if has_target:
@@ -185,6 +224,94 @@ def main(args):
     return scorer
 
 
+def set_ratios(models, encoder_ratio, bert_ratio):
+    for model in models:
+        for module in model.modules():
+            if hasattr(module, 'set_ratios'):
+                module.set_ratios(encoder_ratio, bert_ratio)
+
+
+def close_bert_cache(bert_cache):
+    if bert_cache is not None:
+        bert_cache.close()
+        print('| BERT cache: {} hits, {} misses, {} sentences cached'.format(
+            bert_cache.hits, bert_cache.misses, len(bert_cache)))
+
+
+def sweep(args, task, models, itr, use_cuda, src_dict, tgt_dict, align_dict, bert_cache=None, shortlist=None):
+    """Decode with every combination of --sweep-ratio, --sweep-beam and
+    --sweep-lenpen. BERT runs once per batch and the encoder once per batch
+    and ratio (the bert-fused encoder layers depend on the ratios), so each
+    configuration only adds a decoder pass."""
+    ratios = [None]
+    if args.sweep_ratio:
+        ratios = [tuple(float(r) for r in ratio.split(',')) for ratio in args.sweep_ratio]
+        assert all(len(ratio) == 2 for ratio in ratios), '--sweep-ratio takes encoder_ratio,bert_ratio pairs'
+    configs = list(itertools.product(ratios, args.sweep_beam or [args.beam], args.sweep_lenpen or [args.lenpen]))
+    encoder_uses_ratios = any(
+        hasattr(module, 'set_ratios') for model in models for module in model.encoder.modules()
+    )
+
+    os.makedirs(args.sweep_output_dir, exist_ok=True)
+    generators, scorers, outputs = [], [], []
+    for ratio, beam, lenpen in configs:
+        assert not args.sampling or args.nbest == beam, '--sampling requires --nbest to be equal to --beam'
+        gen_args = copy.copy(args)
+        gen_args.beam, gen_args.lenpen = beam, lenpen
+        generators.append(task.build_generator(gen_args))
+        generators[-1].bert_cache = bert_cache
+        generators[-1].shortlist = shortlist
+        if args.sacrebleu:
+            scorers.append(bleu.SacrebleuScorer())
+        else:
+            scorers.append(bleu.Scorer(tgt_dict.pad(), tgt_dict.eos(), tgt_dict.unk()))
+        name = '{}.beam{}.lenpen{}'.format(args.gen_subset, beam, lenpen)
+        if ratio is not None:
+            name += '.ratio{},{}'.format(*ratio)
+        outputs.append(open(os.path.join(args.sweep_output_dir, name + '.txt'), 'w', encoding='utf-8'))
+
+    gen_timer = StopwatchMeter()
+    num_sentences = 0
+    has_target = True
+    with progress_bar.build_progress_bar(args, itr) as t:
+        for sample in t:
+            sample = utils.move_to_cuda(sample) if use_cuda else sample
+            if 'net_input' not in sample:
+                continue
+
+            prefix_tokens = None
+            if args.prefix_size > 0:
+                prefix_tokens = sample['target'][:, :args.prefix_size]
+
+            gen_timer.start()
+            bert_outs, memories = None, {}
+            for (ratio, _, _), generator, scorer, output in zip(configs, generators, scorers, outputs):
+                if ratio is not None:
+                    set_ratios(models, *ratio)
+                key = ratio if encoder_uses_ratios else None
+                if key not in memories:
+                    memories[key] = generator.forward_memories(models, sample, bert_outs)
+                    bert_outs = memories[key][1]
+                hypos = generator.generate(models, sample, prefix_tokens, memories=memories[key])
+                has_target = process_batch(
+                    args, task, sample, hypos, src_dict, tgt_dict, align_dict, scorer, output=output,
+                )
+            gen_timer.stop(len(configs) * sample['nsentences'])
+            num_sentences += sample['nsentences']
+
+    for output in outputs:
+        output.close()
+    close_bert_cache(bert_cache)
+    print('| Translated {} sentences in {} configurations in {:.1f}s ({:.2f} sentences/s)'.format(
+        num_sentences, len(configs), gen_timer.sum, len(configs) * num_sentences / gen_timer.sum))
+    if has_target:
+        for (ratio, beam, lenpen), scorer in zip(configs, scorers):
+            ratio_str = '' if ratio is None else ' encoder_ratio={} bert_ratio={}'.format(*ratio)
+            print('| Generate {} with beam={} lenpen={}{}: {}'.format(
+                args.gen_subset, beam, lenpen, ratio_str, scorer.result_string()))
+    return scorers
+
+
 def cli_main():
     parser = options.get_generation_parser()
     args = options.parse_args_and_arch(parser)
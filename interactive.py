@@ -9,7 +9,7 @@
 Translate raw text with a trained model. Batches data on-the-fly.
 """
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import fileinput
 
 import torch
@@ -34,38 +34,60 @@ def buffered_read(input, buffer_size):
         yield buffer
 
 
-def make_batches(lines, args, task, max_positions, encode_fn):
-    oldlines = lines
-    lines = oldlines[0::2]
-    bertlines = oldlines[1::2]
-    tokens = [
-        task.source_dictionary.encode_line(
-            encode_fn(src_str), add_if_not_exist=False
-        ).long()
-        for src_str in lines
-    ]
-    bertdict = BertTokenizer.from_pretrained(args.bert_model_name)
-    def getbert(line):
-        line = line.strip()
-        line = '{} {} {}'.format('[CLS]', line, '[SEP]')
-        tokenizedline = bertdict.tokenize(line)
-        if len(tokenizedline) > bertdict.max_len:
-            tokenizedline = tokenizedline[:bertdict.max_len - 1]
-            tokenizedline.append('[SEP]')
-        words = bertdict.convert_tokens_to_ids(tokenizedline)
-        nwords = len(words)
-        ids = torch.IntTensor(nwords)
-        for i, word in enumerate(words):
-            ids[i] = word
-        return ids.long()
-    berttokens = [getbert(x) for x in bertlines]
+class InputEncoder(object):
+    """Encodes pairs of (NMT source, BERT source) input lines into token ids.
+
+    Created once per process, so the BERT vocabulary is only loaded once.
+    The encodings of the most recently seen line pairs are kept in an LRU
+    cache of *cache_size* entries, so that repeated inputs skip both
+    tokenizers.
+    """
+
+    def __init__(self, src_dict, berttokenizer, encode_fn, cache_size=10000):
+        self.src_dict = src_dict
+        self.berttokenizer = berttokenizer
+        self.encode_fn = encode_fn
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def encode_batch(self, src_lines, bert_lines):
+        """Returns a list of (NMT source ids, BERT input ids) pairs. The BERT
+        lines that are not cached are tokenized in a single batch."""
+        keys = list(zip(src_lines, bert_lines))
+        encoded = {key: self.cache[key] for key in keys if key in self.cache}
+        missing = OrderedDict((key, None) for key in keys if key not in encoded)
+        bert_ids = self.berttokenizer.encode_lines([bert_str for _, bert_str in missing])
+        for (src_str, bert_str), ids in zip(missing, bert_ids):
+            tokens = self.src_dict.encode_line(
+                self.encode_fn(src_str), add_if_not_exist=False
+            ).long()
+            encoded[(src_str, bert_str)] = (tokens, torch.LongTensor(ids))
+
+        for key in keys:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            elif self.cache_size > 0:
+                self.cache[key] = encoded[key]
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return [encoded[key] for key in keys]
+
+
+def make_batches(lines, args, task, max_positions, input_encoder):
+    encoded = input_encoder.encode_batch(lines[0::2], lines[1::2])
+    tokens = [t for t, _ in encoded]
+    berttokens = [b for _, b in encoded]
     lengths = torch.LongTensor([t.numel() for t in tokens])
     bertlengths = torch.LongTensor([t.numel() for t in berttokens])
     itr = task.get_batch_iterator(
-        dataset=task.build_dataset_for_inference(tokens, lengths, berttokens, bertlengths, bertdict),
+        dataset=task.build_dataset_for_inference(
+            tokens, lengths, berttokens, bertlengths, input_encoder.berttokenizer,
+        ),
         max_tokens=args.max_tokens,
         max_sentences=args.max_sentences,
         max_positions=max_positions,
+        max_bert_tokens=args.max_bert_tokens,
+        quadratic_cost_weight=args.quadratic_cost_weight,
     ).next_epoch_itr(shuffle=False)
     for batch in itr:
         yield Batch(
@@ -133,6 +155,11 @@ def main(args):
         decoder = None
         encode_fn = lambda x: x
 
+    input_encoder = InputEncoder(
+        src_dict, BertTokenizer.from_pretrained(args.bert_model_name), encode_fn,
+        cache_size=args.input_cache_size,
+    )
+
     # Load alignment dictionary for unknown word replacement
     # (None if no unknown word replacement, empty if no path to align dictionary)
     align_dict = utils.load_align_dict(args.replace_unk)
@@ -148,7 +175,7 @@ def main(args):
     start_id = 0
     for inputs in buffered_read(args.input, args.buffer_size):
         results = []
-        for batch in make_batches(inputs, args, task, max_positions, encode_fn):
+        for batch in make_batches(inputs, args, task, max_positions, input_encoder):
             src_tokens = batch.src_tokens
             src_lengths = batch.src_lengths
             bert_input = batch.bert_input
@@ -19,6 +19,7 @@ from multiprocessing import Pool
 from bert import BertTokenizer
 import os
 import shutil
+import time
 
 
 def main(args):
@@ -99,13 +100,15 @@ def main(args):
         print("| [{}] Dictionary: {} types".format(lang, len(vocab) - 1))
         output_prefix += '.bert' if isinstance(vocab, BertTokenizer) else ''
         input_prefix += '.bert' if isinstance(vocab, BertTokenizer) else ''
-        n_seq_tok = [0, 0]
+        n_seq_tok = [0, 0, 0]
         replaced = Counter()
+        start_time = time.time()
 
         def merge_result(worker_result):
             replaced.update(worker_result["replaced"])
             n_seq_tok[0] += worker_result["nseq"]
             n_seq_tok[1] += worker_result["ntok"]
+            n_seq_tok[2] += worker_result["nunk"]
 
         input_file = "{}{}".format(
             input_prefix, ("." + lang) if lang is not None else ""
@@ -148,15 +151,17 @@ def main(args):
                 os.remove(indexed_dataset.index_file_path(temp_file_path))
 
         ds.finalize(dataset_dest_file(args, output_prefix, lang, "idx"))
+        elapsed = time.time() - start_time
 
         print(
-            "| [{}] {}: {} sents, {} tokens, {:.3}% replaced by {}".format(
+            "| [{}] {}: {} sents, {} tokens, {:.3}% replaced by {}, {:.1f} sents/s".format(
                 lang,
                 input_file,
                 n_seq_tok[0],
                 n_seq_tok[1],
-                100 * sum(replaced.values()) / n_seq_tok[1],
+                100 * n_seq_tok[2] / n_seq_tok[1],
                 vocab.unk_word,
+                n_seq_tok[0] / elapsed if elapsed > 0 else 0.,
             )
         )
 
@@ -12,6 +12,8 @@ import torch
 import os
 import re
 
+from fairseq import checkpoint_utils
+
 
 def average_checkpoints(inputs):
     """Loads checkpoints from inputs and returns a model with averaged weights.
@@ -36,6 +38,8 @@ def average_checkpoints(inputs):
                 lambda s, _: torch.serialization.default_restore_location(s, 'cpu')
             ),
         )
+        # resolve parameters stored separately with --dedup-frozen-params
+        state = checkpoint_utils.load_frozen_state(state, f)
         # Copies over the settings from the first checkpoint
         if new_state is None:
             new_state = state
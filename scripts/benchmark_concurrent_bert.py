@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Measure the latency of computing the encoder and BERT outputs that generation
+attends to, with BERT running before the encoder or, as with
+``--concurrent-bert``, alongside it. The models are randomly initialized
+with the sizes of a base transformer and of bert-base.
+"""
+
+import argparse
+import time
+
+import torch
+
+from bert import BertConfig, BertModel
+from fairseq.data import Dictionary
+from fairseq.models.transformer import base_architecture, Embedding, TransformerModel
+from fairseq.sequence_generator import SequenceGenerator
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='benchmark running BERT concurrently with the NMT encoder')
+    # fmt: off
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 2, 4, 8, 16, 32],
+                        help='batch sizes to measure')
+    parser.add_argument('--src-len', default=30, type=int, metavar='N',
+                        help='source sentence length')
+    parser.add_argument('--vocab-size', default=32000, type=int, metavar='N',
+                        help='size of the source dictionary')
+    parser.add_argument('--bert-threads', type=int, metavar='N',
+                        help='number of intra-op threads of the BERT thread')
+    parser.add_argument('--repeat', default=10, type=int, metavar='N',
+                        help='number of timed runs per batch size')
+    parser.add_argument('--cpu', action='store_true', help='use CPU instead of CUDA')
+    # fmt: on
+    return parser
+
+
+def build_model(vocab_size):
+    d = Dictionary()
+    for i in range(vocab_size - len(d)):
+        d.add_symbol(str(i))
+    args = argparse.Namespace(
+        encoder_ratio=1., bert_ratio=1., bert_gates=[1] * 6,
+        max_source_positions=1024, max_target_positions=1024,
+    )
+    base_architecture(args)
+    bert = BertModel(BertConfig(30522))
+    args.bert_out_dim = bert.hidden_size
+    encoder = TransformerModel.build_encoder(args, d, Embedding(len(d), args.encoder_embed_dim, d.pad()))
+    decoder = TransformerModel.build_decoder(args, d, Embedding(len(d), args.decoder_embed_dim, d.pad()))
+    model = TransformerModel(encoder, decoder, bert, d, False, args)
+    model.eval()
+    return model, d
+
+
+def timed(fn, repeat, use_cuda):
+    fn()  # warmup
+    if use_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if use_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    args = get_parser().parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    model, d = build_model(args.vocab_size)
+    model.bert_threads = args.bert_threads
+    if use_cuda:
+        model.cuda()
+    generator = SequenceGenerator(d, beam_size=1, args=argparse.Namespace(bert_output_layer=-1))
+
+    for bsz in args.batch_sizes:
+        src_tokens = torch.randint(d.nspecial, len(d), (bsz, args.src_len))
+        src_tokens[:, -1] = d.eos()
+        sample = {
+            'net_input': {
+                'src_tokens': src_tokens,
+                'src_lengths': torch.full((bsz,), args.src_len, dtype=torch.long),
+                # BERT sees [CLS] and [SEP] on top of the source tokens
+                'bert_input': torch.randint(1000, 30522, (bsz, args.src_len + 2)),
+            },
+        }
+        if use_cuda:
+            sample = {'net_input': {k: v.cuda() for k, v in sample['net_input'].items()}}
+
+        latency = {}
+        for concurrent in [False, True]:
+            model.concurrent_bert = concurrent
+            latency[concurrent] = timed(
+                lambda: generator.forward_memories([model], sample), args.repeat, use_cuda,
+            )
+        print('| bsz {:3d} | sequential {:8.2f} ms | concurrent {:8.2f} ms | speedup {:.2f}x'.format(
+            bsz, 1000 * latency[False], 1000 * latency[True], latency[False] / latency[True]), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Measure how CPU data-parallel training (``train.py --cpu
+--distributed-world-size N``, i.e. gloo) scales with the number of worker
+processes. Each worker trains a small randomly initialized bert-fused
+transformer on random batches of a fixed size, so ideally the number of
+updates per second stays constant and the throughput grows linearly.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from bert import BertConfig, BertModel
+from fairseq import distributed_utils, options
+from fairseq.data import Dictionary
+from fairseq.models.transformer import Embedding, TransformerModel
+from fairseq.tasks.translation import TranslationTask
+from fairseq.trainer import Trainer
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='benchmark CPU distributed training with gloo')
+    # fmt: off
+    parser.add_argument('--num-procs', nargs='+', type=int, default=[1, 2, 4],
+                        help='numbers of worker processes to measure')
+    parser.add_argument('--threads-per-proc', type=int, metavar='N',
+                        help='intra-op threads of each worker (default: the cores divided by '
+                             'the largest --num-procs)')
+    parser.add_argument('--updates', default=20, type=int, metavar='N',
+                        help='number of timed updates')
+    parser.add_argument('--warmup-updates', default=3, type=int, metavar='N',
+                        help='number of updates before timing')
+    parser.add_argument('--batch-size', default=16, type=int, metavar='N',
+                        help='sentences per worker and update')
+    parser.add_argument('--seq-len', default=20, type=int, metavar='N',
+                        help='source and target sentence length')
+    parser.add_argument('--vocab-size', default=1000, type=int, metavar='N',
+                        help='size of the joined dictionary')
+    parser.add_argument('--embed-dim', default=128, type=int, metavar='N',
+                        help='embedding dimension of the NMT model and of BERT')
+    parser.add_argument('--layers', default=2, type=int, metavar='N',
+                        help='number of encoder, decoder and BERT layers')
+    parser.add_argument('--ddp-backend', default='c10d', choices=['c10d', 'no_c10d'],
+                        help='DistributedDataParallel backend')
+    # fmt: on
+    return parser
+
+
+def train_args(bench_args, world_size, rank, init_method):
+    parser = options.get_training_parser()
+    dim, layers = str(bench_args.embed_dim), str(bench_args.layers)
+    return options.parse_args_and_arch(parser, [
+        'data-bin', '--arch', 'transformer', '--cpu', '--optimizer', 'adam', '--lr', '1e-4',
+        '--criterion', 'label_smoothed_cross_entropy', '--label-smoothing', '0.1',
+        '--max-sentences', str(bench_args.batch_size), '--ddp-backend', bench_args.ddp_backend,
+        '--encoder-embed-dim', dim, '--encoder-ffn-embed-dim', str(4 * bench_args.embed_dim),
+        '--encoder-layers', layers, '--decoder-embed-dim', dim,
+        '--decoder-ffn-embed-dim', str(4 * bench_args.embed_dim), '--decoder-layers', layers,
+        '--bert-gates'] + ['1'] * bench_args.layers + [
+        '--distributed-world-size', str(world_size), '--distributed-rank', str(rank),
+        '--distributed-init-method', init_method,
+    ])
+
+
+def build_model(args, bench_args, d):
+    bert = BertModel(BertConfig(
+        bench_args.vocab_size, hidden_size=bench_args.embed_dim, num_hidden_layers=bench_args.layers,
+        num_attention_heads=4, intermediate_size=4 * bench_args.embed_dim,
+    ))
+    args.bert_out_dim = bert.hidden_size
+    encoder = TransformerModel.build_encoder(args, d, Embedding(len(d), args.encoder_embed_dim, d.pad()))
+    decoder = TransformerModel.build_decoder(args, d, Embedding(len(d), args.decoder_embed_dim, d.pad()))
+    return TransformerModel(encoder, decoder, bert, d, False, args)
+
+
+def random_batch(bench_args, d):
+    bsz, seq_len = bench_args.batch_size, bench_args.seq_len
+    src_tokens = torch.randint(d.nspecial, len(d), (bsz, seq_len))
+    src_tokens[:, -1] = d.eos()
+    target = torch.randint(d.nspecial, len(d), (bsz, seq_len))
+    target[:, -1] = d.eos()
+    return {
+        'id': torch.arange(bsz),
+        'nsentences': bsz,
+        'ntokens': target.numel(),
+        'net_input': {
+            'src_tokens': src_tokens,
+            'src_lengths': torch.full((bsz,), seq_len, dtype=torch.long),
+            'prev_output_tokens': torch.cat([target[:, -1:], target[:, :-1]], dim=1),
+            'bert_input': torch.randint(d.nspecial, len(d), (bsz, seq_len + 2)),
+        },
+        'target': target,
+    }
+
+
+def worker(rank, bench_args, world_size, init_method, result_file):
+    torch.set_num_threads(bench_args.threads_per_proc)
+    args = train_args(bench_args, world_size, rank, init_method)
+    if world_size > 1:
+        distributed_utils.distributed_init(args)
+    torch.manual_seed(args.seed + rank)
+
+    d = Dictionary()
+    for i in range(bench_args.vocab_size - len(d)):
+        d.add_symbol(str(i))
+    task = TranslationTask(args, d, d)
+    model = build_model(args, bench_args, d)
+    # BERT is frozen, as by train.py without --finetune-bert
+    for p in model.bert_encoder.parameters():
+        p.requires_grad = False
+    trainer = Trainer(args, task, model, task.build_criterion(args))
+    batch = random_batch(bench_args, d)
+
+    for _ in range(bench_args.warmup_updates):
+        trainer.train_step([batch])
+    start = time.perf_counter()
+    for _ in range(bench_args.updates):
+        trainer.train_step([batch])
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        with open(result_file, 'w') as f:
+            f.write(str(bench_args.updates / elapsed))
+
+
+def main():
+    bench_args = get_parser().parse_args()
+    if bench_args.threads_per_proc is None:
+        bench_args.threads_per_proc = max(1, os.cpu_count() // max(bench_args.num_procs))
+    print('| {} threads per worker, {} sentences per worker and update'.format(
+        bench_args.threads_per_proc, bench_args.batch_size), flush=True)
+
+    base_ups = None
+    for num_procs in bench_args.num_procs:
+        with tempfile.TemporaryDirectory('benchmark_cpu_distributed') as tmpdir:
+            init_method = 'file://' + os.path.join(tmpdir, 'init')
+            result_file = os.path.join(tmpdir, 'result')
+            mp.spawn(worker, args=(bench_args, num_procs, init_method, result_file), nprocs=num_procs)
+            with open(result_file) as f:
+                ups = float(f.read())
+        if base_ups is None:
+            base_ups = ups
+        print('| procs {:3d} | {:6.2f} updates/s | {:8.1f} sentences/s | scaling efficiency {:.2f}'.format(
+            num_procs, ups, ups * num_procs * bench_args.batch_size, ups / base_ups), flush=True)
+
+
+if __name__ == '__main__':
+    main()
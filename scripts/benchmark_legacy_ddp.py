@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Measure the step time (forward, backward and gradient all-reduce) of a
+bert-fused transformer wrapped in ``LegacyDistributedDataParallel``
+(``--ddp-backend no_c10d``), reducing the gradients once backward has
+finished in a single 256M-element buffer, as it used to, or in
+``--bucket-cap-mb`` buckets overlapped with backward. The model is randomly
+initialized; each worker uses a GPU if there are enough of them, otherwise
+the CPU with gloo.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+from bert import BertConfig, BertModel
+from fairseq import distributed_utils
+from fairseq.data import Dictionary
+from fairseq.legacy_distributed_data_parallel import LegacyDistributedDataParallel
+from fairseq.models.transformer import (
+    base_architecture, Embedding, TransformerModel, transformer_vaswani_wmt_en_de_big,
+)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='benchmark overlapping the gradient all-reduce of --ddp-backend no_c10d with backward')
+    # fmt: off
+    parser.add_argument('--num-procs', default=2, type=int, metavar='N',
+                        help='number of worker processes')
+    parser.add_argument('--steps', default=10, type=int, metavar='N',
+                        help='number of timed steps')
+    parser.add_argument('--warmup-steps', default=2, type=int, metavar='N',
+                        help='number of steps before timing')
+    parser.add_argument('--update-freq', default=1, type=int, metavar='N',
+                        help='backward passes per step, only the last one reduces the gradients')
+    parser.add_argument('--batch-size', default=16, type=int, metavar='N',
+                        help='sentences per worker and backward pass')
+    parser.add_argument('--seq-len', default=30, type=int, metavar='N',
+                        help='source and target sentence length')
+    parser.add_argument('--vocab-size', default=32000, type=int, metavar='N',
+                        help='size of the joined dictionary')
+    parser.add_argument('--big', action='store_true',
+                        help='use a big transformer and bert-large instead of a base transformer and bert-base')
+    parser.add_argument('--finetune-bert', action='store_true',
+                        help='reduce the gradients of BERT, which is frozen otherwise')
+    parser.add_argument('--bucket-cap-mb', default=25, type=int, metavar='MB',
+                        help='bucket size of the overlapped reduction')
+    parser.add_argument('--fp16', action='store_true', help='use FP16 (CUDA only)')
+    parser.add_argument('--cpu', action='store_true', help='use CPU instead of CUDA')
+    # fmt: on
+    return parser
+
+
+def build_model(bench_args, d):
+    args = argparse.Namespace(
+        encoder_ratio=1., bert_ratio=1., bert_gates=[1] * 6,
+        max_source_positions=1024, max_target_positions=1024,
+    )
+    if bench_args.big:
+        transformer_vaswani_wmt_en_de_big(args)
+        bert = BertModel(BertConfig(
+            30522, hidden_size=1024, num_hidden_layers=24, num_attention_heads=16, intermediate_size=4096,
+        ))
+    else:
+        base_architecture(args)
+        bert = BertModel(BertConfig(30522))
+    args.bert_out_dim = bert.hidden_size
+    encoder = TransformerModel.build_encoder(args, d, Embedding(len(d), args.encoder_embed_dim, d.pad()))
+    decoder = TransformerModel.build_decoder(args, d, Embedding(len(d), args.decoder_embed_dim, d.pad()))
+    model = TransformerModel(encoder, decoder, bert, d, False, args)
+    if not bench_args.finetune_bert:
+        # as by train.py without --finetune-bert
+        for p in model.bert_encoder.parameters():
+            p.requires_grad = False
+    return model
+
+
+def random_batch(bench_args, d, device):
+    bsz, seq_len = bench_args.batch_size, bench_args.seq_len
+    src_tokens = torch.randint(d.nspecial, len(d), (bsz, seq_len))
+    src_tokens[:, -1] = d.eos()
+    target = torch.randint(d.nspecial, len(d), (bsz, seq_len))
+    target[:, -1] = d.eos()
+    net_input = {
+        'src_tokens': src_tokens,
+        'src_lengths': torch.full((bsz,), seq_len, dtype=torch.long),
+        'prev_output_tokens': torch.cat([target[:, -1:], target[:, :-1]], dim=1),
+        # BERT sees [CLS] and [SEP] on top of the source tokens
+        'bert_input': torch.randint(1000, 30522, (bsz, seq_len + 2)),
+    }
+    return {k: v.to(device) for k, v in net_input.items()}, target.to(device)
+
+
+def worker(rank, bench_args, init_method):
+    use_cuda = not bench_args.cpu
+    if use_cuda:
+        torch.cuda.set_device(rank)
+    else:
+        torch.set_num_threads(max(1, os.cpu_count() // bench_args.num_procs))
+    args = argparse.Namespace(
+        cpu=not use_cuda, distributed_world_size=bench_args.num_procs, distributed_rank=rank,
+        distributed_backend='nccl', distributed_init_method=init_method,
+    )
+    distributed_utils.distributed_init(args)
+    torch.manual_seed(rank)
+
+    d = Dictionary()
+    for i in range(bench_args.vocab_size - len(d)):
+        d.add_symbol(str(i))
+    model = build_model(bench_args, d)
+    if bench_args.fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    batch = random_batch(bench_args, d, 'cuda' if use_cuda else 'cpu')
+    element_size = next(model.parameters()).element_size()
+    modes = [
+        ('previous', dict(buffer_size=2**28, overlap_reduction=False)),
+        ('overlapped', dict(buffer_size=bench_args.bucket_cap_mb * 2**20 // element_size)),
+    ]
+
+    step_times = []
+    for _, kwargs in modes:
+        ddp_model = LegacyDistributedDataParallel(model, bench_args.num_procs, **kwargs)
+
+        def step():
+            model.zero_grad()
+            for i in range(bench_args.update_freq):
+                ddp_model.accumulate_grads = i < bench_args.update_freq - 1
+                net_input, target = batch
+                logits = ddp_model(**net_input)[0]
+                F.cross_entropy(logits.float().view(-1, logits.size(-1)), target.view(-1)).backward()
+            if use_cuda:
+                torch.cuda.synchronize()
+
+        for _ in range(bench_args.warmup_steps):
+            step()
+        start = time.perf_counter()
+        for _ in range(bench_args.steps):
+            step()
+        step_times.append((time.perf_counter() - start) / bench_args.steps)
+        del ddp_model
+
+    if rank == 0:
+        num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        print('| {} procs | {:.1f}M reduced parameters | update freq {}'.format(
+            bench_args.num_procs, num_params / 1e6, bench_args.update_freq), flush=True)
+        for (name, _), step_time in zip(modes, step_times):
+            print('| {:10s} | {:8.2f} ms/step | speedup {:.2f}x'.format(
+                name, 1000 * step_time, step_times[0] / step_time), flush=True)
+
+
+def main():
+    bench_args = get_parser().parse_args()
+    if torch.cuda.device_count() < bench_args.num_procs:
+        bench_args.cpu = True
+    if bench_args.cpu and bench_args.fp16:
+        raise ValueError('--fp16 requires CUDA')
+    with tempfile.TemporaryDirectory('benchmark_legacy_ddp') as tmpdir:
+        init_method = 'file://' + os.path.join(tmpdir, 'init')
+        mp.spawn(worker, args=(bench_args, init_method), nprocs=bench_args.num_procs)
+
+
+if __name__ == '__main__':
+    main()
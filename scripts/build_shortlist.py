@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Collect the likeliest target tokens of each source token from the binarized
+``{split}.{src}-{tgt}.{src,tgt}`` data, and the most frequent target tokens,
+into a shortlist for ``generate.py --shortlist``. Source and target tokens
+are paired by sentence co-occurrence, or by word alignments if
+``--alignment-file`` is given (e.g. from fast_align, see
+``scripts/build_sym_alignment.py``).
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from fairseq.data import Dictionary, indexed_dataset
+from fairseq.shortlist import Shortlist
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='build a target vocabulary shortlist for decoding')
+    # fmt: off
+    parser.add_argument('data', metavar='DIR', help='binarized data directory')
+    parser.add_argument('-s', '--source-lang', required=True, metavar='SRC',
+                        help='source language')
+    parser.add_argument('-t', '--target-lang', required=True, metavar='TARGET',
+                        help='target language')
+    parser.add_argument('-o', '--output', required=True, metavar='FILE',
+                        help='where to save the shortlist')
+    parser.add_argument('--split', default='train', help='split to collect the statistics from')
+    parser.add_argument('--dataset-impl', choices=['raw', 'lazy', 'cached', 'mmap'], default='cached',
+                        help='implementation of the binarized dataset')
+    parser.add_argument('--alignment-file', metavar='FILE',
+                        help='word alignments of the split, one line of "srcidx-tgtidx" pairs per sentence; '
+                             'by default all the tokens of a sentence pair are paired')
+    parser.add_argument('--size', default=50, type=int, metavar='N',
+                        help='number of candidate target tokens per source token')
+    parser.add_argument('--num-frequent', default=1000, type=int, metavar='N',
+                        help='number of most frequent target tokens that are always scored')
+    parser.add_argument('--chunk-size', default=100000, type=int, metavar='N',
+                        help='number of sentences whose pairs are counted together')
+    # fmt: on
+    return parser
+
+
+def merge_counts(codes, counts, new_codes):
+    """Add the occurrences of *new_codes* to the distinct *codes* and their
+    *counts*."""
+    new_codes, new_counts = np.unique(new_codes, return_counts=True)
+    codes, inverse = np.unique(np.concatenate([codes, new_codes]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts, new_counts]), minlength=len(codes))
+    return codes, counts.astype(np.int64)
+
+
+def count_pairs(src_dataset, tgt_dataset, tgt_vocab_size, alignments, chunk_size):
+    pair_codes, pair_counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    tgt_counts = np.zeros(tgt_vocab_size, dtype=np.int64)
+    chunk = []
+    for i in range(len(src_dataset)):
+        src, tgt = src_dataset[i].numpy(), tgt_dataset[i].numpy()
+        tgt_counts += np.bincount(tgt, minlength=tgt_vocab_size)
+        if alignments is not None:
+            links = np.array(
+                [link.split('-') for link in next(alignments).split()], dtype=np.int64,
+            ).reshape(-1, 2)
+            codes = src[links[:, 0]] * tgt_vocab_size + tgt[links[:, 1]]
+        else:
+            # each pair of distinct tokens counts once per sentence
+            codes = (np.unique(src)[:, None] * tgt_vocab_size + np.unique(tgt)[None, :]).reshape(-1)
+        chunk.append(codes.astype(np.int64))
+        if len(chunk) == chunk_size or i == len(src_dataset) - 1:
+            pair_codes, pair_counts = merge_counts(pair_codes, pair_counts, np.concatenate(chunk))
+            chunk = []
+            print('| {}/{} sentences, {} pairs'.format(i + 1, len(src_dataset), len(pair_codes)), flush=True)
+    return pair_codes, pair_counts, tgt_counts
+
+
+def main():
+    args = get_parser().parse_args()
+    src, tgt = args.source_lang, args.target_lang
+    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{}.txt'.format(src)))
+    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{}.txt'.format(tgt)))
+
+    prefix = None
+    for pair in ['{}-{}'.format(src, tgt), '{}-{}'.format(tgt, src)]:
+        candidate = os.path.join(args.data, '{}.{}.'.format(args.split, pair))
+        if indexed_dataset.dataset_exists(candidate + src, impl=args.dataset_impl):
+            prefix = candidate
+            break
+    if prefix is None:
+        raise FileNotFoundError('Dataset not found: {} ({})'.format(args.split, args.data))
+    src_dataset = indexed_dataset.make_dataset(prefix + src, impl=args.dataset_impl, fix_lua_indexing=True)
+    tgt_dataset = indexed_dataset.make_dataset(prefix + tgt, impl=args.dataset_impl, fix_lua_indexing=True)
+    assert len(src_dataset) == len(tgt_dataset)
+
+    alignments = open(args.alignment_file, 'r') if args.alignment_file is not None else None
+    pair_codes, pair_counts, tgt_counts = count_pairs(
+        src_dataset, tgt_dataset, len(tgt_dict), alignments, args.chunk_size,
+    )
+    if alignments is not None:
+        alignments.close()
+
+    shortlist = Shortlist.build(
+        pair_codes, pair_counts, tgt_counts, len(src_dict),
+        args.size, args.num_frequent, tgt_dict.nspecial,
+    )
+    shortlist.save(args.output)
+    print('| saved a shortlist of {} candidates per source token and {} frequent target tokens to {}'.format(
+        args.size, len(shortlist.frequent), args.output))
+
+
+if __name__ == '__main__':
+    main()
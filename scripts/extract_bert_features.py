@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Run a frozen BERT once over the binarized ``{split}.bert.{src}-{tgt}.{src}``
+data and store the ``--bert-output-layer`` states as fp16 in
+``{split}.bertfeat.{src}-{tgt}.{src}.{bin,idx}``. Train with
+``--precomputed-bert`` to read them instead of running BERT every step.
+
+The BERT input is padded on the right, so that the position ids of each
+sentence start at 0 whatever the batch. The model must therefore be trained
+and used with ``--left-pad-bert False``, which ``--precomputed-bert``
+enforces: with left padding, BERT would see other positions.
+
+The features are extracted in eval mode, without dropout. Training with a
+frozen BERT run every step applies BERT's dropout (``hidden_dropout_prob``
+and ``attention_probs_dropout_prob``, 0.1 for the released models) since the
+model is in train mode, so ``--precomputed-bert`` trains on deterministic
+features and is not an exact replacement of the previous training.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import torch
+
+from bert import BertModel, BertTokenizer
+from fairseq.data import data_utils, indexed_dataset
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='precompute frozen BERT features for bert-fused training; the features are '
+                    'extracted from right-padded input, so train and generate with --left-pad-bert False; '
+                    'they are extracted without dropout, which a frozen BERT applies in training')
+    # fmt: off
+    parser.add_argument('data', metavar='DIR', help='binarized data directory')
+    parser.add_argument('-s', '--source-lang', required=True, metavar='SRC',
+                        help='source language')
+    parser.add_argument('-t', '--target-lang', required=True, metavar='TARGET',
+                        help='target language')
+    parser.add_argument('--splits', nargs='+', default=['train', 'valid', 'test'],
+                        help='splits to process; missing splits are skipped')
+    parser.add_argument('--dataset-impl', choices=['raw', 'lazy', 'cached', 'mmap'], default='cached',
+                        help='implementation of the BERT input dataset')
+    parser.add_argument('--bert-model-name', default='bert-base-uncased', type=str)
+    parser.add_argument('--bert-output-layer', default=-1, type=int)
+    parser.add_argument('--max-tokens', default=8000, type=int, metavar='N',
+                        help='maximum number of BERT tokens per forward')
+    parser.add_argument('--chunk-size', default=100000, type=int, metavar='N',
+                        help='number of consecutive sentences sorted and batched together')
+    parser.add_argument('--cpu', action='store_true', help='use CPU instead of CUDA')
+    # fmt: on
+    return parser
+
+
+def batches_for_chunk(sizes, max_tokens):
+    """Yield lists of chunk-relative indices, sorted by length, whose padded
+    size stays within *max_tokens*."""
+    order = np.argsort(sizes, kind='mergesort')
+    batch = []
+    for idx in order:
+        if len(batch) > 0 and (len(batch) + 1) * sizes[idx] > max_tokens:
+            yield batch
+            batch = []
+        batch.append(idx)
+    if len(batch) > 0:
+        yield batch
+
+
+@torch.no_grad()
+def extract_split(args, prefix, bert_model, tokenizer, use_cuda):
+    dataset = indexed_dataset.make_dataset(prefix, impl=args.dataset_impl, fix_lua_indexing=True)
+    out_prefix = prefix.replace('.bert.', '.bertfeat.', 1)
+    builder = indexed_dataset.MMapBertFeatureDatasetBuilder(
+        indexed_dataset.data_file_path(out_prefix), bert_model.hidden_size, args.bert_output_layer,
+    )
+    sizes = np.array(dataset.sizes)
+
+    for start in range(0, len(dataset), args.chunk_size):
+        end = min(start + args.chunk_size, len(dataset))
+        outputs = [None] * (end - start)
+        for batch in batches_for_chunk(sizes[start:end], args.max_tokens):
+            bert_input = data_utils.collate_tokens(
+                [dataset[start + i] for i in batch], tokenizer.pad(), None, left_pad=False,
+            )
+            if use_cuda:
+                bert_input = bert_input.cuda()
+            attention_mask = bert_input.ne(tokenizer.pad())
+            states, _ = bert_model(bert_input, attention_mask=attention_mask.long(),
+                                   output_layer=args.bert_output_layer)
+            states = states.half().cpu()
+            for j, i in enumerate(batch):
+                outputs[i] = states[j, :sizes[start + i]]
+        for features in outputs:
+            builder.add_item(features)
+        print('| {}: {}/{} sentences'.format(out_prefix, end, len(dataset)), flush=True)
+
+    builder.finalize(indexed_dataset.index_file_path(out_prefix))
+
+
+def main():
+    args = get_parser().parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model_name)
+    bert_model = BertModel.from_pretrained(args.bert_model_name)
+    bert_model.truncate(args.bert_output_layer)
+    # no dropout, unlike a frozen BERT run every training step
+    bert_model.eval()
+    if use_cuda:
+        bert_model.cuda()
+
+    src, tgt = args.source_lang, args.target_lang
+    for split in args.splits:
+        prefix = None
+        for pair in ['{}-{}'.format(src, tgt), '{}-{}'.format(tgt, src)]:
+            candidate = os.path.join(args.data, '{}.bert.{}.{}'.format(split, pair, src))
+            if indexed_dataset.dataset_exists(candidate, impl=args.dataset_impl):
+                prefix = candidate
+                break
+        if prefix is None:
+            print('| skipping {}: no BERT input found in {}'.format(split, args.data))
+            continue
+        extract_split(args, prefix, bert_model, tokenizer, use_cuda)
+
+
+if __name__ == '__main__':
+    main()
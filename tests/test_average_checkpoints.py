@@ -15,7 +15,7 @@ import numpy as np
 import torch
 from torch import nn
 
-
+from fairseq import checkpoint_utils
 
 from scripts.average_checkpoints import average_checkpoints
 
@@ -141,6 +141,31 @@ class TestAverageCheckpoints(unittest.TestCase):
         )
         shutil.rmtree(tmpdir)
 
+    def test_average_checkpoints_with_frozen_state(self):
+        tmpdir = tempfile.mkdtemp()
+        frozen = torch.FloatTensor([[1.0, 2.0], [3.0, 4.0]])
+        paths, frozen_files = [], []
+        for i, value in enumerate([1.0, 3.0]):
+            params = collections.OrderedDict([
+                ('bert.weight', frozen.clone()),
+                ('nmt.weight', torch.FloatTensor([value, 2 * value])),
+            ])
+            params, frozen_file = checkpoint_utils.save_frozen_state(params, ['bert.weight'], tmpdir)
+            self.assertEqual(list(params.keys()), ['nmt.weight'])
+            frozen_files.append(frozen_file)
+            paths.append(os.path.join(tmpdir, 'checkpoint{}.pt'.format(i)))
+            torch.save({'model': params, 'frozen_model_state': frozen_file}, paths[-1])
+
+        # identical frozen params are only written once
+        self.assertEqual(frozen_files[0], frozen_files[1])
+        self.assertEqual(len([f for f in os.listdir(tmpdir) if f.startswith('frozen_')]), 1)
+
+        output = average_checkpoints(paths)
+        self.assertNotIn('frozen_model_state', output)
+        self.assertTrue(torch.equal(output['model']['bert.weight'], frozen))
+        self.assertTrue(torch.equal(output['model']['nmt.weight'], torch.FloatTensor([2.0, 4.0])))
+        shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     unittest.main()
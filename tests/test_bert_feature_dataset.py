@@ -0,0 +1,98 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import argparse
+import os
+import tempfile
+import unittest
+
+import torch
+
+from fairseq.data import Dictionary, indexed_dataset, MMapBertFeatureDataset
+from fairseq.data.language_pair_dataset import collate
+from fairseq.tasks.translation import TranslationTask
+
+
+class TestMMapBertFeatureDataset(unittest.TestCase):
+
+    def _write(self, prefix, items, output_layer=-1):
+        builder = indexed_dataset.MMapBertFeatureDatasetBuilder(
+            indexed_dataset.data_file_path(prefix), items[0].size(1), output_layer,
+        )
+        for item in items:
+            builder.add_item(item)
+        builder.finalize(indexed_dataset.index_file_path(prefix))
+
+    def test_roundtrip_and_merge(self):
+        items = [torch.randn(n, 8) for n in [3, 1, 5]]
+        with tempfile.TemporaryDirectory('test_bert_features') as data_dir:
+            first = os.path.join(data_dir, 'first')
+            second = os.path.join(data_dir, 'second')
+            self._write(first, items[:2], output_layer=-2)
+            self._write(second, items[2:], output_layer=-2)
+
+            merged = os.path.join(data_dir, 'merged')
+            builder = indexed_dataset.MMapBertFeatureDatasetBuilder(
+                indexed_dataset.data_file_path(merged), 8, -2,
+            )
+            builder.merge_file_(first)
+            builder.merge_file_(second)
+            builder.finalize(indexed_dataset.index_file_path(merged))
+
+            ds = MMapBertFeatureDataset(merged)
+            self.assertEqual(len(ds), 3)
+            self.assertEqual(ds.sizes.tolist(), [3, 1, 5])
+            self.assertEqual(ds.output_layer, -2)
+            for item, stored in zip(items, ds):
+                self.assertEqual(stored.dtype, torch.float16)
+                self.assertTrue(torch.equal(stored, item.half()))
+
+    def test_collate_pads_like_bert_input(self):
+        pad, eos = 1, 2
+        samples = [
+            {
+                'id': i,
+                'source': torch.LongTensor([4] * n + [eos]),
+                'target': None,
+                'source_bert': torch.LongTensor([5] * m),
+                'source_bert_features': torch.full((m, 4), float(i + 1)).half(),
+            }
+            for i, (n, m) in enumerate([(2, 3), (4, 2)])
+        ]
+        for left_pad in [True, False]:
+            batch = collate(samples, pad, eos, bert_pad_idx=0, left_pad_source=left_pad)
+            bert_input = batch['net_input']['bert_input']
+            features = batch['net_input']['bert_features']
+            self.assertEqual(features.shape, (2, 3, 4))
+            # padded positions are zero, real positions carry the features
+            self.assertTrue(features.ne(0).all(dim=-1).eq(bert_input.ne(0)).all())
+            for row, sample_id in enumerate(batch['id'].tolist()):
+                self.assertTrue(features[row][bert_input[row].ne(0)].eq(sample_id + 1).all())
+
+    def test_precomputed_bert_requires_right_padding(self):
+        with tempfile.TemporaryDirectory('test_bert_features') as data_dir:
+            for lang in ['de', 'en']:
+                Dictionary().save(os.path.join(data_dir, 'dict.{}.txt'.format(lang)))
+
+            def setup_task(**kwargs):
+                args = argparse.Namespace(
+                    data=data_dir, source_lang='de', target_lang='en', left_pad_source='True',
+                    left_pad_target='False', bert_model_name='bert-base-uncased', precomputed_bert=True,
+                    **kwargs
+                )
+                return TranslationTask.setup_task(args)
+
+            # the features are extracted from right-padded BERT input
+            with self.assertRaises(ValueError):
+                setup_task()
+            task = setup_task(left_pad_bert='False')
+            self.assertFalse(task.args.left_pad_bert)
+            self.assertTrue(task.args.left_pad_source)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import unittest
+from unittest.mock import MagicMock
+
+import torch
+
+from fairseq import optim, options
+from fairseq.trainer import Trainer
+import tests.utils as test_utils
+
+
+def get_args(*extra_args):
+    parser = options.get_training_parser()
+    return options.parse_args_and_arch(parser, [
+        'data-bin', '--arch', 'transformer', '--optimizer', 'adam', '--lr', '0.1', '--cpu', '--finetune-bert',
+    ] + list(extra_args))
+
+
+class TestBertFinetune(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = test_utils.bert_fused_model()
+        self.net_input = {
+            'src_tokens': torch.randint(4, 14, (2, 5)),
+            'src_lengths': torch.LongTensor([5, 5]),
+            'bert_input': torch.randint(4, 100, (2, 6)),
+            'prev_output_tokens': torch.randint(4, 14, (2, 4)),
+        }
+
+    def _step(self, optimizer):
+        optimizer.zero_grad()
+        # the NMT model's attention predates autograd's view checks, so only
+        # BERT and the source embeddings are run
+        loss = self.model.bert_features(self.net_input['bert_input']).sum()
+        loss = loss + self.model.encoder.embed_tokens(self.net_input['src_tokens']).sum()
+        optimizer.backward(loss)
+        optimizer.step()
+
+    def _trainable(self):
+        return [
+            all(p.requires_grad for p in module.parameters()) for module in self.model.bert_modules()
+        ]
+
+    def test_layerwise_lr(self):
+        args = get_args('--bert-lr-scale', '0.5', '--bert-layer-lr-decay', '0.5')
+        trainer = Trainer(args, MagicMock(), self.model, MagicMock())
+        # the NMT model, then the embeddings and the two layers
+        lrs = [group['lr'] for group in trainer.optimizer.optimizer.param_groups]
+        self.assertEqual(lrs, [0.1, 0.1 * 0.5 ** 3, 0.1 * 0.5 ** 2, 0.1 * 0.5])
+        self.assertEqual(trainer.get_lr(), 0.1)
+        self.assertEqual(self._trainable(), [True, True, True])
+        self.assertFalse(any(p.requires_grad for p in self.model.bert_encoder.pooler.parameters()))
+
+        trainer.optimizer.set_lr(0.2)
+        lrs = [group['lr'] for group in trainer.optimizer.optimizer.param_groups]
+        self.assertEqual(lrs, [0.2, 0.2 * 0.5 ** 3, 0.2 * 0.5 ** 2, 0.2 * 0.5])
+
+    def test_unfreeze_top_layers(self):
+        args = get_args('--finetune-bert-top-layers', '1', '--finetune-bert-after', '2')
+        trainer = Trainer(args, MagicMock(), self.model, MagicMock())
+        self.assertEqual(self._trainable(), [False, False, False])
+        self.assertEqual(len(trainer.optimizer.optimizer.param_groups), 2)
+
+        top_layer = self.model.bert_encoder.encoder.layer[1]
+        before = [p.clone() for p in top_layer.parameters()]
+        self._step(trainer.optimizer)
+        self.assertTrue(all(torch.equal(p, q) for p, q in zip(top_layer.parameters(), before)))
+
+        trainer.set_num_updates(2)
+        self.assertEqual(self._trainable(), [False, False, True])
+        self._step(trainer.optimizer)
+        self.assertFalse(any(torch.equal(p, q) for p, q in zip(top_layer.parameters(), before)))
+        # the lower layers are neither in autograd nor in the optimizer state
+        lower = list(self.model.bert_modules()[0].parameters()) + list(self.model.bert_modules()[1].parameters())
+        self.assertTrue(all(p.grad is None for p in lower))
+        self.assertTrue(all(p not in trainer.optimizer.optimizer.state for p in lower))
+
+    def test_fp16_optimizer_skips_frozen_groups(self):
+        args = get_args('--finetune-bert-top-layers', '1', '--finetune-bert-after', '2', '--bert-lr-scale', '0.1')
+        trainer = Trainer(args, MagicMock(), self.model, MagicMock())
+        optimizer = optim.FP16Optimizer.build_optimizer(args, trainer._param_groups())
+        optimizer.set_lr(0.1)
+        lrs = [group['lr'] for group in optimizer.optimizer.param_groups]
+        self.assertEqual(len(lrs), 2)
+        self.assertAlmostEqual(lrs[0], 0.1)
+        self.assertAlmostEqual(lrs[1], 0.01)
+
+        top_layer = self.model.bert_encoder.encoder.layer[1]
+        before = [p.clone() for p in top_layer.parameters()]
+        self._step(optimizer)
+        self.assertTrue(all(torch.equal(p, q) for p, q in zip(top_layer.parameters(), before)))
+        self.assertEqual(len(optimizer.optimizer.state), 1)
+
+        trainer.set_num_updates(2)
+        self._step(optimizer)
+        self.assertFalse(any(torch.equal(p, q) for p, q in zip(top_layer.parameters(), before)))
+        self.assertEqual(len(optimizer.optimizer.state), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import unittest
+
+import torch
+
+from bert import BertConfig, BertModel
+from fairseq.data import data_utils
+
+
+class TestPackedBert(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        config = BertConfig(
+            vocab_size_or_config_json_file=50, hidden_size=16, num_hidden_layers=2,
+            num_attention_heads=4, intermediate_size=32, max_position_embeddings=20,
+        )
+        self.model = BertModel(config)
+        self.model.eval()
+        self.pad = 0
+        self.inputs = [torch.randint(1, 50, (n,)) for n in [7, 3, 5, 1]]
+
+    def _check(self, left_pad):
+        input_ids = data_utils.collate_tokens(self.inputs, self.pad, left_pad=left_pad)
+        attention_mask = input_ids.ne(self.pad).long()
+        padded, _ = self.model(input_ids, attention_mask=attention_mask)
+        packed, _ = self.model(input_ids, attention_mask=attention_mask, packed=True)
+        self.assertEqual(len(packed), len(padded))
+        mask = attention_mask.bool()
+        for padded_layer, packed_layer in zip(padded, packed):
+            self.assertEqual(packed_layer.shape, padded_layer.shape)
+            self.assertTrue(torch.allclose(packed_layer[mask], padded_layer[mask], atol=1e-5))
+            self.assertTrue(packed_layer[~mask].eq(0).all())
+
+    def test_packed_matches_padded_right_pad(self):
+        self._check(left_pad=False)
+
+    def test_packed_matches_padded_left_pad(self):
+        self._check(left_pad=True)
+
+    def test_packed_backward(self):
+        self.model.train()
+        input_ids = data_utils.collate_tokens(self.inputs, self.pad, left_pad=False)
+        layers, _ = self.model(input_ids, attention_mask=input_ids.ne(self.pad).long(), packed=True)
+        layers[-1].sum().backward()
+        self.assertIsNotNone(self.model.embeddings.word_embeddings.weight.grad)
+
+
+class TestTruncatedBert(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.config = BertConfig(
+            vocab_size_or_config_json_file=50, hidden_size=16, num_hidden_layers=4,
+            num_attention_heads=4, intermediate_size=32, max_position_embeddings=20,
+        )
+        self.model = BertModel(self.config)
+        self.model.eval()
+        self.input_ids = data_utils.collate_tokens(
+            [torch.randint(1, 50, (n,)) for n in [7, 3, 5]], 0, left_pad=False,
+        )
+        self.attention_mask = self.input_ids.ne(0).long()
+
+    def test_output_layer(self):
+        layers, _ = self.model(self.input_ids, attention_mask=self.attention_mask)
+        for output_layer in [-4, -2, -1, 0, 2]:
+            for packed in [False, True]:
+                out, pooled = self.model(self.input_ids, attention_mask=self.attention_mask,
+                                         packed=packed, output_layer=output_layer)
+                self.assertIsNone(pooled)
+                mask = self.attention_mask.bool()
+                self.assertTrue(torch.allclose(out[mask], layers[output_layer][mask], atol=1e-5))
+        with self.assertRaises(ValueError):
+            self.model(self.input_ids, output_layer=4)
+
+    def test_truncate(self):
+        state_dict = self.model.state_dict()
+        expected, _ = self.model(self.input_ids, attention_mask=self.attention_mask, output_layer=-2)
+
+        truncated = BertModel(self.config)
+        truncated.truncate(-2)
+        self.assertEqual(len(truncated.encoder.layer), 3)
+        self.assertIsNone(truncated.pooler)
+        truncated.upgrade_state_dict_named(state_dict, '')
+        truncated.load_state_dict(state_dict, strict=True)
+        truncated.eval()
+
+        out, _ = truncated(self.input_ids, attention_mask=self.attention_mask, output_layer=-2)
+        self.assertTrue(torch.allclose(out, expected))
+        out, _ = truncated(self.input_ids, attention_mask=self.attention_mask, output_layer=2)
+        self.assertTrue(torch.allclose(out, expected))
+        with self.assertRaises(ValueError):
+            truncated(self.input_ids, output_layer=-1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import os
+import tempfile
+import unittest
+
+import torch
+
+from fairseq.bert_output_cache import BertOutputCache
+from fairseq.data import data_utils
+import tests.utils as test_utils
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError('BERT should not run on cached sentences')
+
+
+class TestBertOutputCache(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = test_utils.bert_fused_model()
+        self.pad = self.model.berttokenizer.pad()
+        self.bert_input = data_utils.collate_tokens(
+            [torch.randint(4, 100, (n,)) for n in [7, 3, 5, 1]], self.pad, left_pad=False,
+        )
+        self.tmpdir = tempfile.TemporaryDirectory('test_bert_output_cache')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _expected(self, bert_input, output_layer=None):
+        with torch.no_grad():
+            features = self.model.bert_features(bert_input, output_layer).half()
+        return features.masked_fill(bert_input.eq(self.pad).unsqueeze(-1), 0)
+
+    def test_hits_and_misses(self):
+        cache = BertOutputCache(self.tmpdir.name, 2 ** 20)
+        with torch.no_grad():
+            features = cache.bert_features(self.model, self.bert_input[:2])
+        self.assertTrue(torch.equal(features, self._expected(self.bert_input[:2])))
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        # only the new sentences go through BERT
+        with torch.no_grad():
+            default_layer = cache.bert_features(self.model, self.bert_input)
+        self.assertTrue(torch.allclose(default_layer.float(), self._expected(self.bert_input).float(), atol=1e-3))
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+        # another output layer is cached separately
+        with torch.no_grad():
+            features = cache.bert_features(self.model, self.bert_input, output_layer=0)
+        self.assertTrue(torch.allclose(features.float(), self._expected(self.bert_input, 0).float(), atol=1e-3))
+        self.assertEqual(len(cache), 8)
+        cache.close()
+
+        # and it persists
+        cache = BertOutputCache(self.tmpdir.name, 2 ** 20)
+        self.model.bert_features = _fail
+        self.assertTrue(torch.equal(cache.bert_features(self.model, self.bert_input), default_layer))
+        self.assertEqual((cache.hits, cache.misses), (4, 0))
+        cache.close()
+
+    def test_new_weights_miss(self):
+        cache = BertOutputCache(self.tmpdir.name, 2 ** 20)
+        with torch.no_grad():
+            cache.bert_features(self.model, self.bert_input)
+            self.model.bert_encoder.embeddings.word_embeddings.weight.mul_(2.)
+            features = cache.bert_features(self.model, self.bert_input)
+        self.assertEqual((cache.hits, cache.misses), (0, 8))
+        self.assertTrue(torch.allclose(features.float(), self._expected(self.bert_input).float(), atol=1e-3))
+        cache.close()
+
+    def test_lru_eviction(self):
+        sentence_bytes = [n * 8 * 2 for n in [7, 3, 5, 1]]
+        # room for the first two sentences, or the last three
+        cache = BertOutputCache(self.tmpdir.name, sum(sentence_bytes[:2]))
+        with torch.no_grad():
+            for i in range(4):
+                cache.bert_features(self.model, self.bert_input[i:i + 1])
+            self.assertEqual(len(cache), 3)
+            cache.bert_features(self.model, self.bert_input[1:2])
+            self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+            # the first sentence comes back and evicts the two least recently used ones
+            cache.bert_features(self.model, self.bert_input[0:1])
+            self.assertEqual(len(cache), 2)
+            self.model.bert_features = _fail
+            cache.bert_features(self.model, self.bert_input[[0, 1]])
+        self.assertLessEqual(cache.live_bytes, cache.max_bytes)
+        # the evicted states were compacted away
+        cache.close()
+        data_files = [f for f in os.listdir(self.tmpdir.name) if f.startswith('data.')]
+        self.assertEqual(len(data_files), 1)
+        self.assertLessEqual(os.path.getsize(os.path.join(self.tmpdir.name, data_files[0])), 2 * cache.max_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import os
+import pickle
+import random
+import tempfile
+import unittest
+
+from bert import BertTokenizer
+from bert.tokenization import whitespace_tokenize
+
+
+CORPUS = [
+    'The quick brown fox jumped over the lazy dog.',
+    'unaffable runner, running; ran!!',
+    '  leading and trailing whitespace \t\n',
+    'Héllo Wörld ÉCOLE straße İstanbul ǅ ﬁ Ⅸ',
+    'combining accents: é à ö',
+    '中文字符 mixed with English和日本語のかな',
+    '\U00020001 extension B character',
+    'control\x00chars\x0bare\x1cremoved�\x7f',
+    'other spaces line para　ideographic​zero',
+    '[CLS] keep [SEP] special [UNK] tokens [MASK] [cls]',
+    '$5.00 ^caret^ `backtick` ~tilde~ {braces} |pipe|',
+    'a' * 101,
+    'a' * 100,
+    '',
+    '##un ## #',
+]
+
+VOCAB = [
+    '[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '##', '#', '.', ',', '!', ';', '$', '^',
+    'the', 'quick', 'brown', 'fox', 'jump', '##ed', '##s', 'over', 'lazy', 'dog',
+    'un', '##aff', '##able', 'run', '##ner', '##ning', 'ran', 'a', '##a', 'e', '##e',
+    'hello', 'world', 'ecole', 'stra', '##ße', 'i', '##̇', 'is', '##tan', '##bul',
+    '中', '文', '##un', 'mixed', 'with', 'english', 'control', 'chars', 'are',
+    'keep', 'special', 'tokens', 'other', 'spaces', 'line', 'para', '5', '00',
+]
+
+
+def reference_tokenize(tokenizer, text):
+    """The BertTokenizer algorithm before the trie/memoized implementation."""
+    if tokenizer.do_basic_tokenize:
+        basic = tokenizer.basic_tokenizer
+        text = basic._tokenize_chinese_chars(basic._clean_text(text))
+        split_tokens = []
+        for token in whitespace_tokenize(text):
+            if basic.do_lower_case and token not in basic.never_split:
+                token = basic._run_strip_accents(token.lower())
+            split_tokens.extend(basic._run_split_on_punc(token))
+        words = whitespace_tokenize(' '.join(split_tokens))
+    else:
+        words = whitespace_tokenize(text)
+
+    vocab = tokenizer.vocab
+    output_tokens = []
+    for token in words:
+        if len(token) > tokenizer.wordpiece_tokenizer.max_input_chars_per_word:
+            output_tokens.append('[UNK]')
+            continue
+        start, sub_tokens = 0, []
+        while start < len(token):
+            end = len(token)
+            cur_substr = None
+            while start < end:
+                substr = token[start:end]
+                if start > 0:
+                    substr = '##' + substr
+                if substr in vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                sub_tokens = ['[UNK]']
+                break
+            sub_tokens.append(cur_substr)
+            start = end
+        output_tokens.extend(sub_tokens)
+    return output_tokens
+
+
+class TestBertTokenizer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory('test_bert_tokenizer')
+        self.vocab_file = os.path.join(self.tmpdir.name, 'vocab.txt')
+        with open(self.vocab_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(VOCAB) + '\n')
+        rng = random.Random(0)
+        chars = list('abefnrstu') * 4 + list('.,!$# ') + list('\t\x0b  \x00�éÄİß中文́')
+        self.corpus = CORPUS + [
+            ''.join(rng.choice(chars) for _ in range(rng.randint(0, 40))) for _ in range(500)
+        ]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_matches_reference(self):
+        for do_lower_case in [True, False]:
+            for do_basic_tokenize in [True, False]:
+                for cache_size in [0, 4, 100000]:
+                    tokenizer = BertTokenizer(
+                        self.vocab_file, do_lower_case=do_lower_case,
+                        do_basic_tokenize=do_basic_tokenize, cache_size=cache_size,
+                    )
+                    for text in self.corpus:
+                        self.assertEqual(tokenizer.tokenize(text), reference_tokenize(tokenizer, text))
+
+    def test_tokenize_batch_and_pickle(self):
+        tokenizer = BertTokenizer(self.vocab_file, max_len=8)
+        expected = [tokenizer.tokenize(text) for text in self.corpus]
+        self.assertEqual(tokenizer.tokenize_batch(self.corpus), expected)
+
+        restored = pickle.loads(pickle.dumps(tokenizer))
+        self.assertEqual(restored.tokenize_batch(self.corpus), expected)
+        self.assertEqual(restored.encode_lines(self.corpus), tokenizer.encode_lines(self.corpus))
+        for ids in tokenizer.encode_lines(self.corpus):
+            self.assertLessEqual(len(ids), 8)
+            self.assertEqual((ids[0], ids[-1]), (tokenizer.cls(), tokenizer.sep()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import os
+import tempfile
+import unittest
+
+from bert import BertTokenizer
+from fairseq.binarizer import Binarizer
+
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', 'the', 'cat', 'sat', 'on', 'mat', '##s', '.', ',']
+
+LINES = [
+    'The cat sat on the mat.',
+    'cats, mats',
+    '',
+    'the dog sat',
+] * 7
+
+
+class TestBinarizer(unittest.TestCase):
+
+    def test_binarize_bert_matches_per_line_encoding(self):
+        with tempfile.TemporaryDirectory('test_binarizer') as data_dir:
+            vocab_file = os.path.join(data_dir, 'vocab.txt')
+            with open(vocab_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(VOCAB) + '\n')
+            input_file = os.path.join(data_dir, 'input.txt')
+            with open(input_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(LINES) + '\n')
+
+            tokenizer = BertTokenizer(vocab_file, max_len=6)
+            expected = [tokenizer.encode_line(line) for line in LINES]
+
+            offsets = Binarizer.find_offsets(input_file, 3)
+            ids, nunk = [], 0
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                res = Binarizer.binarize_bert(
+                    input_file, tokenizer, lambda t: ids.append(t.tolist()),
+                    offset=start, end=end, batch_size=5,
+                )
+                nunk += res['nunk']
+
+            self.assertEqual(ids, expected)
+            self.assertEqual(nunk, sum(x.count(tokenizer.unk_index) for x in expected))
+            self.assertTrue(all(x[0] == tokenizer.cls() and x[-1] == tokenizer.sep() for x in ids))
+            self.assertTrue(all(len(x) <= 6 for x in ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
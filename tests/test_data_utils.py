@@ -0,0 +1,150 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import data_utils, LanguagePairDataset
+from fairseq.tasks import FairseqTask
+from tests.utils import dummy_dictionary
+
+
+def reference_batch_by_size(indices, budgets, max_sentences, bsz_mult):
+    """Per-index greedy batching, as done before the vectorized version."""
+    batch, sample_lens = [], []
+    for idx in indices:
+        sample_lens.append([sizes[idx] for sizes, _ in budgets])
+        batch_lens = [max(lens) for lens in zip(*sample_lens)]
+        full = len(batch) > 0 and (
+            len(batch) == max_sentences
+            or any((len(batch) + 1) * n > limit for n, (_, limit) in zip(batch_lens, budgets))
+        )
+        if full:
+            mod_len = max(bsz_mult * (len(batch) // bsz_mult), len(batch) % bsz_mult)
+            yield batch[:mod_len]
+            batch = batch[mod_len:]
+            sample_lens = sample_lens[mod_len:]
+        batch.append(idx)
+    if len(batch) > 0:
+        yield batch
+
+
+class TestBatchBySize(unittest.TestCase):
+
+    def test_matches_reference(self):
+        rng = np.random.RandomState(0)
+        for _ in range(300):
+            n = rng.randint(0, 300)
+            sizes = rng.randint(1, 100, size=n)
+            bert_sizes = sizes + rng.randint(0, 30, size=n)
+            indices = np.argsort(sizes + rng.randint(0, 10, size=n), kind='mergesort')
+            max_tokens = max(int(sizes.max(initial=0)), rng.choice([128, 400, 2000]))
+            max_bert_tokens = max(int(bert_sizes.max(initial=0)), rng.choice([150, 500, 2500]))
+            max_sentences = rng.choice([None, 1, 5, 40])
+            bsz_mult = rng.choice([1, 3, 8])
+
+            expected = list(reference_batch_by_size(
+                indices, [(sizes, max_tokens)], max_sentences, bsz_mult,
+            ))
+            batches = data_utils.batch_by_size(
+                indices, lambda idx: sizes[idx], max_tokens=max_tokens,
+                max_sentences=max_sentences, required_batch_size_multiple=bsz_mult,
+            )
+            self.assertEqual(batches, expected)
+
+            expected = list(reference_batch_by_size(
+                indices, [(sizes, max_tokens), (bert_sizes, max_bert_tokens)], max_sentences, bsz_mult,
+            ))
+            batches = data_utils.batch_by_size(
+                indices, None, max_tokens=max_tokens, max_sentences=max_sentences,
+                required_batch_size_multiple=bsz_mult, num_tokens_vec=sizes[indices],
+                bert_num_tokens_vec=bert_sizes[indices], max_bert_tokens=max_bert_tokens,
+            )
+            self.assertEqual(batches, expected)
+
+    def test_too_long_sample(self):
+        with self.assertRaises(AssertionError):
+            data_utils.batch_by_size([0, 1], lambda idx: [3, 9][idx], max_tokens=8)
+
+    def test_cache(self):
+        sizes = np.arange(1, 51)
+        indices = np.arange(50)[::-1]
+        with tempfile.TemporaryDirectory('test_batch_by_size') as cache_dir:
+            kwargs = dict(max_tokens=64, required_batch_size_multiple=2, cache_dir=cache_dir)
+            batches = data_utils.batch_by_size(indices, lambda idx: sizes[idx], **kwargs)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            offsets_fn, data_utils._batch_offsets = data_utils._batch_offsets, None
+            try:
+                cached = data_utils.batch_by_size(indices, lambda idx: sizes[idx], **kwargs)
+            finally:
+                data_utils._batch_offsets = offsets_fn
+            self.assertEqual(cached, batches)
+
+            kwargs['max_tokens'] = 128
+            data_utils.batch_by_size(indices, lambda idx: sizes[idx], **kwargs)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+
+class TestBertTokenBudget(unittest.TestCase):
+
+    def _dataset(self, src_sizes, bert_sizes):
+        d = dummy_dictionary(10)
+        src = [torch.LongTensor([4] * n) for n in src_sizes]
+        bert = [torch.LongTensor([5] * n) for n in bert_sizes]
+        return LanguagePairDataset(
+            src, src_sizes, d, tgt=src, tgt_sizes=src_sizes, tgt_dict=d,
+            srcbert=bert, srcbert_sizes=bert_sizes, berttokenizer=d, shuffle=False,
+        )
+
+    def _batches(self, dataset, **kwargs):
+        itr = FairseqTask(None).get_batch_iterator(
+            dataset, max_tokens=100, max_positions=(1024, 1024), **kwargs,
+        )
+        return itr.frozen_batches
+
+    def test_separate_bert_budget(self):
+        dataset = self._dataset([10] * 20, [40] * 20)
+        # the BERT input dominates max(src, tgt, srcbert)
+        self.assertEqual(max(len(b) for b in self._batches(dataset)), 2)
+        # with its own budget, --max-tokens only counts source and target
+        batches = self._batches(dataset, max_bert_tokens=400)
+        self.assertEqual(max(len(b) for b in batches), 10)
+        batches = self._batches(dataset, max_bert_tokens=120)
+        self.assertEqual(max(len(b) for b in batches), 3)
+
+    def test_quadratic_cost(self):
+        dataset = self._dataset([10] * 20, [10] * 20)
+        self.assertEqual(max(len(b) for b in self._batches(dataset)), 10)
+        # 10 + 0.1 * 10^2 = 20 token equivalents per sentence
+        batches = self._batches(dataset, quadratic_cost_weight=0.1)
+        self.assertEqual(max(len(b) for b in batches), 5)
+
+    def test_quadratic_cost_over_the_limit(self):
+        dataset = self._dataset([10, 60, 10], [10, 60, 10])
+        # within --max-tokens 100: 60 + 0.01 * 60^2 = 96
+        batches = self._batches(dataset, quadratic_cost_weight=0.01)
+        self.assertEqual(sorted(i for b in batches for i in b), [0, 1, 2])
+        # over it: 60 + 0.02 * 60^2 = 132
+        with self.assertRaisesRegex(Exception, '--max-tokens'):
+            self._batches(dataset, quadratic_cost_weight=0.02)
+        with contextlib.redirect_stdout(io.StringIO()):
+            batches = self._batches(dataset, quadratic_cost_weight=0.02, ignore_invalid_inputs=True)
+        self.assertEqual(sorted(i for b in batches for i in b), [0, 2])
+        # and likewise with its own BERT budget
+        dataset = self._dataset([10, 10, 10], [10, 60, 10])
+        with self.assertRaisesRegex(Exception, '--max-bert-tokens'):
+            self._batches(dataset, max_bert_tokens=100, quadratic_cost_weight=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
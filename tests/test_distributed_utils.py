@@ -0,0 +1,269 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import argparse
+import contextlib
+from io import StringIO
+import math
+import os
+import tempfile
+import unittest
+import weakref
+from unittest.mock import MagicMock
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from fairseq import distributed_utils
+from fairseq.criterions.label_smoothed_cross_entropy import LabelSmoothedCrossEntropyCriterion
+from fairseq.legacy_distributed_data_parallel import LegacyDistributedDataParallel
+from fairseq.models import BaseFairseqModel, DistributedFairseqModel
+from fairseq.tasks.fairseq_task import FairseqTask
+from fairseq.trainer import Trainer
+import tests.utils as test_utils
+
+
+WORLD_SIZE = 2
+
+
+def init_worker(rank, init_file):
+    args = argparse.Namespace(
+        cpu=True, distributed_world_size=WORLD_SIZE, distributed_rank=rank, distributed_backend='nccl',
+        distributed_init_method='file://' + init_file,
+    )
+    distributed_utils.distributed_init(args)
+    assert args.distributed_backend == 'gloo'
+    return args
+
+
+def spawn(fn):
+    with tempfile.TemporaryDirectory('test_distributed_utils') as tmpdir:
+        mp.spawn(fn, args=(os.path.join(tmpdir, 'init'),), nprocs=WORLD_SIZE)
+
+
+def logging_outputs(rank):
+    return [
+        {
+            'loss': 1.5 * (rank + i), 'nll_loss': 0.5 + rank,
+            'ntokens': 10 + rank, 'nsentences': 2, 'sample_size': 10 + rank,
+        }
+        for i in range(2)
+    ]
+
+
+def all_reduce_logging_outputs_worker(rank, init_file):
+    args = init_worker(rank, init_file)
+    args.fp16 = False
+    args.label_smoothing = 0.1
+    task = FairseqTask(args)
+    trainer = Trainer(args, task, torch.nn.Linear(2, 2), LabelSmoothedCrossEntropyCriterion(args, MagicMock()))
+
+    logs = logging_outputs(rank)
+    summed = trainer._all_reduce_logging_outputs(logs, [log['sample_size'] for log in logs], ooms=rank, grad_norm=0.25)
+    all_logs = logging_outputs(0) + logging_outputs(1)
+    expected = {k: sum(log[k] for log in all_logs) for k in all_logs[0]}
+    assert summed[0] == [expected], summed[0]
+    assert isinstance(summed[0][0]['ntokens'], int)
+    assert summed[1] == [expected['sample_size']]
+    assert summed[2] == 1
+    assert summed[3] == [0.25, 0.25]
+    assert (
+        task.aggregate_logging_outputs(summed[0], trainer.criterion)
+        == task.aggregate_logging_outputs(all_logs, trainer.criterion)
+    )
+
+    # the norms of the first update are unknown
+    summed = trainer._all_reduce_logging_outputs([{}], [0])
+    assert summed[:3] == ([{'loss': 0., 'nll_loss': 0., 'ntokens': 0, 'nsentences': 0, 'sample_size': 0}], [0], 0)
+    assert all(math.isnan(norm) for norm in summed[3])
+
+    # a worker without logging outputs, e.g. after OOMs, doesn't round the sums
+    logs = [] if rank == 0 else [{'loss': 1.5, 'nll_loss': 0.25, 'ntokens': 3, 'nsentences': 1, 'sample_size': 3}]
+    summed = trainer._all_reduce_logging_outputs(logs, [log['sample_size'] for log in logs])
+    assert summed[0] == [{'loss': 1.5, 'nll_loss': 0.25, 'ntokens': 3, 'nsentences': 1, 'sample_size': 3}], summed[0]
+    assert isinstance(summed[0][0]['loss'], float) and isinstance(summed[0][0]['ntokens'], int)
+
+    # all the workers gather if any has undeclared logging outputs
+    logs = logging_outputs(rank)
+    if rank == 1:
+        logs[0]['posterior'] = 0.5
+    with contextlib.redirect_stdout(StringIO()):
+        assert trainer._all_reduce_logging_outputs(logs, [10, 11]) is None
+
+    # tasks without logging keys gather the logging outputs
+    task.logging_keys = lambda criterion: None
+    assert trainer._all_reduce_logging_outputs(logs, [10]) is None
+
+
+def all_gather_list_worker(rank, init_file):
+    init_worker(rank, init_file)
+    assert distributed_utils.all_gather_list({'rank': rank, 'data': [rank] * 3}) == [
+        {'rank': i, 'data': [i] * 3} for i in range(WORLD_SIZE)
+    ]
+
+
+class LinearModel(BaseFairseqModel):
+
+    def __init__(self):
+        super().__init__()
+        self.fc1 = torch.nn.Linear(4, 8)
+        self.fc2 = torch.nn.Linear(8, 1)
+
+    def forward(self, x):
+        return self.fc2(self.fc1(x))
+
+
+def ddp_worker(rank, init_file):
+    args = init_worker(rank, init_file)
+    args.device_id = 0
+    args.bucket_cap_mb = 25
+    args.find_unused_parameters = False
+    inputs = [torch.randn(3, 4, generator=torch.Generator().manual_seed(i)) for i in range(WORLD_SIZE)]
+    for ddp_backend in ['c10d', 'no_c10d']:
+        torch.manual_seed(0)
+        model = LinearModel()
+        expected = [torch.zeros_like(p) for p in model.parameters()]
+        for x in inputs:
+            model.zero_grad()
+            model(x).sum().backward()
+            expected = [g + p.grad / WORLD_SIZE for g, p in zip(expected, model.parameters())]
+
+        model.zero_grad()
+        args.ddp_backend = ddp_backend
+        ddp_model = DistributedFairseqModel(args, model)
+        ddp_model(inputs[rank]).sum().backward()
+        for g, p in zip(expected, model.parameters()):
+            assert torch.allclose(p.grad, g, atol=1e-6), ddp_backend
+
+
+def dropnet_worker(rank, init_file):
+    args = init_worker(rank, init_file)
+    args.device_id = 0
+    args.bucket_cap_mb = 25
+    args.ddp_backend = 'c10d'
+    args.find_unused_parameters = False
+    args.encoder_bert_dropout = True
+    torch.manual_seed(0)
+    # each half of the draws skips one of the attention branches
+    model = test_utils.bert_fused_model(encoder_bert_dropout=True, encoder_bert_dropout_ratio=0.5)
+    model.train()
+    for p in model.bert_encoder.parameters():
+        p.requires_grad = False
+    ddp_model = DistributedFairseqModel(args, model)
+    # the workers draw different branches
+    np.random.seed(rank)
+    for step in range(3):
+        net_input = {
+            'src_tokens': torch.randint(4, 14, (2, 5), generator=torch.Generator().manual_seed(rank)),
+            'src_lengths': torch.LongTensor([5, 5]),
+            'bert_input': torch.randint(4, 100, (2, 6)),
+            'prev_output_tokens': torch.randint(4, 14, (2, 4)),
+        }
+        model.zero_grad()
+        ddp_model(**net_input)[0].sum().backward()
+        for name, p in model.named_parameters():
+            if p.grad is not None:
+                grad = p.grad.clone()
+                dist.all_reduce(grad)
+                assert torch.allclose(grad / WORLD_SIZE, p.grad, atol=1e-6), (step, name)
+
+
+class MLPModel(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.fc1 = torch.nn.Linear(4, 8)
+        self.fc2 = torch.nn.Linear(8, 8)
+        self.fc3 = torch.nn.Linear(8, 1)
+        self.frozen = torch.nn.Linear(4, 4)
+        self.unused = torch.nn.Linear(4, 4)
+
+    def forward(self, x):
+        return self.fc3(self.fc2(self.fc1(x) + self.frozen(x).sum(-1, keepdim=True)))
+
+
+def local_grads(model, batches):
+    model.zero_grad()
+    for x in batches:
+        model(x).sum().backward()
+    return [p.grad.clone() if p.grad is not None else None for p in model.parameters()]
+
+
+def legacy_ddp_worker(rank, init_file):
+    init_worker(rank, init_file)
+    inputs = [
+        [torch.randn(3, 4, generator=torch.Generator().manual_seed(2 * i + j)) for j in range(2)]
+        for i in range(WORLD_SIZE)
+    ]
+    for overlap in [True, False]:
+        torch.manual_seed(0)
+        model = MLPModel()
+        for p in model.frozen.parameters():
+            p.requires_grad = False
+        grads = [local_grads(model, batches) for batches in inputs]
+        expected = [g0 if g0 is None else (g0 + g1) / WORLD_SIZE for g0, g1 in zip(*grads)]
+
+        # buckets of up to 40 elements, so that fc2 is split from fc1
+        ddp = LegacyDistributedDataParallel(model, WORLD_SIZE, buffer_size=40, overlap_reduction=overlap)
+        assert len(ddp._buckets) > 2
+        model.zero_grad()
+        ddp.accumulate_grads = True
+        ddp(inputs[rank][0]).sum().backward()
+        # nothing is reduced on the accumulation steps
+        first = local_grads(model, inputs[rank][:1])
+        model.zero_grad()
+        ddp(inputs[rank][0]).sum().backward()
+        for g, p in zip(first, model.parameters()):
+            assert (p.grad is None) == (g is None) and (g is None or torch.equal(p.grad, g))
+
+        ddp.accumulate_grads = False
+        ddp(inputs[rank][1]).sum().backward()
+        for g, (name, p) in zip(expected, model.named_parameters()):
+            if name.startswith('frozen'):
+                assert p.grad is None
+            elif not name.startswith('unused'):
+                assert torch.allclose(p.grad, g, atol=1e-6), (overlap, name)
+        assert all(torch.equal(p.grad, torch.zeros_like(p)) for p in model.unused.parameters())
+
+        # once rebuilt, the previous module is freed and doesn't reduce anymore
+        for p in model.frozen.parameters():
+            p.requires_grad = True
+        grads = [local_grads(model, batches[:1]) for batches in inputs]
+        previous = weakref.ref(ddp)
+        del ddp
+        assert previous() is None
+        ddp = LegacyDistributedDataParallel(model, WORLD_SIZE, buffer_size=40, overlap_reduction=overlap)
+        model.zero_grad()
+        ddp(inputs[rank][0]).sum().backward()
+        for g0, g1, (name, p) in zip(*grads, model.named_parameters()):
+            if not name.startswith('unused'):
+                assert torch.allclose(p.grad, (g0 + g1) / WORLD_SIZE, atol=1e-6), (overlap, name)
+
+
+@unittest.skipIf(not dist.is_available(), 'torch.distributed is not available')
+class TestDistributedCPU(unittest.TestCase):
+
+    def test_all_reduce_logging_outputs(self):
+        spawn(all_reduce_logging_outputs_worker)
+
+    def test_all_gather_list(self):
+        spawn(all_gather_list_worker)
+
+    def test_distributed_data_parallel(self):
+        spawn(ddp_worker)
+
+    def test_dropnet_distributed_data_parallel(self):
+        spawn(dropnet_worker)
+
+    def test_legacy_distributed_data_parallel(self):
+        spawn(legacy_ddp_worker)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import argparse
+import unittest
+
+import torch
+
+from fairseq.models.transformer import (
+    base_architecture,
+    TransformerDecoderLayer,
+    TransformerS2EncoderLayer,
+)
+
+
+def layer_args(**kwargs):
+    args = argparse.Namespace(
+        encoder_embed_dim=16, encoder_ffn_embed_dim=32, encoder_attention_heads=4,
+        decoder_embed_dim=16, decoder_ffn_embed_dim=32, decoder_attention_heads=4,
+        dropout=0., attention_dropout=0., encoder_ratio=1., bert_ratio=1., bert_out_dim=12,
+    )
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    base_architecture(args)
+    return args
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError('zero-weighted branch should not be computed')
+
+
+class TestDropNet(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.x = torch.randn(5, 3, 16)
+        self.enc = torch.randn(7, 3, 16)
+        self.enc_mask = torch.zeros(3, 7).bool()
+        self.bert = torch.randn(6, 3, 12)
+        self.bert_mask = torch.zeros(3, 6).bool()
+
+    def _reference(self, layer):
+        """Both branches computed, with the BERT branch contributing nothing."""
+        layer.bert_attn.out_proj.weight.data.zero_()
+        layer.bert_attn.out_proj.bias.data.zero_()
+        layer.bert_ratio = 1.
+        expected = self._run(layer)
+        layer.bert_ratio = 0.
+        return expected
+
+    @torch.no_grad()
+    def _run(self, layer):
+        if isinstance(layer, TransformerDecoderLayer):
+            return layer(self.x, self.enc, self.enc_mask, self.bert, self.bert_mask)[0]
+        return layer(self.x, self.enc_mask[:, :5], self.bert, self.bert_mask)
+
+    def _check_bert_branch_skipped(self, layer):
+        layer.eval()
+        expected = self._reference(layer)
+        layer.bert_attn.forward = _fail
+        self.assertTrue(torch.allclose(self._run(layer), expected))
+
+    def test_decoder_layer_skips_bert_attn(self):
+        self._check_bert_branch_skipped(TransformerDecoderLayer(layer_args(bert_ratio=0.)))
+
+    def test_encoder_layer_skips_bert_attn(self):
+        self._check_bert_branch_skipped(TransformerS2EncoderLayer(layer_args(bert_ratio=0.)))
+
+    def test_decoder_layer_skips_encoder_attn(self):
+        layer = TransformerDecoderLayer(layer_args(encoder_ratio=0.))
+        layer.eval()
+        layer.encoder_attn.forward = _fail
+        with torch.no_grad():
+            x, attn = layer(self.x, self.enc, self.enc_mask, self.bert, self.bert_mask, incremental_state={})
+        self.assertEqual(x.shape, self.x.shape)
+        self.assertIsNone(attn)
+
+    def test_drop_net_training(self):
+        layer = TransformerDecoderLayer(layer_args(encoder_bert_dropout=True, encoder_bert_dropout_ratio=0.5))
+        layer.train()
+        layer.get_ratio = lambda: [0, 1]
+        layer.encoder_attn.forward = _fail
+        self.assertEqual(self._run(layer).shape, self.x.shape)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import unittest
+
+import torch
+
+from fairseq import utils
+from fairseq.modules import KVCache, MultiheadAttention
+
+
+class TestMultiheadAttention(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1)
+        self.bsz, self.beam, self.src_len, self.dim = 3, 4, 7, 16
+        self.attn = MultiheadAttention(self.dim, 4, kdim=12, vdim=12, encoder_decoder_attention=True)
+        self.attn.eval()
+        self.key = torch.randn(self.src_len, self.bsz, 12)
+        self.key_padding_mask = torch.zeros(self.bsz, self.src_len).bool()
+        self.key_padding_mask[0, -2:] = True
+
+    def _expand(self, order):
+        return self.key.index_select(1, order), self.key_padding_mask.index_select(0, order)
+
+    def test_beam_shared_static_kv_matches_expanded(self):
+        bsz, beam = self.bsz, self.beam
+        sent_order = torch.arange(bsz).repeat_interleave(beam)
+
+        shared_state, expanded_state = {}, {}
+        for step in range(3):
+            query = torch.randn(1, bsz * beam, self.dim)
+
+            self.attn.set_beam_size(beam)
+            shared_out, shared_weights = self.attn(
+                query, self.key, self.key, key_padding_mask=self.key_padding_mask,
+                incremental_state=shared_state, static_kv=True,
+            )
+            self.attn.set_beam_size(1)
+            key, key_padding_mask = self._expand(sent_order)
+            expanded_out, expanded_weights = self.attn(
+                query, key, key, key_padding_mask=key_padding_mask,
+                incremental_state=expanded_state, static_kv=True,
+            )
+            self.assertTrue(torch.allclose(shared_out, expanded_out, atol=1e-6))
+            self.assertTrue(torch.allclose(shared_weights, expanded_weights, atol=1e-6))
+
+            # shuffle beams within each sentence and drop the second sentence
+            # after the first step, like SequenceGenerator does
+            keep = torch.arange(bsz) if step != 1 else torch.LongTensor([0, 2])
+            perm = torch.stack([torch.randperm(beam) for _ in keep])
+            new_order = (keep.unsqueeze(1) * beam + perm).view(-1)
+            self.attn.set_beam_size(beam)
+            self.attn.reorder_incremental_state(shared_state, new_order)
+            self.attn.set_beam_size(1)
+            self.attn.reorder_incremental_state(expanded_state, new_order)
+            self.key = self.key.index_select(1, keep)
+            self.key_padding_mask = self.key_padding_mask.index_select(0, keep)
+            bsz = keep.numel()
+            sent_order = torch.arange(bsz).repeat_interleave(beam)
+
+        shared_key = self.attn._get_input_buffer(shared_state)['prev_key']
+        self.assertEqual(shared_key.size(0), bsz)
+
+    def test_project_static_kv(self):
+        attns = [self.attn] + [
+            MultiheadAttention(self.dim, 4, kdim=12, vdim=12, encoder_decoder_attention=True).eval()
+            for _ in range(2)
+        ]
+        query = torch.randn(1, self.bsz, self.dim)
+        for attn, (k, v) in zip(attns, MultiheadAttention.project_static_kv(attns, self.key)):
+            expected, precomputed_state = {}, {}
+            expected_out, _ = attn(
+                query, self.key, self.key, key_padding_mask=self.key_padding_mask,
+                incremental_state=expected, static_kv=True,
+            )
+            attn._set_input_buffer(precomputed_state, {'prev_key': k, 'prev_value': v})
+            out, _ = attn(
+                query, None, None, key_padding_mask=self.key_padding_mask,
+                incremental_state=precomputed_state, static_kv=True,
+            )
+            self.assertTrue(torch.allclose(out, expected_out, atol=1e-6))
+            expected = attn._get_input_buffer(expected)
+            self.assertTrue(torch.allclose(k, expected['prev_key'], atol=1e-6))
+            self.assertTrue(torch.allclose(v, expected['prev_value'], atol=1e-6))
+
+
+class TestKVCache(unittest.TestCase):
+
+    def test_matches_concatenated_cache(self):
+        torch.manual_seed(0)
+        heads, head_dim = 2, 3
+        for max_len in [1, 4, 20]:
+            bsz = 6
+            cache = KVCache(bsz, heads, head_dim, max_len)
+            prev_k = prev_v = None
+            for step in range(9):
+                if step > 0:
+                    # shuffle the hypotheses and sometimes drop some of them
+                    new_order = torch.randint(0, bsz, (bsz - (step % 3 == 0),))
+                    bsz = new_order.numel()
+                    cache.reorder(new_order)
+                    prev_k = prev_k.view(-1, heads, step, head_dim).index_select(0, new_order)
+                    prev_v = prev_v.view(-1, heads, step, head_dim).index_select(0, new_order)
+                    prev_k = prev_k.view(bsz * heads, step, head_dim)
+                    prev_v = prev_v.view(bsz * heads, step, head_dim)
+                k = torch.randn(bsz * heads, 1, head_dim)
+                v = torch.randn(bsz * heads, 1, head_dim)
+                prev_k = k if prev_k is None else torch.cat([prev_k, k], dim=1)
+                prev_v = v if prev_v is None else torch.cat([prev_v, v], dim=1)
+                cached_k, cached_v = cache.append(k, v)
+                self.assertTrue(torch.equal(cached_k, prev_k))
+                self.assertTrue(torch.equal(cached_v, prev_v))
+                self.assertEqual(len(cache), step + 1)
+
+    def test_incremental_self_attention(self):
+        torch.manual_seed(0)
+        attn = MultiheadAttention(16, 4, self_attention=True)
+        attn.eval()
+        x = torch.randn(5, 3, 16)
+        mask = torch.triu(utils.fill_with_neg_inf(x.new(5, 5)), 1)
+        with torch.no_grad():
+            expected, _ = attn(x, x, x, attn_mask=mask)
+            for max_decode_len in [None, 5]:
+                attn.set_max_decode_len(max_decode_len)
+                state = {}
+                for step in range(5):
+                    out, _ = attn(x[step:step + 1], x[step:step + 1], x[step:step + 1], incremental_state=state)
+                    self.assertTrue(torch.allclose(out, expected[step:step + 1], atol=1e-6))
+                self.assertEqual(len(attn._get_input_buffer(state)['kv_cache']), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
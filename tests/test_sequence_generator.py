@@ -6,11 +6,16 @@
 # can be found in the PATENTS file in the same directory.
 
 import argparse
+import copy
+import math
 import unittest
 
+import numpy as np
 import torch
 
-from fairseq.sequence_generator import SequenceGenerator
+from fairseq.sequence_generator import EnsembleModel, SequenceGenerator
+from fairseq.sequence_generator_ensemble import EnsembleModel as EnsembleModelOnBeams
+from fairseq.shortlist import Shortlist
 
 import tests.utils as test_utils
 
@@ -253,5 +258,270 @@ class TestDiverseBeamSearch(unittest.TestCase):
         self.assertEqual(t1.ne(t2).long().sum(), 0)
 
 
+class TestEnsembleBert(unittest.TestCase):
+
+    def test_bert_runs_once_per_distinct_encoder(self):
+        torch.manual_seed(0)
+        frozen = test_utils.bert_fused_model()
+        shared = copy.deepcopy(frozen)
+        finetuned = copy.deepcopy(frozen)
+        with torch.no_grad():
+            finetuned.bert_encoder.pooler.dense.bias.add_(1.)
+        models = [frozen, shared, finetuned]
+
+        calls = []
+        for i, model in enumerate(models):
+            model.forward_bert = lambda bert_input, bert_features, output_layer=None, i=i: calls.append(i) or {}
+        bert_outs = EnsembleModel(models).forward_bert(torch.LongTensor([[1, 2]]))
+        self.assertEqual(calls, [0, 2])
+        self.assertIs(bert_outs[0], bert_outs[1])
+        self.assertIsNot(bert_outs[0], bert_outs[2])
+
+        # a later change to the weights is picked up
+        with torch.no_grad():
+            shared.bert_encoder.embeddings.word_embeddings.weight.mul_(2.)
+        self.assertEqual(EnsembleModel(models).bert_groups, [0, 1, 2])
+
+    def test_mixed_bert_output_layers(self):
+        torch.manual_seed(0)
+        last = test_utils.bert_fused_model()
+        last.eval()
+        first = copy.deepcopy(last)
+        first.bert_output_layer = 0
+        models = [first, last]
+        bert_input = torch.LongTensor([[4, 5, 6], [7, 8, 1]])
+        for ensemble in [EnsembleModel(models), EnsembleModelOnBeams(models)]:
+            # the generator-wide layer is that of the last checkpoint
+            bert_outs = ensemble.forward_bert(bert_input, output_layer=-1)
+            for model, bert_out in zip(models, bert_outs):
+                expected = model.forward_bert(bert_input)['bert_encoder_out']
+                self.assertTrue(torch.equal(bert_out['bert_encoder_out'], expected))
+            self.assertFalse(torch.equal(bert_outs[0]['bert_encoder_out'], bert_outs[1]['bert_encoder_out']))
+
+
+class TestGreedy(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tgt_dict = test_utils.dummy_dictionary(10)
+        self.model = test_utils.bert_fused_model(self.tgt_dict)
+        self.model.eval()
+        src_tokens = torch.randint(4, len(self.tgt_dict), (8, 6))
+        src_tokens[:, -1] = self.tgt_dict.eos()
+        self.sample = {
+            'net_input': {
+                'src_tokens': src_tokens,
+                'src_lengths': torch.full((8,), 6, dtype=torch.long),
+                'bert_input': torch.randint(4, 100, (8, 7)),
+            },
+        }
+        # output weights under which the hypotheses end at different steps
+        torch.manual_seed(1)
+        with torch.no_grad():
+            self.model.decoder.embed_out.normal_(0, 1)
+            self.model.decoder.embed_out[self.tgt_dict.eos()] *= 2.
+
+    def _reference(self, i, max_len, min_len=1):
+        """Greedy decoding of sentence *i* with full decoder passes."""
+        net_input = {k: v[i:i + 1] for k, v in self.sample['net_input'].items()}
+        eos = self.tgt_dict.eos()
+        tokens, lprobs = [eos], []
+        for step in range(max_len + 1):
+            net_output = self.model(prev_output_tokens=torch.LongTensor([tokens]), **net_input)
+            step_lprobs = self.model.get_normalized_probs(net_output, log_probs=True)[0, -1]
+            step_lprobs[self.tgt_dict.pad()] = -math.inf
+            if step < min_len:
+                step_lprobs[eos] = -math.inf
+            if step == max_len:
+                tokens.append(eos)
+            else:
+                tokens.append(step_lprobs.argmax().item())
+            lprobs.append(step_lprobs[tokens[-1]].item())
+            if tokens[-1] == eos:
+                break
+        return tokens[1:], lprobs
+
+    @torch.no_grad()
+    def _check(self, max_len, **kwargs):
+        generator = SequenceGenerator(
+            self.tgt_dict, beam_size=1, max_len_b=max_len, args=argparse.Namespace(bert_output_layer=-1), **kwargs,
+        )
+        hypos = generator.generate([self.model], self.sample)
+        for i, sent_hypos in enumerate(hypos):
+            self.assertEqual(len(sent_hypos), 1)
+            tokens, lprobs = self._reference(i, max_len, kwargs.get('min_len', 1))
+            self.assertEqual(sent_hypos[0]['tokens'].tolist(), tokens)
+            self.assertTrue(torch.allclose(sent_hypos[0]['positional_scores'], torch.tensor(lprobs), atol=1e-4))
+            self.assertAlmostEqual(sent_hypos[0]['score'], sum(lprobs) / len(lprobs), places=4)
+            self.assertEqual(sent_hypos[0]['attention'].size(), (6, len(tokens)))
+
+    def test_greedy(self):
+        self._check(max_len=10)
+
+    def test_greedy_min_len(self):
+        self._check(max_len=10, min_len=4)
+
+    def test_greedy_max_len(self):
+        self._check(max_len=2)
+
+class TestBeamSizeReset(unittest.TestCase):
+
+    @torch.no_grad()
+    def test_beam_size_is_reset_after_generate(self):
+        torch.manual_seed(0)
+        tgt_dict = test_utils.dummy_dictionary(10)
+        model = test_utils.bert_fused_model(tgt_dict)
+        model.eval()
+        src_tokens = torch.randint(4, len(tgt_dict), (4, 6))
+        src_tokens[:, -1] = tgt_dict.eos()
+        sample = {
+            'net_input': {
+                'src_tokens': src_tokens,
+                'src_lengths': torch.full((4,), 6, dtype=torch.long),
+                'bert_input': torch.randint(4, 100, (4, 7)),
+            },
+        }
+        # the greedy path returns early, the beam size is reset nonetheless
+        generator = SequenceGenerator(tgt_dict, beam_size=1, max_len_b=8, args=argparse.Namespace(bert_output_layer=-1))
+
+        def beam_sizes():
+            return [m.beam_size for m in model.modules() if hasattr(m, 'set_beam_size') and hasattr(m, 'beam_size')]
+
+        self.assertTrue(len(beam_sizes()) > 0)
+        generator.generate([model], sample)
+        # e.g. SequenceScorer expands the outputs over the beams itself
+        self.assertTrue(all(beam_size is None for beam_size in beam_sizes()))
+
+        def fail(*args, **kwargs):
+            raise RuntimeError('decoder failure')
+
+        model.decoder.forward = fail
+        with self.assertRaises(RuntimeError):
+            generator.generate([model], sample)
+        self.assertTrue(all(beam_size is None for beam_size in beam_sizes()))
+
+
+class TestShortlist(unittest.TestCase):
+
+    def setUp(self):
+        TestGreedy.setUp(self)
+
+    def test_build(self):
+        # pairs of source tokens 4, 5 with target tokens 2 (EOS), 4, 5, 6, as src * 7 + tgt
+        pair_codes = np.array([4 * 7 + 2, 4 * 7 + 4, 4 * 7 + 5, 4 * 7 + 6, 5 * 7 + 6])
+        pair_counts = np.array([9, 1, 3, 2, 5])
+        tgt_counts = np.array([0, 0, 9, 0, 1, 8, 2])
+        shortlist = Shortlist.build(pair_codes, pair_counts, tgt_counts, 7, size=2, num_frequent=1, nspecial=4)
+        self.assertEqual(shortlist.frequent.tolist(), [0, 1, 2, 3, 5])
+        self.assertEqual(shortlist.candidates[4].tolist(), [5, 6])
+        self.assertEqual(shortlist.candidates[5].tolist(), [6, -1])
+        self.assertEqual(shortlist.candidates[6].tolist(), [-1, -1])
+        self.assertEqual(shortlist.vocab(torch.LongTensor([[5, 2]])).tolist(), [0, 1, 2, 3, 5, 6])
+        self.assertEqual(shortlist.vocab(torch.LongTensor([[6], [4]])).tolist(), [0, 1, 2, 3, 5, 6])
+
+    def _generate(self, shortlist):
+        generator = SequenceGenerator(
+            self.tgt_dict, beam_size=1, max_len_b=10, args=argparse.Namespace(bert_output_layer=-1),
+        )
+        generator.shortlist = shortlist
+        return generator.generate([self.model], self.sample)
+
+    def test_full_shortlist(self):
+        vocab_size = len(self.tgt_dict)
+        shortlist = Shortlist(torch.arange(vocab_size).repeat(vocab_size, 1), torch.arange(0))
+        for hypos, expected in zip(self._generate(shortlist), self._generate(None)):
+            self.assertTrue(torch.equal(hypos[0]['tokens'], expected[0]['tokens']))
+            self.assertTrue(torch.equal(hypos[0]['positional_scores'], expected[0]['positional_scores']))
+
+    def test_restricted_shortlist(self):
+        # source tokens 4-8 only translate to 9-13
+        candidates = torch.full((len(self.tgt_dict), 1), -1, dtype=torch.long)
+        candidates[4:9, 0] = torch.arange(9, 14)
+        shortlist = Shortlist(candidates, torch.arange(self.tgt_dict.nspecial))
+        allowed = set(shortlist.vocab(self.sample['net_input']['src_tokens']).tolist())
+        for hypos in self._generate(shortlist):
+            self.assertTrue(set(hypos[0]['tokens'].tolist()) <= allowed)
+            self.assertTrue(torch.isfinite(hypos[0]['positional_scores']).all())
+
+
+class TestConcurrentBert(unittest.TestCase):
+
+    def setUp(self):
+        TestGreedy.setUp(self)
+
+    def _memories(self, concurrent):
+        self.model.concurrent_bert = concurrent
+        generator = SequenceGenerator(self.tgt_dict, beam_size=1, args=argparse.Namespace(bert_output_layer=-1))
+        return generator.forward_memories([self.model], self.sample)
+
+    def test_forward_memories(self):
+        (encoder_out,), (bert_out,) = self._memories(concurrent=True)
+        (expected_encoder_out,), (expected_bert_out,) = self._memories(concurrent=False)
+        self.assertTrue(torch.equal(encoder_out['encoder_out'], expected_encoder_out['encoder_out']))
+        self.assertTrue(torch.equal(bert_out['bert_encoder_out'], expected_bert_out['bert_encoder_out']))
+
+    def test_forward(self):
+        prev_output_tokens = torch.randint(4, len(self.tgt_dict), (8, 3))
+        outputs = []
+        for concurrent in [True, False]:
+            self.model.concurrent_bert = concurrent
+            with torch.no_grad():
+                outputs.append(self.model(prev_output_tokens=prev_output_tokens, **self.sample['net_input'])[0])
+        self.assertTrue(torch.equal(outputs[0], outputs[1]))
+
+
+class TestPrecomputeStaticKV(unittest.TestCase):
+
+    def setUp(self):
+        TestGreedy.setUp(self)
+
+    def test_skips_zero_weighted_branches(self):
+        generator = SequenceGenerator(self.tgt_dict, beam_size=1, args=argparse.Namespace(bert_output_layer=-1))
+        (encoder_out,), (bert_out,) = generator.forward_memories([self.model], self.sample)
+        layer = self.model.decoder.layers[0]
+        for ratios, expected in [((1., 1.), [True, True]), ((1., 0.), [True, False]), ((0., 1.), [False, True])]:
+            layer.set_ratios(*ratios)
+            incremental_state = {}
+            self.model.decoder.precompute_static_kv(encoder_out, bert_out, incremental_state)
+            self.assertEqual([
+                'prev_key' in attn._get_input_buffer(incremental_state)
+                for attn in [layer.encoder_attn, layer.bert_attn]
+            ], expected)
+
+
+def reference_banned_tokens(tokens, step, n):
+    """Per-hypothesis ngram blocking, as done before the vectorized version."""
+    banned = []
+    for row in tokens.tolist():
+        gen_ngrams = {}
+        for ngram in zip(*[row[i:] for i in range(n)]):
+            gen_ngrams[tuple(ngram[:-1])] = gen_ngrams.get(tuple(ngram[:-1]), []) + [ngram[-1]]
+        if step + 2 - n >= 0:
+            banned.append(set(gen_ngrams.get(tuple(row[step + 2 - n:step + 1]), [])))
+        else:
+            banned.append(set())
+    return banned
+
+
+class TestNoRepeatNgram(unittest.TestCase):
+
+    def test_matches_reference(self):
+        torch.manual_seed(0)
+        tgt_dict = test_utils.dummy_dictionary(4)
+        for n in [1, 2, 3, 4]:
+            generator = SequenceGenerator(
+                tgt_dict, no_repeat_ngram_size=n, args=argparse.Namespace(bert_output_layer=-1),
+            )
+            for step in range(12):
+                tokens = torch.full((20, 14), tgt_dict.pad(), dtype=torch.long)
+                tokens[:, 0] = tgt_dict.eos()
+                # few distinct tokens, so that ngrams repeat
+                tokens[:, 1:step + 1] = torch.randint(4, 7, (20, step))
+                lprobs = torch.zeros(20, len(tgt_dict))
+                generator._ban_repeated_ngrams(tokens, lprobs, step)
+                banned = [set(row.eq(-math.inf).nonzero().view(-1).tolist()) for row in lprobs]
+                self.assertEqual(banned, reference_banned_tokens(tokens, step, n))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,8 +5,11 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import argparse
 import contextlib
 from io import StringIO
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
 
@@ -127,5 +130,49 @@ class TestLoadCheckpoint(unittest.TestCase):
         patch.stopall()
 
 
+class TestSaveCheckpoint(unittest.TestCase):
+
+    def test_prune_frozen_states(self):
+        with tempfile.TemporaryDirectory('test_train') as save_dir:
+            args = argparse.Namespace(
+                no_save=False, distributed_rank=0, save_dir=save_dir, no_epoch_checkpoints=False,
+                save_interval=1, save_interval_updates=0, keep_interval_updates=-1, keep_last_epochs=1,
+            )
+
+            def save(frozen_file):
+                # what Trainer.save_checkpoint writes with --dedup-frozen-params
+                def save_checkpoint(path, extra_state):
+                    torch.save({'model': {}, 'frozen_model_state': frozen_file}, path)
+                    torch.save({}, os.path.join(save_dir, frozen_file))
+                    return frozen_file
+                return save_checkpoint
+
+            trainer, epoch_itr = MagicMock(), MagicMock()
+            epoch_itr.end_of_epoch.return_value = True
+            # BERT layers are unfrozen in the third epoch
+            for epoch, frozen_file in [(1, 'frozen_aa.pt'), (2, 'frozen_aa.pt'), (3, 'frozen_bb.pt')]:
+                epoch_itr.epoch = epoch
+                trainer.save_checkpoint.side_effect = save(frozen_file)
+                with contextlib.redirect_stdout(StringIO()):
+                    checkpoint_utils.save_checkpoint(args, trainer, epoch_itr, None)
+                self.assertTrue(os.path.exists(os.path.join(save_dir, frozen_file)))
+            self.assertEqual(sorted(os.listdir(save_dir)), [
+                'checkpoint3.pt', 'checkpoint_last.pt', 'frozen_bb.pt', 'frozen_states.json',
+            ])
+
+            # the checkpoints are not read back, so unrecorded ones keep all frozen states
+            torch.save({}, os.path.join(save_dir, 'checkpoint_best.pt'))
+            for epoch, frozen_file in [(4, 'frozen_cc.pt'), (5, 'frozen_cc.pt')]:
+                epoch_itr.epoch = epoch
+                trainer.save_checkpoint.side_effect = save(frozen_file)
+                with contextlib.redirect_stdout(StringIO()):
+                    checkpoint_utils.save_checkpoint(args, trainer, epoch_itr, None)
+            self.assertIn('frozen_bb.pt', os.listdir(save_dir))
+            os.remove(os.path.join(save_dir, 'checkpoint_best.pt'))
+            with contextlib.redirect_stdout(StringIO()):
+                checkpoint_utils.save_checkpoint(args, trainer, epoch_itr, None)
+            self.assertNotIn('frozen_bb.pt', os.listdir(save_dir))
+
+
 if __name__ == '__main__':
     unittest.main()
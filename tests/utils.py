@@ -8,6 +8,7 @@
 import argparse
 import torch
 
+from bert import BertConfig, BertModel
 from fairseq import utils
 from fairseq.data import Dictionary
 from fairseq.data.language_pair_dataset import collate
@@ -16,6 +17,7 @@ from fairseq.models import (
     FairseqEncoderDecoderModel,
     FairseqIncrementalDecoder,
 )
+from fairseq.models.transformer import base_architecture, Embedding, TransformerModel
 from fairseq.tasks import FairseqTask
 
 
@@ -28,6 +30,30 @@ def dummy_dictionary(vocab_size, prefix='token_'):
     return d
 
 
+def bert_fused_model(d=None, bert_layers=2, **kwargs):
+    """A tiny randomly initialized bert-fused transformer in eval mode, over
+    the dictionary *d* (by default ``dummy_dictionary(10)``) and a BERT of
+    *bert_layers* layers. *kwargs* are added to the model args."""
+    args = argparse.Namespace(
+        encoder_embed_dim=16, encoder_ffn_embed_dim=32, encoder_layers=1, encoder_attention_heads=2,
+        decoder_embed_dim=16, decoder_ffn_embed_dim=32, decoder_layers=1, decoder_attention_heads=2,
+        encoder_ratio=1., bert_ratio=1., bert_gates=[1], max_source_positions=100, max_target_positions=100,
+        **kwargs
+    )
+    base_architecture(args)
+    bert = BertModel(BertConfig(
+        100, hidden_size=8, num_hidden_layers=bert_layers, num_attention_heads=2, intermediate_size=16,
+    ))
+    args.bert_out_dim = bert.hidden_size
+    if d is None:
+        d = dummy_dictionary(10)
+    encoder = TransformerModel.build_encoder(args, d, Embedding(len(d), 16, d.pad()))
+    decoder = TransformerModel.build_decoder(args, d, Embedding(len(d), 16, d.pad()))
+    model = TransformerModel(encoder, decoder, bert, d, False, args)
+    model.eval()
+    return model
+
+
 def dummy_dataloader(
     samples,
     padding_idx=1,
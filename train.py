@@ -57,13 +57,14 @@ def main(args, init_distributed=False):
     criterion = task.build_criterion(args)
     print(model)
     print('| model {}, criterion {}'.format(args.arch, criterion.__class__.__name__))
+
+    # Build trainer
+    trainer = Trainer(args, task, model, criterion)
+    # the trainer may freeze more of BERT, see --finetune-bert-top-layers
     print('| num. model params: {} (num. trained: {})'.format(
         sum(p.numel() for p in model.parameters()),
         sum(p.numel() for p in model.parameters() if p.requires_grad),
     ))
-
-    # Build trainer
-    trainer = Trainer(args, task, model, criterion)
     print('| training on {} GPUs'.format(args.distributed_world_size))
     print('| max tokens per GPU = {} and max sentences per GPU = {}'.format(
         args.max_tokens,
@@ -219,6 +220,8 @@ def validate(args, trainer, task, epoch_itr, subsets):
             num_shards=args.distributed_world_size,
             shard_id=args.distributed_rank,
             num_workers=args.num_workers,
+            max_bert_tokens=args.max_bert_tokens,
+            quadratic_cost_weight=args.quadratic_cost_weight,
         ).next_epoch_itr(shuffle=False)
         progress = progress_bar.build_progress_bar(
             args, itr, epoch_itr.epoch,
@@ -283,7 +286,7 @@ def cli_main():
 
     if args.distributed_init_method is not None:
         # distributed training
-        if torch.cuda.device_count() > 1 and not args.distributed_no_spawn:
+        if torch.cuda.device_count() > 1 and not args.distributed_no_spawn and not args.cpu:
             start_rank = args.distributed_rank
             args.distributed_rank = None  # assign automatically
             torch.multiprocessing.spawn(
@@ -294,8 +297,12 @@ def cli_main():
         else:
             distributed_main(args.device_id, args)
     elif args.distributed_world_size > 1:
-        # fallback for single node with multiple GPUs
-        assert args.distributed_world_size <= torch.cuda.device_count()
+        # fallback for single node with multiple GPUs, or CPU worker processes
+        if not args.cpu:
+            assert args.distributed_world_size <= torch.cuda.device_count()
+        elif 'OMP_NUM_THREADS' not in os.environ:
+            # share the cores between the CPU workers
+            os.environ['OMP_NUM_THREADS'] = str(max(1, os.cpu_count() // args.distributed_world_size))
         port = random.randint(10000, 20000)
         args.distributed_init_method = 'tcp://localhost:{port}'.format(port=port)
         args.distributed_rank = None  # set based on device id